@@ -7,29 +7,159 @@ import subprocess
 import base64
 import hashlib
 import secrets
+from urllib.parse import quote
+import re
+import sqlite3
+import time
+import queue
+import threading
+import hmac
+import io
+import struct
+import tarfile
+import zlib
+import concurrent.futures
+import tempfile
+import contextlib
+import asyncio
+from logging.handlers import RotatingFileHandler
 from typing import List, Dict, Optional
 
 # 第三方库
 import httpx
 import pyzipper
-from fastapi import FastAPI, UploadFile, BackgroundTasks, HTTPException, File, Depends, status
-from fastapi.responses import HTMLResponse, JSONResponse
+import pyzipper.zipfile_aes
+import zstandard
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Depends, Request, status
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from webdav4.client import Client as WebDavClient
+from webdav4.client import ResourceNotFound
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from pytz import timezone
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 
 # --- 全局配置与常量 ---
 
-DATA_DIR = "/data"
-CONF_DIR = "/conf"
+# 目录可通过环境变量覆盖 (DATA_FOLDER 与 Vaultwarden 使用的变量一致；基准测试等离线运行时使用)
+DATA_DIR = os.getenv("DATA_FOLDER", "/data")
+CONF_DIR = os.getenv("BACKUP_CONF_DIR", "/conf")
 BACKUP_CONFIG_FILE = os.path.join(CONF_DIR, "backup_config.json")
 LOG_FILE = os.path.join(CONF_DIR, "manager.log")
-TEMP_DIR = "/tmp/backup_work"
+CATALOG_FILE = os.path.join(CONF_DIR, "backup_catalog.json")
+NOTIFY_TIMEOUT = 10
+NOTIFY_BATCH_WINDOW = 2
+LOG_MAX_BYTES = 5 * 1024 * 1024  # manager.log 超过 5 MB 时轮转
+LOG_BACKUP_COUNT = 3
+LOG_TAIL_BLOCK = 64 * 1024
+LOG_STREAM_BACKLOG = 200
+LOG_STREAM_INTERVAL = 1.0
+TEMP_DIR = os.getenv("BACKUP_TEMP_DIR", "/tmp/backup_work")
 TZ_CN = timezone('Asia/Shanghai')
 
+# SQLite 主数据库及其附属文件 (在线快照模式下附属文件无需打包)
+SQLITE_DB_NAME = "db.sqlite3"
+SQLITE_SIDECAR_SUFFIXES = ("-wal", "-shm", "-journal")
+
+# 流式传输: 单块大小与队列深度 (内存占用上限约为二者乘积)
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_QUEUE_DEPTH = 8
+
+# 分阶段还原: /data 是挂载点无法整体重命名，暂存与回滚目录放在 /data 内部，
+# 以保证顶层条目的交换都是同一文件系统内的 rename
+RESTORE_STAGING_DIR = ".restore_staging"
+RESTORE_ROLLBACK_DIR = ".restore_rollback"
+RESTORE_WORK_DIRS = (RESTORE_STAGING_DIR, RESTORE_ROLLBACK_DIR)
+# 停机打包模式的流式/增量路径: 停机期间在 /data 内冻结一份一致视图 (硬链接需要同一文件系统)，服务恢复后从中打包
+BACKUP_FREEZE_DIR = ".backup_freeze"
+# 附件与 Send 文件由 Vaultwarden 一次写入、只会整体删除，冻结时硬链接即可；其余文件可能被原地改写，需要复制
+FREEZE_LINK_DIRS = ("attachments", "sends")
+# /data 中的工作目录，不参与备份、指纹与还原时的目录交换
+DATA_WORK_DIRS = RESTORE_WORK_DIRS + (BACKUP_FREEZE_DIR,)
+
+# 备份校验: 顺序读取条目的块大小与 integrity_check 最多报告的问题数
+VERIFY_READ_SIZE = 1024 * 1024
+VERIFY_MAX_ERRORS = 20
+
+# WebDAV 连接池: 每个目标保留的空闲长连接数与空闲超时秒数
+WEBDAV_KEEPALIVE_CONNECTIONS = 16
+WEBDAV_KEEPALIVE_EXPIRY = 60
+
+# 可靠上传: 上传过程中使用的临时文件后缀 (完成后 MOVE 为正式文件名)
+UPLOAD_TEMP_SUFFIX = ".part"
+
+# 分段下载: 本地续传进度文件后缀 (下载中的数据写入 <文件名>.part)
+DOWNLOAD_STATE_SUFFIX = ".progress"
+
+# 资源调度: /alive 探测间隔与超时、降速下限与单次暂停上限 (秒)
+GOVERNOR_PROBE_INTERVAL = 2
+GOVERNOR_PROBE_TIMEOUT = 5
+GOVERNOR_MIN_SCALE = 0.1
+GOVERNOR_MAX_PAUSE = 1.0
+
+# 上传还原: multipart 表单相对文件本身的额外开销上限 (用于按 Content-Length 提前拒绝) 与 Zip 本地文件头
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+ZIP_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+ZIP_LOCAL_MAGIC = b"PK\x03\x04"
+
+# 按文件还原: 随机读取远程 Zip 时单次 Range 请求的最小/最大长度 (顺序读取时逐次翻倍)
+RANGE_READ_MIN = 64 * 1024
+RANGE_READ_MAX = 4 * 1024 * 1024
+
+# 并行压缩: 不再压缩的扩展名、试压缩抽样大小与单个条目的内存缓冲上限 (超出后落地到 TEMP_DIR)
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".ico", ".avif", ".heic",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar",
+    ".mp3", ".mp4", ".m4a", ".mov", ".mkv", ".webm", ".pdf", ".docx", ".xlsx", ".pptx",
+}
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_SPOOL_SIZE = 4 * 1024 * 1024
+
+# 流式归档格式 (.vwb): tar -> zstd -> 分块 AES-256-GCM，头部带魔数与版本号
+ARCHIVE_MAGIC = b"VWBK"
+ARCHIVE_VERSION = 1
+ARCHIVE_SUFFIX = ".vwb"
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+ARCHIVE_FINAL_FLAG = 1 << 31
+ARCHIVE_SCRYPT_LOG_N = 15
+# 魔数, 版本, 标志, 盐, scrypt log2(N)/r/p, nonce 前缀, 密钥校验值, 分块大小, zstd 字典 ID, 打包前的数据大小
+ARCHIVE_HEADER = struct.Struct(">4sBB16sBBB8s8sIIQ")
+
+# 增量备份: 远程分块仓库目录、本地文件缓存与 FastCDC 参数 (平均约 1 MB)
+INCREMENTAL_STORE_DIR = "chunks"
+INCREMENTAL_CACHE_FILE = os.path.join(CONF_DIR, "incremental_cache.json")
+CHUNK_BLOB_MAGIC = b"VWC1"
+INCREMENTAL_MANIFEST_SUFFIX = ".manifest"
+CDC_MIN_SIZE = 256 * 1024
+CDC_AVG_BITS = 20
+CDC_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_TRANSFER_WORKERS = 4
+
+# 变更检测: 最近一次成功备份的数据指纹
+LAST_BACKUP_FILE = os.path.join(CONF_DIR, "last_backup.json")
+
+# 持续复制: 远程目录 (<存储路径>/wal/<基础备份名>/)、本地状态与影子数据库 (最近一次上传后的页面状态)
+WAL_REMOTE_DIR = "wal"
+WAL_SEGMENT_SUFFIX = ".seg"
+WAL_STATE_FILE = os.path.join(CONF_DIR, "wal_state.json")
+WAL_SHADOW_FILE = os.path.join(CONF_DIR, "wal_shadow.sqlite3")
+WAL_SEGMENT_HEADER = struct.Struct(">II")
+# SQLite -wal 文件格式: 文件头 (魔数, 版本, 页大小, 检查点序号, salt1, salt2, 校验和) 与帧头 (页号, 提交后的页数, salt1, salt2, 校验和)
+WAL_FILE_HEADER = struct.Struct(">8I")
+WAL_FRAME_HEADER = struct.Struct(">6I")
+WAL_MAGIC = (0x377F0682, 0x377F0683)  # 校验和按小端 / 大端字节序计算
+# 持续复制周期会短暂占用任务锁，期间提交的任务最多等待的秒数
+JOB_LOCK_WAIT = 30
+
 # 读取环境变量中的管理员账号密码
 ADMIN_USER = os.getenv("DASHBOARD_ADMIN_USER", "admin")
 ADMIN_PASS = os.getenv("DASHBOARD_ADMIN_PASSWORD", "admin")
@@ -41,7 +171,7 @@ os.makedirs(DATA_DIR, exist_ok=True)
 
 # 日志配置
 logging.basicConfig(
-    filename=LOG_FILE,
+    handlers=[RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')],
     level=logging.INFO,
     format='%(asctime)s [%(levelname)s] %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S'
@@ -77,36 +207,210 @@ def check_auth(credentials: HTTPBasicCredentials = Depends(security)):
         )
     return credentials.username
 
+# --- 监控指标 (Prometheus) ---
+
+PHASE_DURATION = Histogram(
+    "vw_job_phase_duration_seconds", "备份/还原各阶段耗时", ["job", "phase"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+SERVICE_DOWNTIME = Histogram(
+    "vw_service_downtime_seconds", "stop_service 到 start_service 之间的停机时长", ["mode"],
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600),
+)
+BYTES_PACKED = Counter("vw_backup_packed_bytes_total", "打包的源数据字节数")
+BYTES_UPLOADED = Counter("vw_backup_uploaded_bytes_total", "上传到 WebDAV 的字节数 (含重试)")
+ARCHIVE_SIZE = Gauge("vw_backup_archive_bytes", "最近一次备份的归档大小")
+COMPRESSION_RATIO = Gauge("vw_backup_compression_ratio", "最近一次 Zip 备份的压缩后/压缩前大小之比")
+WEBDAV_LATENCY = Histogram(
+    "vw_webdav_request_duration_seconds", "WebDAV 请求耗时", ["context", "operation"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+JOBS_TOTAL = Counter("vw_jobs_total", "结束的任务数", ["job", "status"])
+LAST_SUCCESS = Gauge("vw_job_last_success_timestamp_seconds", "最近一次成功完成的时间戳", ["job"])
+VERIFY_TOTAL = Counter("vw_backup_verifications_total", "备份校验次数", ["status"])
+WAL_SEGMENTS = Counter("vw_wal_segments_total", "持续复制上传的增量段数")
+WAL_LAST_SHIPPED = Gauge("vw_wal_last_shipped_timestamp_seconds", "最近一次上传增量段的时间戳")
+ALIVE_LATENCY = Histogram(
+    "vw_service_alive_latency_seconds", "任务运行期间 Vaultwarden /alive 的响应时间",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+GOVERNOR_SCALE = Gauge("vw_governor_speed_ratio", "后台任务当前的速度比例 (1 为全速)")
+GOVERNOR_PAUSE = Counter("vw_governor_pause_seconds_total", "自适应降速累计暂停的时间 (各线程之和)")
+NOTIFY_FAILURES = Counter("vw_notification_failures_total", "重试后仍然失败的通知数", ["channel"])
+
+@contextlib.contextmanager
+def webdav_timer(context: str, operation: str):
+    """记录一次 WebDAV 请求的耗时"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        WEBDAV_LATENCY.labels(context, operation).observe(time.monotonic() - started)
+
 # --- 辅助功能函数 ---
 
-def load_config() -> dict:
-    """加载配置文件"""
-    if os.path.exists(BACKUP_CONFIG_FILE):
+# 配置项类型 (未列出的键原样保留)；加载时校验一次，类型不符的值会被丢弃并回退为默认值
+CONFIG_SCHEMA = {
+    "schedule_cron": str,
+    "max_backups": int,
+    "backup_mode": ("stop", "online"),
+    "backup_format": ("zip", "vwb", "incremental"),
+    "stream_transfer": bool,
+    "compression_level": int,
+    "compression_workers": int,
+    "zstd_level": int,
+    "zstd_dictionary": str,
+    "encryption_password": str,
+    "webdav_url": str,
+    "webdav_path": str,
+    "webdav_user": str,
+    "webdav_password": str,
+    "webdav_targets": list,
+    "upload_retries": int,
+    "upload_segment_mb": int,
+    "upload_bandwidth_limit": float,
+    "download_workers": int,
+    "download_retries": int,
+    "download_segment_mb": int,
+    "upload_max_mb": int,
+    "download_bandwidth_limit": float,
+    "backup_read_limit": float,
+    "job_nice": int,
+    "job_io_class": ("none", "best-effort", "idle"),
+    "governor_latency_ms": int,
+    "catalog_ttl": int,
+    "vaultwarden_url": str,
+    "restore_health_timeout": float,
+    "verify_after_backup": bool,
+    "wal_replication": bool,
+    "wal_interval": int,
+    "notify_on_success": bool,
+    "notify_retries": int,
+    "tg_bot_token": str,
+    "tg_chat_id": str,
+    "bark_url": str,
+    "smtp_host": str,
+    "smtp_port": int,
+    "smtp_user": str,
+    "smtp_pass": str,
+    "mail_to": str,
+}
+
+# 限速配置 (KB/s，可以是小数)
+RATE_LIMIT_KEYS = ("upload_bandwidth_limit", "download_bandwidth_limit", "backup_read_limit")
+
+_config_lock = threading.RLock()
+_config_cache = {"stamp": None, "data": {}}
+
+def validate_config(config: dict):
+    """按 CONFIG_SCHEMA 校验并规范化配置，返回 (规范化后的配置, 错误列表)"""
+    if not isinstance(config, dict):
+        return {}, ["配置必须是 JSON 对象"]
+    result = {}
+    errors = []
+    for key, value in config.items():
+        expected = CONFIG_SCHEMA.get(key)
+        if expected is None or value is None:
+            if value is not None:
+                result[key] = value
+            continue
         try:
-            with open(BACKUP_CONFIG_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logging.error(f"加载配置失败: {e}")
-    return {}
+            if isinstance(expected, tuple):
+                if value not in expected:
+                    raise ValueError(f"可选值为 {', '.join(expected)}")
+            elif expected is list:
+                if not isinstance(value, list) or not all(isinstance(v, dict) for v in value):
+                    raise ValueError("应为对象列表")
+                if key == "webdav_targets":
+                    # 目标名称用于区分备份索引与上传状态，不能重复，default 保留给主目标
+                    names = [str(t.get("name") or f"target{i + 1}") for i, t in enumerate(value)]
+                    duplicated = sorted({n for n in names if names.count(n) > 1 or n == "default"})
+                    if duplicated:
+                        raise ValueError(f"目标名称重复: {', '.join(duplicated)}")
+            elif expected is bool:
+                if not isinstance(value, bool):
+                    raise ValueError("应为布尔值")
+            elif expected is str:
+                if isinstance(value, bool) or not isinstance(value, (str, int)):
+                    raise ValueError("应为字符串")
+                value = str(value)
+            else:
+                if isinstance(value, bool):
+                    raise ValueError("应为数字")
+                if isinstance(value, str) and not value.strip():
+                    continue
+                value = expected(value)
+                if key in RATE_LIMIT_KEYS and value < 0:
+                    raise ValueError("不能为负数 (0 表示不限速)")
+            result[key] = value
+        except (TypeError, ValueError) as e:
+            errors.append(f"{key}: {e}")
+    return result, errors
+
+def _config_stamp():
+    try:
+        st = os.stat(BACKUP_CONFIG_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+def load_config() -> dict:
+    """加载配置 (内存缓存，仅在文件 mtime/inode 变化时重新解析)"""
+    stamp = _config_stamp()
+    with _config_lock:
+        if stamp != _config_cache["stamp"]:
+            data = {}
+            if stamp is not None:
+                try:
+                    with open(BACKUP_CONFIG_FILE, 'r', encoding='utf-8') as f:
+                        data, errors = validate_config(json.load(f))
+                    for error in errors:
+                        logging.error(f"配置项无效，已忽略: {error}")
+                except Exception as e:
+                    logging.error(f"加载配置失败: {e}")
+            _config_cache["stamp"] = stamp
+            _config_cache["data"] = data
+        return dict(_config_cache["data"])
 
 def save_config(config: dict):
-    """保存配置文件，并尝试更新调度任务"""
-    with open(BACKUP_CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(config, f, indent=4, ensure_ascii=False)
+    """校验并原子写入配置文件 (临时文件 + 重命名)，Cron 或持续复制设置变化时更新调度任务"""
+    data, errors = validate_config(config)
+    if errors:
+        raise ValueError("; ".join(errors))
+
+    with _config_lock:
+        old = load_config()
+        old_cron = old.get('schedule_cron')
+        tmp_path = BACKUP_CONFIG_FILE + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, BACKUP_CONFIG_FILE)
+        _config_cache["stamp"] = _config_stamp()
+        _config_cache["data"] = data
     
-    # 尝试重新调度
-    try:
-        schedule_backup_job(config)
-    except Exception as e:
-        logging.error(f"更新调度任务失败: {e}")
+    # 仅在 Cron 变化时重新调度
+    if data.get('schedule_cron') != old_cron:
+        try:
+            schedule_backup_job(data)
+        except Exception as e:
+            logging.error(f"更新调度任务失败: {e}")
+    if any(data.get(k) != old.get(k) for k in ("wal_replication", "wal_interval")):
+        try:
+            schedule_wal_job(data)
+        except Exception as e:
+            logging.error(f"更新持续复制任务失败: {e}")
 
 def get_current_time_str():
     """获取当前北京时间字符串"""
     return datetime.datetime.now(TZ_CN).strftime("%Y%m%d_%H%M%S")
 
-def send_telegram_notify(msg: str, success: bool = True):
+def notify_title(success: bool) -> str:
+    return "Vaultwarden 备份/还原成功" if success else "Vaultwarden 备份/还原失败"
+
+def send_telegram_notify(cfg: dict, http: httpx.Client, msg: str, success: bool = True):
     """发送 Telegram 通知"""
-    cfg = load_config()
     token = cfg.get("tg_bot_token")
     chat_id = cfg.get("tg_chat_id")
     
@@ -114,48 +418,39 @@ def send_telegram_notify(msg: str, success: bool = True):
         return
     
     emoji = "✅" if success else "❌"
-    title = "Vaultwarden 备份成功" if success else "Vaultwarden 备份/还原失败"
+    title = notify_title(success)
     text = f"{emoji} *{title}*\n\n{msg}\n\n🕒 时间: {datetime.datetime.now(TZ_CN).strftime('%Y-%m-%d %H:%M:%S')}"
     
     url = f"https://api.telegram.org/bot{token}/sendMessage"
-    try:
-        httpx.post(url, json={"chat_id": chat_id, "text": text, "parse_mode": "Markdown"}, timeout=10)
-    except Exception as e:
-        logging.error(f"Telegram 发送失败: {e}")
+    http.post(url, json={"chat_id": chat_id, "text": text, "parse_mode": "Markdown"}).raise_for_status()
 
-def send_bark_notify(msg: str, success: bool = True):
+def send_bark_notify(cfg: dict, http: httpx.Client, msg: str, success: bool = True):
     """发送 Bark 通知 (iOS)"""
-    cfg = load_config()
     bark_url = cfg.get("bark_url", "").strip()
     
     if not bark_url:
         return
     
-    title = "Vaultwarden 备份成功" if success else "Vaultwarden 备份/还原失败"
-    icon = "checkmark.circle.fill" if success else "xmark.circle.fill"
+    title = notify_title(success)
     
     # 支持两种格式: https://api.day.app/xxx 或 https://api.day.app/xxx/
     bark_url = bark_url.rstrip('/')
     
-    try:
-        # Bark API v2 格式
-        url = f"{bark_url}/{title}/{msg}"
-        params = {
-            "icon": f"https://cdn-icons-png.flaticon.com/512/6195/6195699.png",
-            "group": "Vaultwarden",
-            "sound": "success" if success else "failure"
-        }
-        httpx.get(url, params=params, timeout=10)
-    except Exception as e:
-        logging.error(f"Bark 发送失败: {e}")
+    # Bark API v2 格式 (合并后的消息可能包含换行，需要编码)
+    url = f"{bark_url}/{quote(title, safe='')}/{quote(msg, safe='')}"
+    params = {
+        "icon": f"https://cdn-icons-png.flaticon.com/512/6195/6195699.png",
+        "group": "Vaultwarden",
+        "sound": "success" if success else "failure"
+    }
+    http.get(url, params=params).raise_for_status()
 
-def send_email_notify(msg: str, success: bool = True):
+def send_email_notify(cfg: dict, http: httpx.Client, msg: str, success: bool = True):
     """发送邮件通知"""
     import smtplib
     from email.mime.text import MIMEText
     from email.header import Header
     
-    cfg = load_config()
     smtp_host = cfg.get("smtp_host", "").strip()
     smtp_port = int(cfg.get("smtp_port", 465))
     smtp_user = cfg.get("smtp_user", "").strip()
@@ -165,7 +460,7 @@ def send_email_notify(msg: str, success: bool = True):
     if not all([smtp_host, smtp_user, smtp_pass, mail_to]):
         return
     
-    title = "✅ Vaultwarden 备份成功" if success else "❌ Vaultwarden 备份/还原失败"
+    title = ("✅ " if success else "❌ ") + notify_title(success)
     time_str = datetime.datetime.now(TZ_CN).strftime('%Y-%m-%d %H:%M:%S')
     
     body = f"""
@@ -178,41 +473,128 @@ def send_email_notify(msg: str, success: bool = True):
 此邮件由 Vaultwarden Backup Admin 自动发送
 """
     
+    message = MIMEText(body, 'plain', 'utf-8')
+    message['From'] = smtp_user
+    message['To'] = mail_to
+    message['Subject'] = Header(title, 'utf-8')
+    
+    # 尝试 SSL 连接
+    if smtp_port == 465:
+        server = smtplib.SMTP_SSL(smtp_host, smtp_port, timeout=NOTIFY_TIMEOUT)
+    else:
+        server = smtplib.SMTP(smtp_host, smtp_port, timeout=NOTIFY_TIMEOUT)
+        server.starttls()
+    
     try:
-        message = MIMEText(body, 'plain', 'utf-8')
-        message['From'] = smtp_user
-        message['To'] = mail_to
-        message['Subject'] = Header(title, 'utf-8')
-        
-        # 尝试 SSL 连接
-        if smtp_port == 465:
-            server = smtplib.SMTP_SSL(smtp_host, smtp_port, timeout=10)
-        else:
-            server = smtplib.SMTP(smtp_host, smtp_port, timeout=10)
-            server.starttls()
-        
         server.login(smtp_user, smtp_pass)
         server.sendmail(smtp_user, [mail_to], message.as_string())
+    finally:
         server.quit()
-    except Exception as e:
-        logging.error(f"邮件发送失败: {e}")
+
+NOTIFY_CHANNELS = {
+    "Telegram": send_telegram_notify,
+    "Bark": send_bark_notify,
+    "邮件": send_email_notify,
+}
+
+class NotificationDispatcher:
+    """通知分发器
+
+    消息进入队列后由后台线程发送，备份/还原线程不会被网络阻塞。短时间内的多条消息合并为一条，
+    每批只读取一次配置，各渠道并发发送并复用同一个 keep-alive HTTP 客户端，失败按指数退避重试。
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._http = None
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(NOTIFY_CHANNELS), thread_name_prefix="notify")
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def submit(self, msg: str, success: bool):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="notify-dispatcher", daemon=True)
+                self._worker.start()
+        self._queue.put((msg, success))
+
+    def _collect(self) -> List[tuple]:
+        """取出一条消息，并等待合并窗口内到达的后续消息"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + NOTIFY_BATCH_WINDOW
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._dispatch(batch)
+            except Exception as e:
+                logging.error(f"通知分发出错: {e}")
+
+    def _dispatch(self, batch: List[tuple]):
+        cfg = load_config()
+        if not cfg.get("notify_on_success", False):
+            batch = [item for item in batch if not item[1]]
+        if not batch:
+            return
+
+        success = all(ok for _, ok in batch)
+        msg = "\n\n".join(m for m, _ in batch)
+        if self._http is None:
+            self._http = httpx.Client(timeout=NOTIFY_TIMEOUT)
+
+        retries = max(int(cfg.get("notify_retries", 3)), 0)
+        futures = {
+            self._pool.submit(self._send, channel, send, cfg, msg, success, retries): channel
+            for channel, send in NOTIFY_CHANNELS.items()
+        }
+        concurrent.futures.wait(futures)
+
+    def _send(self, channel: str, send, cfg: dict, msg: str, success: bool, retries: int):
+        for attempt in range(retries + 1):
+            try:
+                send(cfg, self._http, msg, success)
+                return
+            except Exception as e:
+                if attempt >= retries:
+                    logging.error(f"{channel} 发送失败: {e}")
+                    NOTIFY_FAILURES.labels(channel).inc()
+                    return
+                wait = min(2 ** attempt, 30)
+                logging.warning(f"{channel} 发送失败 ({e})，{wait} 秒后重试 ({attempt + 1}/{retries})")
+                time.sleep(wait)
+
+notifier = NotificationDispatcher()
 
 def send_notifications(msg: str, success: bool = True):
-    """统一发送所有通知"""
-    send_telegram_notify(msg, success)
-    send_bark_notify(msg, success)
-    send_email_notify(msg, success)
+    """统一发送所有通知 (异步排队，立即返回)"""
+    notifier.submit(msg, success)
 
 
 # --- 服务控制函数 ---
 
 def stop_service():
     logging.info("正在停止 Vaultwarden 服务...")
-    subprocess.run(["supervisorctl", "stop", "vaultwarden"], check=True)
+    governor.service_stopped()
+    try:
+        subprocess.run(["supervisorctl", "stop", "vaultwarden"], check=True)
+    except Exception:
+        governor.service_started()
+        raise
 
 def start_service():
     logging.info("正在启动 Vaultwarden 服务...")
     subprocess.run(["supervisorctl", "start", "vaultwarden"], check=True)
+    governor.service_started()
 
 # --- 过滤器逻辑 ---
 
@@ -226,249 +608,3618 @@ def is_file_allowed(filename: str) -> bool:
     # 其他所有文件（包括图标缓存、临时文件等）全部备份
     return True
 
+# --- 备份目录索引 ---
+
+def get_targets(cfg: dict) -> List[dict]:
+    """返回所有启用的 WebDAV 目标
+
+    顶层 webdav_url/webdav_path 为主目标，webdav_targets 中可配置更多目标；
+    每个目标是在全局配置上覆盖了自身连接参数、max_backups 与 timeout 的配置字典。
+    """
+    targets = []
+    if cfg.get("webdav_url"):
+        targets.append({**cfg, "name": "default"})
+    for i, extra in enumerate(cfg.get("webdav_targets") or []):
+        if not extra.get("webdav_url") or not extra.get("enabled", True):
+            continue
+        target = {**cfg, "webdav_path": "/", "webdav_user": "", "webdav_password": ""}
+        target.update({k: v for k, v in extra.items() if v not in (None, "")})
+        target.setdefault("name", f"target{i + 1}")
+        targets.append(target)
+    return targets
+
+class WebDavClientPool:
+    """按连接参数缓存 WebDAV 客户端，所有请求共享同一个 HTTP 连接池 (keep-alive)
+
+    httpx.Client 可以跨线程共享：备份、还原、索引同步与 API 请求使用同一个客户端，
+    不再每次调用都重新建立 TCP/TLS 连接。配置文件变化后，不再出现在配置中的目标被移出缓存，
+    新的连接参数会创建新的客户端；被移出的客户端可能仍被运行中的任务使用，因此不主动关闭，
+    由垃圾回收释放其连接。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._stamp = None
+
+    @staticmethod
+    def _key(cfg: dict) -> tuple:
+        return (cfg["webdav_url"], cfg.get("webdav_user", ""), cfg.get("webdav_password", ""),
+                float(cfg.get("timeout") or 30))
+
+    def get(self, cfg: dict) -> WebDavClient:
+        key = self._key(cfg)
+        stamp = _config_stamp()
+        with self._lock:
+            if stamp != self._stamp:
+                self._stamp = stamp
+                live = {self._key(t) for t in get_targets(load_config())}
+                for k in [k for k in self._clients if k not in live]:
+                    del self._clients[k]
+            client = self._clients.get(key)
+            if client is None:
+                client = WebDavClient(
+                    key[0],
+                    auth=(key[1], key[2]),
+                    timeout=key[3],
+                    limits=httpx.Limits(max_keepalive_connections=WEBDAV_KEEPALIVE_CONNECTIONS,
+                                        keepalive_expiry=WEBDAV_KEEPALIVE_EXPIRY),
+                )
+                self._clients[key] = client
+            return client
+
+webdav_clients = WebDavClientPool()
+
+def make_webdav_client(cfg: dict) -> WebDavClient:
+    """返回该目标共享的 WebDAV 客户端 (目标可单独设置超时秒数 timeout)"""
+    return webdav_clients.get(cfg)
+
+def file_sha256(path: str) -> str:
+    """计算本地文件的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def parse_backup_time(name: str) -> str:
+    """从备份文件名中解析备份时间 (北京时间)"""
+    m = re.search(r"vw_backup_(\d{8}_\d{6})", name)
+    if not m:
+        return ""
+    return datetime.datetime.strptime(m.group(1), "%Y%m%d_%H%M%S").strftime("%Y-%m-%d %H:%M:%S")
+
+class BackupCatalog:
+    """远程备份的本地索引 (/conf/backup_catalog.json)
+
+    备份列表与保留策略直接读取索引，只有索引过期 (catalog_ttl) 或强制同步时才对 WebDAV 做完整 PROPFIND。
+    每个目标按 "目标名称 + WebDAV 地址 + 存储路径" 单独索引，同时记录最近一次上传的状态和列表请求的耗时。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._data = None
+
+    def _empty(self) -> dict:
+        return {"synced_at": 0, "entries": {}, "temp_files": [], "chunk_store": False, "latency": None, "last_upload": None}
+
+    def _load(self, target: str) -> dict:
+        if self._data is None:
+            self._data = {"targets": {}}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    # 兼容旧版单目标索引
+                    if "target" in data:
+                        data = {"targets": {data.pop("target"): data}}
+                    self._data = data
+                except Exception as e:
+                    logging.error(f"加载备份索引失败: {e}")
+        data = self._data["targets"].setdefault(target, self._empty())
+        for key, value in self._empty().items():
+            data.setdefault(key, value)
+        return data
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def is_stale(self, target: str, ttl: int) -> bool:
+        with self._lock:
+            return time.time() - self._load(target)["synced_at"] > ttl
+
+    def entries(self, target: str) -> List[dict]:
+        """按名称 (即时间) 倒序返回所有备份"""
+        with self._lock:
+            entries = list(self._load(target)["entries"].values())
+        return sorted(entries, key=lambda e: e["name"], reverse=True)
+
+    def meta(self, target: str) -> dict:
+        with self._lock:
+            data = self._load(target)
+            return {
+                "synced_at": data["synced_at"],
+                "temp_files": list(data["temp_files"]),
+                "chunk_store": data["chunk_store"],
+                "latency": data["latency"],
+                "last_upload": data["last_upload"],
+            }
+
+    def clear_temp_files(self, target: str):
+        with self._lock:
+            self._load(target)["temp_files"] = []
+            self._save()
+
+    def record(self, target: str, name: str, **fields):
+        """新增或更新一条备份记录"""
+        with self._lock:
+            data = self._load(target)
+            entry = data["entries"].setdefault(name, {"name": name, "timestamp": parse_backup_time(name), "checksum": None})
+            entry.update(fields)
+            if entry.get("format") == "incremental":
+                data["chunk_store"] = True
+            self._save()
+
+    def remove(self, target: str, name: str):
+        with self._lock:
+            if self._load(target)["entries"].pop(name, None) is not None:
+                self._save()
+
+    def set_upload_status(self, target: str, **status):
+        """记录目标最近一次上传的结果"""
+        with self._lock:
+            self._load(target)["last_upload"] = status
+            self._save()
+
+    def sync(self, client: WebDavClient, remote_dir: str, target: str, context: str = "list_backups"):
+        """对 WebDAV 做一次完整列表，与索引对账 (保留同名同大小备份的校验和等附加信息)"""
+        with self._sync_lock:
+            started = time.monotonic()
+            with webdav_timer(context, "list"):
+                files = client.ls(remote_dir, detail=True)
+            latency = time.monotonic() - started
+            entries = {}
+            temp_files = []
+            chunk_store = False
+            with self._lock:
+                data = self._load(target)
+                old = data["entries"]
+                for f in files:
+                    name = os.path.basename(f['name'].rstrip('/'))
+                    if f.get('type') == 'directory':
+                        chunk_store = chunk_store or name == INCREMENTAL_STORE_DIR
+                        continue
+                    if name.endswith(UPLOAD_TEMP_SUFFIX):
+                        temp_files.append(f['name'])
+                        continue
+                    if not is_backup_name(name):
+                        continue
+
+                    # 健壮的大小获取
+                    raw_size = f.get('size')
+                    if raw_size is None:
+                        raw_size = f.get('content_length')
+                    try:
+                        size_bytes = int(raw_size) if raw_size is not None else 0
+                    except:
+                        size_bytes = 0
+
+                    modified = f.get('modified')
+                    entry = {}
+                    prev = old.get(name)
+                    if prev and prev.get("size") == size_bytes:
+                        entry.update(prev)
+                    entry.update({
+                        "name": name,
+                        "path": f['name'],
+                        "size": size_bytes,
+                        "last_modified": modified.astimezone(TZ_CN).strftime("%Y-%m-%d %H:%M:%S") if modified else "",
+                        "timestamp": parse_backup_time(name),
+                        "format": backup_format_of(name),
+                    })
+                    entry.setdefault("checksum", None)
+                    entries[name] = entry
+
+                data.update({
+                    "synced_at": time.time(),
+                    "entries": entries,
+                    "temp_files": temp_files,
+                    "chunk_store": chunk_store,
+                    "latency": latency,
+                })
+                self._save()
+            logging.info(f"备份索引已同步 ({target}): {len(entries)} 个备份, 列表耗时 {latency:.2f} 秒")
+
+catalog = BackupCatalog(CATALOG_FILE)
+
+def backup_format_of(name: str) -> str:
+    """根据文件名判断备份格式"""
+    if name.endswith(INCREMENTAL_MANIFEST_SUFFIX):
+        return "incremental"
+    return "vwb" if name.endswith(ARCHIVE_SUFFIX) else "zip"
+
+def catalog_target(cfg: dict) -> str:
+    # 目标名称唯一：地址与路径相同但凭据不同的两个目标也各自索引 (未经 get_targets 的顶层配置即主目标)
+    return f"{cfg.get('name', 'default')}|{cfg.get('webdav_url', '')}|{cfg.get('webdav_path', '/')}"
+
+def refresh_catalog(force: bool = False, client: Optional[WebDavClient] = None, context: str = "list_backups",
+                    target_cfg: Optional[dict] = None) -> List[dict]:
+    """索引过期 (或 force) 时与 WebDAV 对账，返回该目标最新的备份列表 (默认为主目标)"""
+    cfg = target_cfg or load_config()
+    target = catalog_target(cfg)
+    if force or catalog.is_stale(target, int(cfg.get("catalog_ttl", 300))):
+        catalog.sync(client or make_webdav_client(cfg), cfg.get('webdav_path', '/'), target, context)
+    return catalog.entries(target)
+
+def refresh_all_catalogs(force: bool = False) -> List[dict]:
+    """并发刷新所有目标的索引，合并为一个备份列表；每个备份记录所在的目标 (不可用的目标被跳过)"""
+    targets = get_targets(load_config())
+
+    def refresh(t: dict):
+        try:
+            refresh_catalog(force, target_cfg=t)
+        except Exception as e:
+            logging.error(f"同步备份索引失败 ({t['name']}): {e}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(targets), 1)) as pool:
+        list(pool.map(refresh, targets))
+    return merge_catalog_entries(targets)
+
+def merge_catalog_entries(targets: List[dict]) -> List[dict]:
+    """合并各目标索引中的备份，每个备份记录所在的目标"""
+    merged = {}
+    for t in targets:
+        for entry in catalog.entries(catalog_target(t)):
+            item = merged.setdefault(entry["name"], {**entry, "targets": []})
+            item["targets"].append(t["name"])
+    return sorted(merged.values(), key=lambda e: e["name"], reverse=True)
+
+def rank_targets(cfg: dict, name: Optional[str] = None) -> List[dict]:
+    """按最近一次列表请求的耗时排序目标 (未测量的排在后面)；指定 name 时优先包含该备份的目标"""
+    def key(t: dict):
+        target = catalog_target(t)
+        meta = catalog.meta(target)
+        has_backup = name is None or any(e["name"] == name for e in catalog.entries(target))
+        latency = meta["latency"] if meta["latency"] is not None else float("inf")
+        return (not has_backup, latency)
+    return sorted(get_targets(cfg), key=key)
+
+def refresh_catalog_quietly():
+    """后台刷新索引 (失败只记录日志)"""
+    try:
+        refresh_all_catalogs()
+    except Exception as e:
+        logging.error(f"后台同步备份索引失败: {e}")
+
 # --- 保留策略逻辑 ---
 
-def apply_retention_policy(client: WebDavClient, remote_dir: str):
-    """应用保留策略：保留最新的 N 个备份，删除旧的"""
-    cfg = load_config()
+def is_backup_name(name: str) -> bool:
+    """是否为备份文件 (排除上传中的临时文件)"""
+    return "vw_backup_" in name and not name.endswith(UPLOAD_TEMP_SUFFIX)
+
+def apply_retention_policy(client: WebDavClient, remote_dir: str, cfg: dict):
+    """应用保留策略：保留最新的 N 个备份，删除旧的 (基于备份索引，索引过期时先与 WebDAV 对账)
+
+    cfg 为目标的配置 (见 get_targets)，各目标可设置自己的 max_backups。
+    """
     max_backups = int(cfg.get("max_backups", 10))
     if max_backups < 1:
         max_backups = 10
+    target = catalog_target(cfg)
 
     try:
-        files = client.ls(remote_dir, detail=True)
-        backups = []
-        
-        for f in files:
-            if f['type'] == 'directory':
-                continue
-            
-            name = os.path.basename(f['name'])
-            if "vw_backup_" in name:
-                backups.append({
-                    "name": name, 
-                    "path": f['name'],
-                    "sort_key": name 
-                })
-        
-        backups.sort(key=lambda x: x['sort_key'], reverse=True)
+        backups = refresh_catalog(client=client, context="retention", target_cfg=cfg)
+        meta = catalog.meta(target)
+
+        # 上一次中断的上传留下的临时文件 (保留策略在上传完成后执行，此时不会有进行中的上传)
+        for path in meta["temp_files"]:
+            logging.info(f"清理未完成的上传: {path}")
+            try:
+                with webdav_timer("retention", "delete"):
+                    client.remove(path)
+            except Exception:
+                pass
+        if meta["temp_files"]:
+            catalog.clear_temp_files(target)
         
         if len(backups) > max_backups:
             to_delete = backups[max_backups:]
             for item in to_delete:
-                path_to_remove = item['path']
+                path_to_remove = item.get('path') or f"{remote_dir}/{item['name']}".replace("//", "/")
                 logging.info(f"保留策略删除: {path_to_remove}")
+                # 路径兼容重试也计入删除耗时，慢的情况不会从统计中漏掉
+                with webdav_timer("retention", "delete"):
+                    try:
+                        client.remove(path_to_remove)
+                    except Exception as ex:
+                        try:
+                            if not path_to_remove.startswith('/'):
+                                client.remove('/' + path_to_remove)
+                            else:
+                                client.remove(path_to_remove.lstrip('/'))
+                        except Exception as retry_ex:
+                            logging.warning(f"删除 {path_to_remove} 失败: {ex}; 路径兼容重试: {retry_ex}")
+                jobs.progress("retention", item.get("size") or 0)
+                catalog.remove(target, item['name'])
+                # 持续复制: 基础备份删除后，其增量段也不再可用
+                gen_dir = wal_generation_dir(remote_dir, item['name'])
                 try:
-                    client.remove(path_to_remove)
+                    if client.exists(gen_dir):
+                        logging.info(f"保留策略删除增量段: {gen_dir}")
+                        with webdav_timer("retention", "delete"):
+                            client.remove(gen_dir)
                 except Exception as ex:
-                    # 路径兼容重试
-                    try:
-                        if not path_to_remove.startswith('/'):
-                            client.remove('/' + path_to_remove)
-                        else:
-                            client.remove(path_to_remove.lstrip('/'))
-                    except:
-                        pass
+                    logging.warning(f"删除增量段失败: {ex}")
+
+        # 增量备份: 回收不再被保留快照引用的分块
+        if meta["chunk_store"]:
+            manifests = [
+                b.get('path') or f"{remote_dir}/{b['name']}".replace("//", "/")
+                for b in backups[:max_backups] if b['name'].endswith(INCREMENTAL_MANIFEST_SUFFIX)
+            ]
+            collect_chunk_garbage(client, remote_dir, manifests)
     except Exception as e:
         logging.error(f"保留策略出错: {e}")
 
-# --- 核心备份逻辑 (Zip 版) ---
+# --- 在线快照逻辑 ---
+
+def snapshot_sqlite(src_path: str, dest_path: str):
+    """使用 SQLite 在线备份 API 生成一致性快照 (数据库保持打开，无需停止服务)"""
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    src = sqlite3.connect(src_path, timeout=30)
+    try:
+        dest = sqlite3.connect(dest_path)
+        try:
+            # pages=-1: 在同一个读事务内一次性复制全部页面，保证快照一致
+            src.backup(dest, pages=-1)
+        finally:
+            dest.close()
+    finally:
+        src.close()
+
+def iter_backup_files(db_snapshot: Optional[str] = None, data_dir: str = DATA_DIR):
+    """遍历 /data (或 data_dir 指定的冻结视图)，返回 (源文件路径, 压缩包内路径)
+
+    指定 db_snapshot 时，用快照替换 db.sqlite3 并跳过其 -wal/-shm 附属文件。
+    """
+    for root, dirs, files in os.walk(data_dir):
+        if root == data_dir:
+            # 跳过备份/还原过程中的工作目录
+            dirs[:] = [d for d in dirs if d not in DATA_WORK_DIRS]
+        for file in files:
+            if not is_file_allowed(file):
+                continue
+            abs_path = os.path.join(root, file)
+            # 计算相对路径，确保解压时结构正确
+            rel_path = os.path.relpath(abs_path, data_dir)
+            if db_snapshot:
+                if rel_path == SQLITE_DB_NAME:
+                    yield db_snapshot, rel_path
+                    continue
+                if any(rel_path == SQLITE_DB_NAME + sfx for sfx in SQLITE_SIDECAR_SUFFIXES):
+                    continue
+            yield abs_path, rel_path
+
+def freeze_data_dir(dest: str):
+    """停机期间把 /data 冻结为 dest 中的一致视图 (数据库用备份 API 复制，附件与 Send 硬链接，其余文件复制)
+
+    硬链接不复制数据，停机时长只与文件数量有关；服务恢复后删除原文件也不影响冻结视图。
+    """
+    shutil.rmtree(dest, ignore_errors=True)
+    os.makedirs(dest)
+    stats = {"linked": 0, "copied": 0}
+    for abs_path, rel_path in iter_backup_files():
+        dest_path = os.path.join(dest, rel_path)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        if rel_path == SQLITE_DB_NAME:
+            snapshot_sqlite(abs_path, dest_path)
+        elif any(rel_path == SQLITE_DB_NAME + sfx for sfx in SQLITE_SIDECAR_SUFFIXES):
+            # 快照已包含 WAL 中的内容
+            continue
+        else:
+            if rel_path.split(os.sep)[0] in FREEZE_LINK_DIRS:
+                try:
+                    os.link(abs_path, dest_path)
+                    stats["linked"] += 1
+                    continue
+                except OSError:
+                    # 文件系统不支持硬链接时退回复制
+                    pass
+            shutil.copy2(abs_path, dest_path)
+            stats["copied"] += 1
+    logging.info(f"已冻结数据目录: 硬链接 {stats['linked']} 个文件，复制 {stats['copied']} 个文件")
+
+def write_backup_zip(target, password: Optional[str], db_snapshot: Optional[str] = None, data_dir: str = DATA_DIR):
+    """将 /data 打包为 (可选 AES-256 加密的) Zip 文件，target 可以是路径或可写的流
 
-def perform_backup():
-    """执行备份 (停止服务 -> Zip打包加密 -> 启动服务 -> 上传)"""
-    logging.info(">>> 开始执行备份任务 (Zip AES-256)")
+    各条目在线程池中并行压缩加密 (zlib 与 AES 均会释放 GIL)，再按遍历顺序写入。
+    """
     cfg = load_config()
-    
-    if not cfg.get("webdav_url"):
-        logging.warning("未配置 WebDAV，跳过备份。")
-        return
+    level = min(max(int(cfg.get("compression_level", 6)), 0), 9)
+    workers = max(int(cfg.get("compression_workers", 0)) or (os.cpu_count() or 1), 1)
+    pwd = password.encode('utf-8') if password else None
 
-    tmp_files = []
-    backup_name = ""
+    # encryption: WinZip AES 标准 (兼容性最好)；未设置密码时不加密
+    started = time.monotonic()
+    stats = {"files": 0, "stored": 0, "raw": 0, "packed": 0}
+    with ParallelAESZipFile(target, 'w', compression=pyzipper.ZIP_DEFLATED,
+                            encryption=pyzipper.WZ_AES if pwd else None) as zf:
+        if pwd:
+            logging.info("已启用 AES-256 加密")
+            zf.setpassword(pwd)
+
+        def write(fut):
+            entry = fut.result()
+            zf.write_prepared(entry)
+            stats["files"] += 1
+            jobs.progress("pack", entry.zinfo.file_size)
+            stats["stored"] += entry.zinfo.compress_type == pyzipper.ZIP_STORED
+            stats["raw"] += entry.zinfo.file_size
+            stats["packed"] += entry.zinfo.compress_size
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            window = []
+            try:
+                for abs_path, rel_path in iter_backup_files(db_snapshot, data_dir):
+                    window.append(pool.submit(prepare_zip_entry, abs_path, rel_path, pwd, level))
+                    if len(window) >= workers * 2:
+                        write(window.pop(0))
+                while window:
+                    write(window.pop(0))
+            finally:
+                # 出错时释放尚未写入条目的临时缓冲
+                for fut in window:
+                    fut.cancel()
+                    if fut.done() and not fut.cancelled() and fut.exception() is None:
+                        fut.result().spool.close()
 
+    elapsed = max(time.monotonic() - started, 0.001)
+    BYTES_PACKED.inc(stats["raw"])
+    if stats["raw"]:
+        COMPRESSION_RATIO.set(stats["packed"] / stats["raw"])
+    logging.info(
+        f"打包完成: {stats['files']} 个文件 (不压缩 {stats['stored']} 个), "
+        f"{round(stats['raw'] / 1024 / 1024, 2)} MB -> {round(stats['packed'] / 1024 / 1024, 2)} MB, "
+        f"用时 {elapsed:.2f} 秒 ({round(stats['raw'] / 1024 / 1024 / elapsed, 2)} MB/s, {workers} 线程, 压缩级别 {level})"
+    )
+
+# --- 变更检测 ---
+
+def sqlite_state(db_path: str) -> list:
+    """数据库的提交状态: 主文件头的修改计数，以及 WAL 头 (检查点序号与盐值，WAL 每次重置都会变化)
+
+    空的或不存在的 WAL 视为相同 (服务启动时会创建空 WAL)。
+    """
+    state = []
     try:
-        timestamp = get_current_time_str()
-        # 使用 .zip 后缀
-        backup_name = f"vw_backup_{timestamp}.zip"
-        zip_path = os.path.join(TEMP_DIR, backup_name)
-        tmp_files.append(zip_path)
+        with open(db_path, "rb") as f:
+            state.append(f.read(100)[24:28].hex())
+    except OSError:
+        return state
+    wal_path = db_path + "-wal"
+    if os.path.exists(wal_path) and os.path.getsize(wal_path) > 0:
+        with open(wal_path, "rb") as f:
+            state.append(f.read(32).hex())
+    return state
+
+def compute_data_fingerprint(cfg: dict) -> str:
+    """/data 的指纹: 每个待备份文件的路径、大小、mtime 与 inode，加上数据库的提交状态
 
-        # 1. 停止服务（确保数据一致性）
+    -shm 只是 WAL 的共享内存索引，空 WAL 由服务启动时创建，二者都不计入；
+    备份格式与目标变化时指纹也会变化。
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps([cfg.get("backup_format", "zip"), [catalog_target(t) for t in get_targets(cfg)]]).encode())
+    for abs_path, rel_path in sorted(iter_backup_files(), key=lambda item: item[1]):
+        if rel_path.endswith("-shm"):
+            continue
         try:
-            stop_service()
-        except Exception as e:
-            logging.error(f"停止服务失败，中止备份: {e}")
-            return
+            st = os.stat(abs_path)
+        except OSError:
+            continue
+        if rel_path.endswith("-wal") and st.st_size == 0:
+            continue
+        h.update(f"{rel_path}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_ino}\n".encode())
+    h.update(json.dumps(sqlite_state(os.path.join(DATA_DIR, SQLITE_DB_NAME))).encode())
+    return h.hexdigest()
 
-        # 2. 创建加密 Zip (同时打包)
+def load_last_backup() -> dict:
+    if os.path.exists(LAST_BACKUP_FILE):
         try:
-            logging.info(f"正在打包并加密到 {zip_path} ...")
-            password = cfg.get("encryption_password")
-            
-            # 配置 pyzipper
-            # compression: 标准压缩
-            # encryption: WinZip AES 标准 (兼容性最好)
-            with pyzipper.AESZipFile(zip_path, 'w', compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES) as zf:
-                if password:
-                    logging.info("已启用 AES-256 加密")
-                    zf.setpassword(password.encode('utf-8'))
-                    zf.setencryption(pyzipper.WZ_AES, nbits=256)
-                
-                # 遍历 /data 目录
-                for root, dirs, files in os.walk(DATA_DIR):
-                    for file in files:
-                        if is_file_allowed(file):
-                            abs_path = os.path.join(root, file)
-                            # 计算相对路径，确保解压时结构正确
-                            rel_path = os.path.relpath(abs_path, DATA_DIR)
-                            zf.write(abs_path, arcname=rel_path)
-                            
+            with open(LAST_BACKUP_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
         except Exception as e:
-            logging.error(f"打包失败: {e}")
-            start_service() # 尝试恢复服务
-            raise e
-        
-        # 3. 立即恢复服务
+            logging.error(f"读取上次备份记录失败: {e}")
+    return {}
+
+def save_last_backup(name: str, fingerprint: str):
+    tmp_path = LAST_BACKUP_FILE + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"name": name, "fingerprint": fingerprint,
+                   "at": datetime.datetime.now(TZ_CN).strftime("%Y-%m-%d %H:%M:%S")}, f)
+    os.replace(tmp_path, LAST_BACKUP_FILE)
+
+def is_backup_current(fingerprint: str, target_cfgs: List[dict]) -> bool:
+    """指纹与上次成功备份一致，且该备份仍存在于所有目标上 (索引过期时先对账)"""
+    last = load_last_backup()
+    if not last or last.get("fingerprint") != fingerprint:
+        return False
+    for t in target_cfgs:
         try:
-            start_service()
+            entries = refresh_catalog(target_cfg=t, context="retention")
         except Exception as e:
-            logging.error(f"服务启动失败! 请手动检查: {e}")
-            send_notifications("严重错误：备份后服务无法自动启动！", success=False)
-            raise e
+            logging.warning(f"无法确认目标 {t['name']} 上的备份: {e}")
+            return False
+        if not any(e["name"] == last["name"] for e in entries):
+            return False
+    return True
 
-        # 4. 上传
-        logging.info("正在上传到 WebDAV...")
-        client = WebDavClient(
-            cfg["webdav_url"], 
-            auth=(cfg.get("webdav_user", ""), cfg.get("webdav_password", ""))
-        )
-        
-        remote_dir = cfg.get('webdav_path', '/')
-        try:
-            if remote_dir != "/" and not client.exists(remote_dir):
-                client.mkdir(remote_dir)
-        except:
-            pass
+# --- 并行压缩 ---
 
-        remote_path = f"{remote_dir}/{backup_name}".replace("//", "/")
-        client.upload_file(zip_path, remote_path)
-        logging.info("上传成功")
-        
-        # 5. 保留策略
-        logging.info("正在检查保留策略...")
-        apply_retention_policy(client, remote_dir)
+def is_incompressible(abs_path: str) -> bool:
+    """判断文件是否不值得压缩 (已压缩的格式，或抽样试压缩后几乎没有收益)"""
+    if os.path.splitext(abs_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return True
+    try:
+        with open(abs_path, "rb") as f:
+            sample = f.read(COMPRESSION_SAMPLE_SIZE)
+    except OSError:
+        return False
+    # 太小的文件压缩收益可以忽略，按原逻辑处理
+    if len(sample) < 4096:
+        return False
+    return len(zlib.compress(sample, 1)) > len(sample) * 0.95
 
-        logging.info(f"备份流程全部完成: {backup_name}")
+class PreparedZipEntry:
+    """在工作线程中已压缩 (并加密) 完成、等待按顺序写入 Zip 的条目"""
 
-    except Exception as e:
-        logging.error(f"备份流程异常: {e}", exc_info=True)
-        send_notifications(f"备份失败: {str(e)}", success=False)
-    finally:
-        # 清理临时文件
-        for f in tmp_files:
-            if os.path.exists(f):
-                try:
-                    os.remove(f)
-                except:
-                    pass
+    def __init__(self, zinfo, encrypter, spool, crc: int, file_size: int, tag: bytes):
+        self.zinfo = zinfo
+        self.encrypter = encrypter
+        self.spool = spool
+        self.crc = crc
+        self.file_size = file_size
+        self.tag = tag
 
-# --- 还原逻辑 (Zip 版) ---
+    # 以下方法供 ParallelAESZipFile 作为 "加密器" 使用：数据已经加密，这里只回放结果
+    def update_zipinfo(self, zinfo):
+        self.encrypter.update_zipinfo(zinfo)
 
-def process_restore_file(local_file_path: str):
-    """执行还原 (验证Zip -> 停止服务 -> 清空数据 -> 解压Zip -> 启动服务)"""
-    logging.info(">>> 开始执行还原任务 (Zip)")
-    cfg = load_config()
-    
+    def finalize_zipinfo(self, zinfo):
+        self.encrypter.finalize_zipinfo(zinfo)
+
+    def encryption_header(self) -> bytes:
+        return self.encrypter.encryption_header()
+
+    def encrypt(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return self.tag
+
+def prepare_zip_entry(abs_path: str, rel_path: str, password: Optional[bytes], level: int) -> PreparedZipEntry:
+    """读取单个文件，完成 CRC、压缩与 WinZip AES 加密 (可在线程池中并行执行)"""
+    zinfo = pyzipper.AESZipFile.zipinfo_cls.from_file(abs_path, rel_path)
+    stored = level == 0 or is_incompressible(abs_path)
+    zinfo.compress_type = pyzipper.ZIP_STORED if stored else pyzipper.ZIP_DEFLATED
+    zinfo._compresslevel = level
+    compressor = None if stored else zlib.compressobj(level, zlib.DEFLATED, -15)
+    encrypter = pyzipper.zipfile_aes.AESZipEncrypter(password, nbits=256) if password else None
+
+    spool = tempfile.SpooledTemporaryFile(max_size=COMPRESSION_SPOOL_SIZE, dir=TEMP_DIR)
+    crc = 0
+    file_size = 0
     try:
-        # 1. 基础验证
-        if not pyzipper.is_zipfile(local_file_path):
-            raise ValueError("不是有效的 Zip 文件")
+        with open(abs_path, "rb") as raw:
+            f = governor.reader(raw)
+            while True:
+                data = f.read(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                file_size += len(data)
+                crc = zlib.crc32(data, crc)
+                if compressor:
+                    data = compressor.compress(data)
+                if encrypter:
+                    data = encrypter.encrypt(data)
+                spool.write(data)
+        tail = compressor.flush() if compressor else b""
+        if encrypter:
+            tail = encrypter.encrypt(tail)
+        spool.write(tail)
+    except BaseException:
+        spool.close()
+        raise
+    # 文件在读取期间可能变化 (在线模式)，以实际读到的大小为准
+    zinfo.file_size = file_size
+    return PreparedZipEntry(zinfo, encrypter, spool, crc, file_size, encrypter.flush() if encrypter else b"")
 
-        # 2. 停止服务
-        try:
-            stop_service()
-        except Exception as e:
-            logging.error(f"停止服务失败: {e}")
-            raise e
+class _PreparedZipWriteFile(pyzipper.zipfile._ZipWriteFile):
+    """写入已压缩加密的条目数据，只负责头部、CRC 与大小的记账"""
 
-        # 3. 清空 /data 目录 (确保无残留垃圾文件)
-        logging.info(f"正在清空数据目录 {DATA_DIR} ...")
-        for filename in os.listdir(DATA_DIR):
-            file_path = os.path.join(DATA_DIR, filename)
-            try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-            except Exception as e:
-                logging.error(f"删除 {file_path} 失败: {e}")
+    def __init__(self, zf, zinfo, zip64, encrypter=None):
+        super().__init__(zf, zinfo, zip64, encrypter)
+        self._compressor = None
 
-        # 4. 解压还原
-        logging.info("正在解压 Zip 包...")
-        password = cfg.get("encryption_password")
-        
-        try:
-            with pyzipper.AESZipFile(local_file_path, 'r') as zf:
-                if password:
-                    zf.setpassword(password.encode('utf-8'))
-                
-                # 提取到数据目录
-                zf.extractall(path=DATA_DIR)
-                logging.info("解压完成")
-        except RuntimeError as e:
-            # 通常是密码错误
-            if 'Bad password' in str(e):
-                raise ValueError("解密密码错误")
-            raise e
-        
-        # 5. 启动服务
-        try:
-            start_service()
-            logging.info("还原完成，服务已重启")
-        except Exception as e:
-            logging.error(f"服务启动失败: {e}")
-            raise e
+    def write(self, data):
+        self._compress_size += len(data)
+        self._fileobj.write(data)
+        return len(data)
 
-    except Exception as e:
-        logging.error(f"还原失败: {e}", exc_info=True)
-        send_notifications(f"还原失败: {str(e)}", success=False)
-        # 尝试保底启动
+    def close(self):
+        if self.closed:
+            return
+        prepared = self._zipfile._prepared
+        self._crc = prepared.crc
+        self._file_size = prepared.file_size
+        super().close()
+
+class ParallelAESZipFile(pyzipper.AESZipFile):
+    """按顺序写入 PreparedZipEntry 的 AESZipFile (压缩加密在调用方的线程池中完成)"""
+
+    zipwritefile_cls = _PreparedZipWriteFile
+
+    def write_prepared(self, entry: PreparedZipEntry):
+        self._prepared = entry
         try:
-            start_service() 
-        except:
-            pass
-    finally:
-        if os.path.exists(local_file_path):
+            entry.spool.seek(0)
+            with self.open(entry.zinfo, 'w') as dest:
+                shutil.copyfileobj(entry.spool, dest, STREAM_CHUNK_SIZE)
+        finally:
+            self._prepared = None
+            entry.spool.close()
+
+    def get_encrypter(self):
+        return self._prepared
+
+# --- 流式归档格式 (zstd + AES-GCM) ---
+
+def read_exact(fileobj, size: int) -> bytes:
+    """读取恰好 size 字节 (HTTP 流的一次 read 可能返回更少)，到达末尾时返回已读到的部分"""
+    buf = bytearray()
+    while len(buf) < size:
+        data = fileobj.read(size - len(buf))
+        if not data:
+            break
+        buf += data
+    return bytes(buf)
+
+def derive_archive_key(password: str, salt: bytes, log_n: int, r: int, p: int) -> tuple:
+    """由密码派生 AES-256 密钥与密钥校验值 (每个归档只派生一次)"""
+    key = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=1 << log_n, r=r, p=p,
+                         maxmem=256 * r * (1 << log_n), dklen=32)
+    return key, hmac.new(key, b"vw-archive-check", hashlib.sha256).digest()[:8]
+
+def load_zstd_dictionary(cfg: dict) -> Optional[zstandard.ZstdCompressionDict]:
+    path = cfg.get("zstd_dictionary")
+    if not path:
+        return None
+    with open(path, "rb") as f:
+        return zstandard.ZstdCompressionDict(f.read())
+
+class ArchiveWriter:
+    """.vwb 归档的分块加密层 (可写的类文件对象，写入 zstd 压缩后的数据)
+
+    数据按 ARCHIVE_CHUNK_SIZE 分块，每块一条记录: 4 字节长度 (最高位标记最后一块) + 数据。
+    设置了密码时每块使用 AES-256-GCM 加密，nonce 为随机前缀 + 块序号，附加数据为头部与结束标记，
+    块被截断、重排或替换都会在解密时发现。
+    """
+
+    def __init__(self, fileobj, password: Optional[str], raw_size: int = 0, dict_id: int = 0):
+        self._out = fileobj
+        self._buf = bytearray()
+        self._counter = 0
+        self._aead = None
+        self.bytes_written = 0
+        salt = os.urandom(16)
+        prefix = os.urandom(8)
+        check = bytes(8)
+        flags = 0
+        if password:
+            key, check = derive_archive_key(password, salt, ARCHIVE_SCRYPT_LOG_N, 8, 1)
+            self._aead = AESGCM(key)
+            flags |= 1
+        if dict_id:
+            flags |= 2
+        self._prefix = prefix
+        self.header = ARCHIVE_HEADER.pack(
+            ARCHIVE_MAGIC, ARCHIVE_VERSION, flags, salt, ARCHIVE_SCRYPT_LOG_N, 8, 1,
+            prefix, check, ARCHIVE_CHUNK_SIZE, dict_id, raw_size,
+        )
+        self._emit(self.header)
+
+    def _emit(self, data: bytes):
+        self._out.write(data)
+        self.bytes_written += len(data)
+
+    def _seal(self, data: bytes, final: bool):
+        if self._aead:
+            nonce = self._prefix + self._counter.to_bytes(4, "big")
+            data = self._aead.encrypt(nonce, data, self.header + bytes([final]))
+        self._counter += 1
+        self._emit(struct.pack(">I", len(data) | (ARCHIVE_FINAL_FLAG if final else 0)) + data)
+
+    def write(self, data) -> int:
+        self._buf += data
+        # 保留至少一个字节，保证最后一块总是在 close() 时带结束标记写出
+        while len(self._buf) > ARCHIVE_CHUNK_SIZE:
+            self._seal(bytes(self._buf[:ARCHIVE_CHUNK_SIZE]), False)
+            del self._buf[:ARCHIVE_CHUNK_SIZE]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._seal(bytes(self._buf), True)
+        self._buf = bytearray()
+
+class ArchiveReader:
+    """ArchiveWriter 的逆过程: 解析头部并校验密码，read() 逐块校验解密后返回 zstd 数据
+
+    只需要顺序读取，source 可以是本地文件或 HTTP 响应流。
+    """
+
+    def __init__(self, source, password: Optional[str]):
+        self._src = source
+        self._buf = b""
+        self._counter = 0
+        self._aead = None
+        self.finished = False
+        self.header = read_exact(source, ARCHIVE_HEADER.size)
+        if len(self.header) < ARCHIVE_HEADER.size or self.header[:len(ARCHIVE_MAGIC)] != ARCHIVE_MAGIC:
+            raise ValueError("不是有效的 .vwb 归档")
+        (_, version, flags, salt, log_n, r, p, self._prefix, check,
+         self.chunk_size, self.dict_id, self.raw_size) = ARCHIVE_HEADER.unpack(self.header)
+        if version > ARCHIVE_VERSION:
+            raise ValueError(f"归档版本 {version} 过新，请升级后再还原")
+        if flags & 1:
+            if not password:
+                raise ValueError("归档已加密，但未设置加密密码")
+            key, expected = derive_archive_key(password, salt, log_n, r, p)
+            if not hmac.compare_digest(check, expected):
+                raise ValueError("解密密码错误")
+            self._aead = AESGCM(key)
+
+    def _next_chunk(self) -> bytes:
+        head = read_exact(self._src, 4)
+        if len(head) < 4:
+            raise ValueError("归档不完整 (缺少结束块)")
+        length = struct.unpack(">I", head)[0]
+        final = bool(length & ARCHIVE_FINAL_FLAG)
+        length &= ~ARCHIVE_FINAL_FLAG
+        if length > self.chunk_size + 16:
+            raise ValueError(f"归档已损坏 (第 {self._counter + 1} 块长度异常)")
+        data = read_exact(self._src, length)
+        if len(data) < length:
+            raise ValueError("归档不完整 (数据被截断)")
+        if self._aead:
+            nonce = self._prefix + self._counter.to_bytes(4, "big")
+            try:
+                data = self._aead.decrypt(nonce, data, self.header + bytes([final]))
+            except InvalidTag:
+                raise ValueError(f"归档已损坏 (第 {self._counter + 1} 块校验失败)")
+        self._counter += 1
+        self.finished = final
+        return data
+
+    def read(self, n: int = -1) -> bytes:
+        while not self.finished and (n < 0 or len(self._buf) < n):
+            self._buf += self._next_chunk()
+        if n < 0:
+            n = len(self._buf)
+        data, self._buf = self._buf[:n], self._buf[n:]
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+def write_backup_vwb(target, password: Optional[str], db_snapshot: Optional[str] = None, data_dir: str = DATA_DIR):
+    """将 /data 打包为 .vwb 归档 (tar -> zstd -> 分块加密)，target 可以是路径或可写的流
+
+    zstd 自身多线程压缩 (compression_workers)，整个归档只派生一次密钥。
+    每个文件先读入暂存 (超过 COMPRESSION_SPOOL_SIZE 时落盘到工作目录)，读取期间变化的文件按实际读到的内容打包。
+    """
+    cfg = load_config()
+    level = min(max(int(cfg.get("zstd_level", 3)), 1), 19)
+    workers = max(int(cfg.get("compression_workers", 0)) or (os.cpu_count() or 1), 1)
+    dict_data = load_zstd_dictionary(cfg)
+    files = list(iter_backup_files(db_snapshot, data_dir))
+    raw_size = estimate_backup_size(db_snapshot, data_dir)
+
+    started = time.monotonic()
+    stats = {"files": 0, "raw": 0}
+    out = open(target, "wb") if isinstance(target, str) else target
+    try:
+        writer = ArchiveWriter(out, password, raw_size, dict_data.dict_id() if dict_data else 0)
+        if password:
+            logging.info("已启用 AES-256-GCM 加密")
+        cctx = zstandard.ZstdCompressor(level=level, threads=workers if workers > 1 else 0,
+                                        dict_data=dict_data, write_checksum=True)
+        with cctx.stream_writer(writer, closefd=False) as zw:
+            with tarfile.open(fileobj=zw, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                for abs_path, rel_path in files:
+                    # tar 头部先写大小；文件在读取期间可能变化 (在线模式)，先读入暂存再以实际读到的大小为准
+                    with open(abs_path, "rb") as f, \
+                            tempfile.SpooledTemporaryFile(max_size=COMPRESSION_SPOOL_SIZE, dir=TEMP_DIR) as spool:
+                        info = tar.gettarinfo(arcname=rel_path, fileobj=f)
+                        info.uname = info.gname = ""
+                        shutil.copyfileobj(governor.reader(f), spool, STREAM_CHUNK_SIZE)
+                        info.size = spool.tell()
+                        spool.seek(0)
+                        tar.addfile(info, spool)
+                    stats["files"] += 1
+                    stats["raw"] += info.size
+                    jobs.progress("pack", info.size)
+        writer.close()
+    finally:
+        if isinstance(target, str):
+            out.close()
+
+    elapsed = max(time.monotonic() - started, 0.001)
+    BYTES_PACKED.inc(stats["raw"])
+    if stats["raw"]:
+        COMPRESSION_RATIO.set(writer.bytes_written / stats["raw"])
+    logging.info(
+        f"打包完成: {stats['files']} 个文件, "
+        f"{round(stats['raw'] / 1024 / 1024, 2)} MB -> {round(writer.bytes_written / 1024 / 1024, 2)} MB, "
+        f"用时 {elapsed:.2f} 秒 ({round(stats['raw'] / 1024 / 1024 / elapsed, 2)} MB/s, {workers} 线程, zstd 级别 {level})"
+    )
+
+def extract_vwb_archive(reader: ArchiveReader, dest_dir: str, phase: str = "extract", only=None) -> dict:
+    """顺序解压 .vwb 归档到 dest_dir，返回文件数与字节数
+
+    only(相对路径) 返回 False 的文件只读取校验、不写入 (用于校验)。只还原普通文件与目录，
+    路径不能越出 dest_dir。读完 tar 后继续读到归档末尾，确保 zstd 校验和与结束块都经过验证。
+    """
+    dict_data = None
+    if reader.dict_id:
+        dict_data = load_zstd_dictionary(load_config())
+        if dict_data is None or dict_data.dict_id() != reader.dict_id:
+            raise ValueError(f"归档使用了 zstd 字典 (ID {reader.dict_id})，请在配置中指定相同的字典文件")
+    jobs.set_total(phase, reader.raw_size or None)
+    root = os.path.realpath(dest_dir)
+    entries = 0
+    total = 0
+    try:
+        dctx = zstandard.ZstdDecompressor(dict_data=dict_data)
+        with dctx.stream_reader(reader, read_size=ARCHIVE_CHUNK_SIZE, closefd=False) as zr:
+            with tarfile.open(fileobj=zr, mode="r|") as tar:
+                for member in tar:
+                    target = os.path.realpath(os.path.join(root, member.name))
+                    if not target.startswith(root + os.sep):
+                        raise ValueError(f"归档中的路径不合法: {member.name}")
+                    if member.isdir():
+                        if only is None:
+                            os.makedirs(target, exist_ok=True)
+                        continue
+                    if not member.isfile():
+                        continue
+                    src = tar.extractfile(member)
+                    keep = only is None or only(member.name)
+                    if keep:
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                    with (open(target, "wb") if keep else contextlib.nullcontext()) as out:
+                        while True:
+                            data = src.read(STREAM_CHUNK_SIZE)
+                            if not data:
+                                break
+                            if out:
+                                out.write(data)
+                            jobs.progress(phase, len(data))
+                    if keep:
+                        os.chmod(target, member.mode & 0o777)
+                        os.utime(target, (member.mtime, member.mtime))
+                    entries += 1
+                    total += member.size
+            while zr.read(ARCHIVE_CHUNK_SIZE):
+                pass
+    except (zstandard.ZstdError, tarfile.TarError) as e:
+        raise ValueError(f"归档已损坏: {e}")
+    if not reader.finished:
+        raise ValueError("归档不完整 (缺少结束块)")
+    return {"entries": entries, "bytes": total}
+
+# --- 可靠上传 ---
+
+class RateLimiter:
+    """令牌桶限速 (bytes_per_sec 为 0 时不限速)，同时统计经过的字节数；线程安全"""
+
+    def __init__(self, bytes_per_sec: float = 0, progress=None):
+        self.rate = max(float(bytes_per_sec), 0.0)
+        self.progress = progress
+        self.total = 0
+        self.started = None
+        self._allowance = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n: int):
+        with self._lock:
+            if self.started is None:
+                self.started = time.monotonic()
+            self.total += n
+            wait = 0
+            # 服务已停止 (停机打包、还原交换) 时不限速，以免延长停机时间
+            if self.rate and governor.service_running:
+                now = time.monotonic()
+                self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate) - n
+                self._last = now
+                wait = -self._allowance / self.rate if self._allowance < 0 else 0
+        if self.progress:
+            self.progress(n)
+        if wait > 0:
+            time.sleep(wait)
+        governor.throttle()
+
+class ThrottledReader:
+    """包装可读对象，读取时计入限速器"""
+
+    def __init__(self, fileobj, limiter: RateLimiter):
+        self._f = fileobj
+        self._limiter = limiter
+
+    def read(self, n: int = -1) -> bytes:
+        data = self._f.read(n)
+        self._limiter.consume(len(data))
+        return data
+
+class ResilientUploader:
+    """可靠上传：写入临时文件名后 MOVE 到位，失败自动重试并可限速
+
+    服务器支持 SabreDAV 部分更新 (Nextcloud/ownCloud 等) 时按段追加上传，
+    中断后从服务器已确认的偏移处续传；否则整体 PUT 并在失败时重新上传。
+    """
+
+    def __init__(self, client: WebDavClient, cfg: dict):
+        self.client = client
+        self.retries = max(int(cfg.get("upload_retries", 3)), 0)
+        self.segment_size = max(int(cfg.get("upload_segment_mb", 8)), 1) * 1024 * 1024
+        self.limiter = RateLimiter(
+            float(cfg.get("upload_bandwidth_limit", 0)) * 1024,
+            progress=lambda n: jobs.progress("upload", n),
+        )
+        self.retry_count = 0
+        self._partial_update = None
+
+    @property
+    def bytes_sent(self) -> int:
+        return self.limiter.total
+
+    def supports_partial_update(self, path: str) -> bool:
+        if self._partial_update is None:
+            try:
+                resp = self.client.http.options(self.client.join_url(path))
+                self._partial_update = "sabredav-partialupdate" in resp.headers.get("dav", "").lower()
+            except Exception:
+                self._partial_update = False
+        return self._partial_update
+
+    def _backoff(self, desc: str, attempt: int, error: Exception):
+        self.retry_count += 1
+        delay = min(2 ** attempt, 30)
+        logging.warning(f"{desc}失败 ({error})，{delay} 秒后第 {attempt + 1} 次重试")
+        time.sleep(delay)
+
+    def _retry(self, desc: str, func):
+        for attempt in range(self.retries + 1):
+            try:
+                return func()
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+                self._backoff(desc, attempt, e)
+
+    def _put(self, fileobj, path: str, size: Optional[int] = None):
+        self.client.upload_fileobj(
+            ThrottledReader(fileobj, self.limiter), path,
+            overwrite=True, size=size, chunk_size=STREAM_CHUNK_SIZE,
+        )
+
+    def _iter_throttled(self, data: bytes):
+        for i in range(0, len(data), STREAM_CHUNK_SIZE):
+            piece = data[i:i + STREAM_CHUNK_SIZE]
+            self.limiter.consume(len(piece))
+            yield piece
+
+    def _append(self, path: str, data: bytes, offset: int):
+        resp = self.client.http.request(
+            "PATCH", self.client.join_url(path),
+            content=self._iter_throttled(data),
+            headers={
+                "Content-Type": "application/x-sabredav-partialupdate",
+                "Content-Length": str(len(data)),
+                "X-Update-Range": f"bytes={offset}-{offset + len(data) - 1}",
+            },
+        )
+        resp.raise_for_status()
+
+    def _remote_size(self, path: str) -> int:
+        try:
+            return int(self.client.content_length(path) or 0)
+        except ResourceNotFound:
+            return 0
+
+    def _upload_segments(self, read_at, rewind, tmp_path: str):
+        """按段追加上传
+
+        read_at(offset) 返回从 offset 开始的下一段数据 (空表示结束)；
+        服务器确认的偏移与本地不一致时调用 rewind(acked)，返回新的续传偏移。
+        """
+        self._retry("创建临时文件", lambda: self._put(io.BytesIO(b""), tmp_path, size=0))
+        offset = 0
+        attempt = 0
+        while True:
+            data = read_at(offset)
+            if not data:
+                break
+            try:
+                self._append(tmp_path, data, offset)
+                offset += len(data)
+                attempt = 0
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+                self._backoff(f"分段上传 (偏移 {offset})", attempt, e)
+                attempt += 1
+                # 以服务器已确认的大小为准继续
+                acked = self._retry("查询已上传大小", lambda: self._remote_size(tmp_path))
+                if acked == offset + len(data):
+                    offset = acked
+                    attempt = 0
+                elif acked != offset:
+                    offset = rewind(acked)
+
+    def upload_file(self, local_path: str, remote_path: str):
+        """上传本地文件 (支持分段续传)"""
+        tmp_path = remote_path + UPLOAD_TEMP_SUFFIX
+        size = os.path.getsize(local_path)
+        with open(local_path, "rb") as f:
+            if size > self.segment_size and self.supports_partial_update(tmp_path):
+                def read_at(offset: int) -> bytes:
+                    f.seek(offset)
+                    return f.read(self.segment_size)
+
+                def rewind(acked: int) -> int:
+                    if acked > size:
+                        raise IOError(f"服务器上的临时文件大小异常: {acked}")
+                    return acked
+
+                self._upload_segments(read_at, rewind, tmp_path)
+            else:
+                def put():
+                    f.seek(0)
+                    self._put(f, tmp_path, size=size)
+                self._retry("上传", put)
+        self._commit(tmp_path, remote_path)
+
+    def upload_stream(self, fileobj, remote_path: str):
+        """上传不可回退的流：支持部分更新时只缓存当前一段用于重试，否则单次 chunked PUT"""
+        tmp_path = remote_path + UPLOAD_TEMP_SUFFIX
+        if self.supports_partial_update(tmp_path):
+            current = {"offset": 0, "data": None}
+
+            def read_at(offset: int) -> bytes:
+                if current["data"] is not None and offset == current["offset"]:
+                    return current["data"]  # 重试当前段
+                parts = []
+                remaining = self.segment_size
+                while remaining > 0:
+                    part = fileobj.read(remaining)
+                    if not part:
+                        break
+                    parts.append(part)
+                    remaining -= len(part)
+                current["offset"], current["data"] = offset, b"".join(parts)
+                return current["data"]
+
+            def rewind(acked: int) -> int:
+                raise IOError(f"服务器确认的偏移 {acked} 与已发送数据不一致，流式上传无法续传")
+
+            self._upload_segments(read_at, rewind, tmp_path)
+        else:
+            self._put(fileobj, tmp_path)
+        self._commit(tmp_path, remote_path)
+
+    def upload_bytes(self, data: bytes, remote_path: str, atomic: bool = False):
+        """上传小对象 (分块、清单等)，atomic 时同样经临时文件名 MOVE 到位"""
+        target = remote_path + UPLOAD_TEMP_SUFFIX if atomic else remote_path
+        self._retry("上传", lambda: self._put(io.BytesIO(data), target, size=len(data)))
+        if atomic:
+            self._commit(target, remote_path)
+
+    def _commit(self, tmp_path: str, remote_path: str):
+        self._retry("重命名", lambda: self.client.move(tmp_path, remote_path, overwrite=True))
+
+    def log_summary(self):
+        BYTES_UPLOADED.inc(self.bytes_sent)
+        elapsed = max(time.monotonic() - (self.limiter.started or time.monotonic()), 0.001)
+        mb = self.bytes_sent / 1024 / 1024
+        logging.info(
+            f"上传统计: {round(mb, 2)} MB, 用时 {elapsed:.2f} 秒, "
+            f"平均 {round(mb / elapsed, 2)} MB/s, 重试 {self.retry_count} 次"
+        )
+
+# --- 资源调度 ---
+
+class ResourceGovernor:
+    """备份/还原任务的资源调度，避免后台任务挤占正在服务的 Vaultwarden
+
+    - 任务线程按 job_nice / job_io_class 降低 CPU 与磁盘 IO 优先级 (Linux 上按线程生效，任务中新建的线程继承)，
+      停止服务期间恢复正常优先级，服务启动后再降低；
+    - 读取 /data 时按 backup_read_limit 限速 (KB/s)，上传/下载限速见 ResilientUploader 与 RangedDownloader；
+    - governor_latency_ms > 0 时每隔几秒探测 Vaultwarden 的 /alive，延迟超过阈值时把速度减半 (最低 10%)，
+      恢复后逐步提速；降速通过在数据块之间插入暂停实现 (占空比)，所有限速器与源文件读取都会经过 throttle()。
+    服务已停止 (停机打包、还原交换) 时不限速，以免延长停机时间。
+    """
+
+    def __init__(self):
+        self.scale = 1.0
+        self.service_running = True
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stop = None
+        self._read_limiter = RateLimiter()
+        self._stats = {}
+        self._priority = None  # (任务线程 tid, nice, IO 调度类别)
+
+    def begin(self, kind: str):
+        """任务开始时在任务线程中调用：启动 /alive 探测并降低本线程的优先级"""
+        cfg = load_config()
+        self.scale = 1.0
+        GOVERNOR_SCALE.set(1.0)
+        self._read_limiter = RateLimiter(float(cfg.get("backup_read_limit", 0)) * 1024)
+        self._stats = {"latencies": [], "backoffs": 0, "paused": 0.0}
+        threshold = int(cfg.get("governor_latency_ms", 0))
+        if threshold > 0:
+            # 先创建探测线程，避免它继承任务线程降低后的优先级
+            self._stop = threading.Event()
+            url = f"{cfg.get('vaultwarden_url', 'http://127.0.0.1:80').rstrip('/')}/alive"
+            threading.Thread(target=self._monitor, args=(url, threshold / 1000, self._stop),
+                             name=f"governor-{kind}", daemon=True).start()
+        nice = min(max(int(cfg.get("job_nice", 0)), 0), 19)
+        io_class = cfg.get("job_io_class", "none")
+        self._priority = None
+        if nice or io_class != "none":
+            self._priority = (threading.get_native_id(), nice, io_class)
+            logging.info(f"任务优先级: nice {nice}, IO 调度 {io_class}")
+            if self.service_running:
+                self._apply_priority(lowered=True)
+
+    def end(self):
+        """任务结束：停止探测并记录调度统计"""
+        self._priority = None
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+        self.scale = 1.0
+        GOVERNOR_SCALE.set(1.0)
+        # 任务之外的读取 (例如直接调用打包函数) 不沿用本次任务的限速
+        self._read_limiter = RateLimiter()
+        stats = self._stats
+        latencies = sorted(stats.get("latencies", []))
+        if latencies:
+            p50 = latencies[len(latencies) // 2] * 1000
+            p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000
+            logging.info(
+                f"资源调度统计: /alive 探测 {len(latencies)} 次, 延迟 p50 {p50:.0f} ms / p99 {p99:.0f} ms / "
+                f"最大 {latencies[-1] * 1000:.0f} ms, 降速 {stats['backoffs']} 次, 累计暂停 {stats['paused']:.1f} 秒"
+            )
+
+    def service_stopped(self):
+        """stop_service 调用：停机期间任务线程恢复正常优先级，尽快完成停机窗口内的工作"""
+        self.service_running = False
+        self._apply_priority(lowered=False)
+
+    def service_started(self):
+        """start_service 调用：服务恢复后任务线程重新降低优先级"""
+        self.service_running = True
+        self._apply_priority(lowered=True)
+
+    def _apply_priority(self, lowered: bool):
+        priority = self._priority
+        # 只调整任务线程自身 (优先级按线程生效)
+        if priority is None or priority[0] != threading.get_native_id():
+            return
+        tid, nice, io_class = priority
+        if nice:
+            try:
+                os.setpriority(os.PRIO_PROCESS, tid, nice if lowered else 0)
+            except (OSError, AttributeError) as e:
+                logging.warning(f"设置任务 CPU 优先级失败: {e}")
+        if io_class != "none":
+            if not lowered:
+                cmd = ["ionice", "-c", "0"]
+            elif io_class == "idle":
+                cmd = ["ionice", "-c", "3"]
+            else:
+                cmd = ["ionice", "-c", "2", "-n", "7"]
+            try:
+                subprocess.run(cmd + ["-p", str(tid)], check=True, capture_output=True)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logging.warning(f"设置任务 IO 优先级失败: {e}")
+
+    def _monitor(self, url: str, threshold: float, stop: threading.Event):
+        with httpx.Client(timeout=GOVERNOR_PROBE_TIMEOUT) as http:
+            while not stop.wait(GOVERNOR_PROBE_INTERVAL):
+                if not self.service_running:
+                    continue
+                started = time.monotonic()
+                try:
+                    http.get(url)
+                except httpx.TimeoutException:
+                    pass
+                except httpx.HTTPError:
+                    continue  # 服务启动中或不可达，不作为延迟样本
+                latency = time.monotonic() - started
+                ALIVE_LATENCY.observe(latency)
+                self._stats["latencies"].append(latency)
+                if latency > threshold:
+                    if self.scale > GOVERNOR_MIN_SCALE:
+                        self.scale = max(self.scale / 2, GOVERNOR_MIN_SCALE)
+                        self._stats["backoffs"] += 1
+                        logging.warning(
+                            f"Vaultwarden /alive 延迟 {latency * 1000:.0f} ms 超过阈值 {threshold * 1000:.0f} ms，"
+                            f"后台任务降速至 {self.scale:.0%}"
+                        )
+                elif latency < threshold * 0.8 and self.scale < 1:
+                    self.scale = min(self.scale + 0.1, 1.0)
+                    if self.scale >= 1:
+                        logging.info(f"Vaultwarden /alive 延迟已恢复 ({latency * 1000:.0f} ms)，后台任务恢复全速")
+                GOVERNOR_SCALE.set(self.scale)
+
+    def throttle(self):
+        """在数据块之间调用：降速时按 1/scale 拉长每段工作的耗时"""
+        scale = self.scale
+        if scale >= 1 or not self.service_running:
+            self._local.mark = None
+            return
+        now = time.monotonic()
+        mark = getattr(self._local, "mark", None)
+        if mark is not None:
+            pause = min((now - mark) * (1 / scale - 1), GOVERNOR_MAX_PAUSE)
+            time.sleep(pause)
+            GOVERNOR_PAUSE.inc(pause)
+            with self._lock:
+                self._stats["paused"] = self._stats.get("paused", 0.0) + pause
+        self._local.mark = time.monotonic()
+
+    def reader(self, f):
+        """包装 /data 中源文件的读取 (服务已停止时原样返回)"""
+        if not self.service_running:
+            return f
+        return ThrottledReader(f, self._read_limiter)
+
+governor = ResourceGovernor()
+
+# --- 分段下载 ---
+
+class RangeNotSupported(Exception):
+    """服务器忽略了 Range 请求头 (返回 200 而不是 206)"""
+
+class RangedDownloader:
+    """分段并发下载：按 HTTP Range 把远程文件切成若干段，由多个连接并发写入预分配的本地文件
+
+    下载中的数据写入 <文件名>.part，已完成的段记录在 <文件名>.progress；单段失败时从该段已写入的位置重试，
+    任务失败后再次还原同一备份会跳过已完成的段 (远程文件大小或 ETag 变化时重新下载)。
+    服务器不支持 Range、HEAD 请求失败或不返回 Content-Length 时回退为单连接下载；
+    失败重试 download_retries 次，可按 download_bandwidth_limit (KB/s) 限速。
+    完成后按上传时记录的大小与 SHA-256 校验。
+    """
+
+    def __init__(self, client: WebDavClient, cfg: dict):
+        self.client = client
+        self.retries = max(int(cfg.get("download_retries", 3)), 0)
+        self.workers = max(int(cfg.get("download_workers", 4)), 1)
+        self.segment_size = max(int(cfg.get("download_segment_mb", 8)), 1) * 1024 * 1024
+        self.limiter = RateLimiter(
+            float(cfg.get("download_bandwidth_limit", 0)) * 1024,
+            progress=lambda n: jobs.progress("download", n),
+        )
+        self.retry_count = 0
+        self._state_lock = threading.Lock()
+
+    def _backoff(self, desc: str, attempt: int, error: Exception):
+        self.retry_count += 1
+        delay = min(2 ** attempt, 30)
+        logging.warning(f"{desc}失败 ({error})，{delay} 秒后第 {attempt + 1} 次重试")
+        time.sleep(delay)
+
+    def _load_state(self, state_path: str, remote: dict) -> set:
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if {k: state.get(k) for k in remote} != remote:
+            return set()
+        return set(state.get("done", []))
+
+    def _save_state(self, state_path: str, remote: dict, done: set):
+        tmp_path = state_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({**remote, "done": sorted(done)}, f)
+        os.replace(tmp_path, state_path)
+
+    def _fetch_segment(self, url: str, part_path: str, start: int, end: int):
+        """下载 [start, end] 一段 (含两端)，失败时从已写入的位置继续"""
+        pos = start
+        attempt = 0
+        while True:
+            try:
+                headers = {"Range": f"bytes={pos}-{end}"}
+                with self.client.http.stream("GET", url, headers=headers) as resp:
+                    if resp.status_code == 200:
+                        raise RangeNotSupported()
+                    resp.raise_for_status()
+                    if not resp.headers.get("content-range", "").startswith(f"bytes {pos}-"):
+                        raise IOError(f"服务器返回的范围不符: {resp.headers.get('content-range')}")
+                    with open(part_path, "r+b") as f:
+                        f.seek(pos)
+                        for block in resp.iter_bytes(STREAM_CHUNK_SIZE):
+                            block = block[:end + 1 - pos]
+                            f.write(block)
+                            pos += len(block)
+                            self.limiter.consume(len(block))
+                            if pos > end:
+                                break
+                if pos <= end:
+                    raise IOError(f"连接提前结束 (偏移 {pos})")
+                return
+            except RangeNotSupported:
+                raise
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+                self._backoff(f"分段下载 (偏移 {pos})", attempt, e)
+                attempt += 1
+
+    def _download_single(self, remote_path: str, part_path: str):
+        """单连接下载 (不支持 Range 的服务器)，失败后从头重新下载"""
+        for attempt in range(self.retries + 1):
+            received = 0
+
+            def callback(n: int):
+                nonlocal received
+                received += n
+                self.limiter.consume(n)
+
+            try:
+                self.client.download_file(remote_path, part_path, callback=callback)
+                return
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+                jobs.progress("download", -received)
+                self._backoff("下载", attempt, e)
+
+    def download(self, remote_path: str, local_path: str, expected: Optional[dict] = None):
+        """下载到 local_path；expected 为备份索引中的记录，其中的 size/checksum 用于校验结果"""
+        part_path = local_path + UPLOAD_TEMP_SUFFIX
+        state_path = local_path + DOWNLOAD_STATE_SUFFIX
+        url = self.client.join_url(remote_path)
+        size, etag = 0, None
+        try:
+            resp = self.client.http.head(url)
+            resp.raise_for_status()
+            size = int(resp.headers.get("content-length") or 0)
+            etag = resp.headers.get("etag") or resp.headers.get("last-modified")
+            if not size:
+                logging.warning("服务器未返回文件大小 (Content-Length)，回退为单连接下载")
+        except (httpx.HTTPError, ValueError) as e:
+            # 部分服务器不支持 HEAD (405/501 等)，直接用 GET 单连接下载
+            reason = f"HTTP {e.response.status_code}" if isinstance(e, httpx.HTTPStatusError) else e
+            logging.warning(f"HEAD 请求失败 ({reason})，回退为单连接下载")
+        remote = {"path": remote_path, "size": size, "etag": etag}
+
+        with jobs.phase("download", total=size or None):
+            ranged = size > 0
+            if ranged:
+                done = self._load_state(state_path, remote)
+                if not done or not os.path.exists(part_path) or os.path.getsize(part_path) != size:
+                    done = set()
+                    with open(part_path, "wb") as f:
+                        if hasattr(os, "posix_fallocate"):
+                            os.posix_fallocate(f.fileno(), 0, size)
+                        else:
+                            f.truncate(size)
+                    self._save_state(state_path, remote, done)
+                segments = [(i, i * self.segment_size, min((i + 1) * self.segment_size, size) - 1)
+                            for i in range((size + self.segment_size - 1) // self.segment_size)]
+                pending = [seg for seg in segments if seg[0] not in done]
+                resumed = sum(end - start + 1 for i, start, end in segments if i in done)
+                if resumed:
+                    logging.info(f"续传下载: 已完成 {len(done)}/{len(segments)} 段 ({round(resumed / 1024 / 1024, 2)} MB)")
+                    jobs.progress("download", resumed)
+
+                def fetch(seg):
+                    i, start, end = seg
+                    self._fetch_segment(url, part_path, start, end)
+                    with self._state_lock:
+                        done.add(i)
+                        self._save_state(state_path, remote, done)
+
+                try:
+                    if pending:
+                        # 先下载第一段以确认服务器支持 Range，再并发下载其余段
+                        fetch(pending[0])
+                        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+                            list(pool.map(fetch, pending[1:]))
+                except RangeNotSupported:
+                    logging.warning("服务器不支持 Range 请求，回退为单连接下载")
+                    ranged = False
+            if not ranged:
+                self._download_single(remote_path, part_path)
+
+        self._verify(part_path, state_path, expected)
+        os.replace(part_path, local_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        elapsed = max(time.monotonic() - (self.limiter.started or time.monotonic()), 0.001)
+        mb = self.limiter.total / 1024 / 1024
+        logging.info(
+            f"下载统计: {round(mb, 2)} MB, 用时 {elapsed:.2f} 秒, 平均 {round(mb / elapsed, 2)} MB/s, "
+            f"{'分段并发 ' + str(self.workers) + ' 连接' if ranged else '单连接'}, 重试 {self.retry_count} 次"
+        )
+
+    def _verify(self, part_path: str, state_path: str, expected: Optional[dict]):
+        """与上传时记录的大小、SHA-256 比较；不一致时删除下载结果 (下次重新下载)"""
+        expected = expected or {}
+        size = os.path.getsize(part_path)
+        error = None
+        if expected.get("size") and size != expected["size"]:
+            error = f"大小不符 (索引 {expected['size']}，下载 {size})"
+        elif expected.get("checksum"):
+            with jobs.phase("checksum"):
+                if file_sha256(part_path) != expected["checksum"]:
+                    error = "SHA-256 校验和与上传时记录的不一致"
+        if error:
+            for path in (part_path, state_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise IOError(f"下载的备份文件校验失败: {error}")
+        if expected.get("checksum"):
+            logging.info("下载的备份文件已通过 SHA-256 校验")
+
+# --- 流式传输 ---
+
+class StreamPipe:
+    """打包线程与 HTTP PUT 之间的有界管道 (写端交给 pyzipper，读端交给上传)"""
+
+    def __init__(self, max_chunks: int = STREAM_QUEUE_DEPTH):
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._buffer = bytearray()
+        self._pending = b""
+        self._eof = False
+        self._aborted = threading.Event()
+        self.error = None
+        self.bytes_written = 0
+        self.sha256 = hashlib.sha256()
+
+    # 写端
+    def write(self, data) -> int:
+        self._buffer += data
+        self.bytes_written += len(data)
+        self.sha256.update(data)
+        if len(self._buffer) >= STREAM_CHUNK_SIZE:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _put(self, item):
+        while not self._aborted.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise IOError("上传已中止，停止打包")
+
+    def finish(self, error: Optional[BaseException] = None):
+        """写端结束 (可携带打包异常，读端读到结尾时抛出)"""
+        self.error = error
+        try:
+            if self._buffer and error is None:
+                self._put(bytes(self._buffer))
+                self._buffer.clear()
+            self._put(None)
+        except IOError:
+            pass
+
+    # 读端
+    def read(self, n: int = -1) -> bytes:
+        while not self._pending and not self._eof:
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+                if self.error:
+                    raise IOError(f"打包失败: {self.error}")
+            else:
+                self._pending = item
+        if n is None or n < 0:
+            n = len(self._pending)
+        out, self._pending = self._pending[:n], self._pending[n:]
+        return out
+
+    def abort(self):
+        self._aborted.set()
+
+def upload_zip_stream(uploader: "ResilientUploader", remote_path: str, password: Optional[str], db_snapshot: Optional[str] = None,
+                      writer=None, data_dir: str = DATA_DIR):
+    """边打包加密边以 chunked PUT 上传，不落地临时 Zip 文件；返回上传的大小与 SHA-256
+
+    writer 为打包函数 (默认 write_backup_zip，.vwb 格式为 write_backup_vwb)。
+    """
+    pipe = StreamPipe()
+    writer = writer or write_backup_zip
+
+    def pack():
+        try:
+            writer(pipe, password, db_snapshot=db_snapshot, data_dir=data_dir)
+        except BaseException as e:
+            pipe.finish(e)
+            return
+        pipe.finish()
+
+    packer = threading.Thread(target=pack, name="zip-stream-packer", daemon=True)
+    packer.start()
+    try:
+        uploader.upload_stream(pipe, remote_path)
+    finally:
+        pipe.abort()
+        packer.join()
+    logging.info(f"流式上传完成: {round(pipe.bytes_written / 1024 / 1024, 2)} MB")
+    return {"size": pipe.bytes_written, "checksum": pipe.sha256.hexdigest()}
+
+class RemoteZipReader:
+    """基于 HTTP Range 的远程只读文件，顺序读取时复用同一个连接
+
+    zipfile 每读一个条目都会 seek 到其偏移，而条目是顺序排列的；
+    这里把 "seek 到当前位置" 和小范围前跳转换成读取，避免每个条目都重新发起请求。
+    """
+
+    SKIP_LIMIT = 256 * 1024
+
+    def __init__(self, raw):
+        self._raw = raw
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 0:
+            gap = offset - self._raw.tell()
+            if gap == 0:
+                return offset
+            if 0 < gap <= self.SKIP_LIMIT:
+                self._raw.read(gap)
+                return self._raw.tell()
+        return self._raw.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._raw.tell()
+
+    def read(self, n: int = -1) -> bytes:
+        return self._raw.read(n)
+
+    def seekable(self) -> bool:
+        return True
+
+    def close(self):
+        pass
+
+# --- 增量备份 (内容定义分块 + 去重) ---
+
+# FastCDC 使用的 gear 表 (29 位，保证整数运算停留在单个 digit 内)
+_CDC_GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "little") >> 3 for i in range(256)]
+_CDC_HASH_MASK = (1 << 29) - 1
+# 归一化分块：达到平均大小前使用更严格的掩码，之后放宽
+_CDC_MASK_S = ((1 << (CDC_AVG_BITS + 2)) - 1) << (29 - CDC_AVG_BITS - 2)
+_CDC_MASK_L = ((1 << (CDC_AVG_BITS - 2)) - 1) << (29 - CDC_AVG_BITS + 2)
+
+# 29 位哈希每次左移一位，位置 i 的哈希只取决于最近 29 个字节，因此可以按块整体计算
+_CDC_WINDOW = 29
+_CDC_SCAN_BLOCK = 32 * 1024
+# 把 gear 值拆成 4 个字节的查找表，用 bytes.translate 一次性完成查表
+_CDC_GEAR_BYTES = [bytes((g >> (8 * k)) & 0xFF for g in _CDC_GEAR) for k in range(4)]
+_cdc_patterns: Dict[tuple, int] = {}
+
+def _cdc_pattern(value: int, count: int) -> int:
+    """count 个 64 位槽位都填入 value 的大整数"""
+    key = (value, count)
+    pattern = _cdc_patterns.get(key)
+    if pattern is None:
+        pattern = _cdc_patterns[key] = int.from_bytes(value.to_bytes(8, "little") * count, "little")
+    return pattern
+
+def _cdc_scan(data: bytes, skip: int, mask: int) -> int:
+    """返回 data 中第 skip 个字节起第一个满足 hash & mask == 0 的位置，没有则返回 -1
+
+    哈希从 data[0] 开始累积。每个字节占大整数中的一个 64 位槽位，
+    h_i = Σ gear[b_(i-k)] << k (k < 29) 通过倍增的移位相加得到，最大不超过 58 位，槽位之间不会进位。
+    """
+    n = len(data)
+    slots = bytearray(8 * n)
+    for k, table in enumerate(_CDC_GEAR_BYTES):
+        slots[k::8] = data.translate(table)
+    a1 = int.from_bytes(slots, "little")
+    a2 = a1 + (a1 << 65)
+    a4 = a2 + (a2 << 130)
+    a8 = a4 + (a4 << 260)
+    a16 = a8 + (a8 << 520)
+    h = a16 + (a8 << 1040) + (a4 << 1560) + (a1 << 1820)
+    # 掩码后槽位非零时加上 2^29-1 会进位到第 29 位，据此得到每个位置的 0/1 标记
+    masked = h & _cdc_pattern(mask, n)
+    flags = ((masked + _cdc_pattern(_CDC_HASH_MASK, n)) >> 29) & _cdc_pattern(1, n)
+    return flags.to_bytes(8 * n, "little")[0::8].find(b"\0", skip)
+
+def _cdc_cut_point(buf: bytes) -> int:
+    """返回 buf 中第一个内容定义的分块边界 (FastCDC)
+
+    逐块批量计算 gear 哈希，结果与逐字节滚动 h = (h << 1) + gear[b] 完全一致。
+    """
+    n = len(buf)
+    if n <= CDC_MIN_SIZE:
+        return n
+    n = min(n, CDC_MAX_SIZE)
+    normal = min(n, 1 << CDC_AVG_BITS)
+    view = memoryview(buf)
+    for start, end, mask in ((CDC_MIN_SIZE, normal, _CDC_MASK_S), (normal, n, _CDC_MASK_L)):
+        pos = start
+        while pos < end:
+            stop = min(pos + _CDC_SCAN_BLOCK, end)
+            # 带上前面最多 28 个字节作为哈希窗口的上下文 (哈希从 CDC_MIN_SIZE 开始累积)
+            lo = max(CDC_MIN_SIZE, pos - (_CDC_WINDOW - 1))
+            i = _cdc_scan(bytes(view[lo:stop]), pos - lo, mask)
+            if i != -1:
+                return lo + i + 1
+            pos = stop
+    return n
+
+def iter_cdc_chunks(path: str):
+    """按内容定义的边界切分文件，逐块返回"""
+    with open(path, "rb") as raw:
+        f = governor.reader(raw)
+        buf = b""
+        eof = False
+        while True:
+            while not eof and len(buf) < CDC_MAX_SIZE:
+                data = f.read(CDC_MAX_SIZE - len(buf))
+                if not data:
+                    eof = True
+                buf += data
+            if not buf:
+                return
+            cut = _cdc_cut_point(buf)
+            yield buf[:cut]
+            buf = buf[cut:]
+
+class ChunkCipher:
+    """分块仓库的密钥与加解密
+
+    设置了加密密码时：分块 ID 为明文的 HMAC-SHA256，内容使用 AES-256-GCM 加密；
+    未设置时：分块 ID 为 SHA-256，仅压缩不加密。
+    """
+
+    def __init__(self, password: Optional[str], salt: bytes):
+        self.encrypted = bool(password)
+        if password:
+            key = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=2 ** 14, r=8, p=1, dklen=64)
+            self._aead = AESGCM(key[:32])
+            self._id_key = key[32:]
+        else:
+            self._aead = None
+            self._id_key = None
+
+    def chunk_id(self, data: bytes) -> str:
+        if self._id_key:
+            return hmac.new(self._id_key, data, hashlib.sha256).hexdigest()
+        return hashlib.sha256(data).hexdigest()
+
+    def seal(self, data: bytes, aad: bytes) -> bytes:
+        flags = 0
+        payload = zlib.compress(data, 6)
+        if len(payload) < len(data):
+            flags |= 1
+        else:
+            payload = data
+        if self._aead:
+            nonce = os.urandom(12)
+            payload = nonce + self._aead.encrypt(nonce, payload, aad)
+            flags |= 2
+        return CHUNK_BLOB_MAGIC + bytes([flags]) + payload
+
+    def open(self, blob: bytes, aad: bytes) -> bytes:
+        if blob[:len(CHUNK_BLOB_MAGIC)] != CHUNK_BLOB_MAGIC:
+            raise ValueError("分块格式无法识别")
+        flags = blob[len(CHUNK_BLOB_MAGIC)]
+        payload = blob[len(CHUNK_BLOB_MAGIC) + 1:]
+        if flags & 2:
+            if not self._aead:
+                raise ValueError("分块已加密，但未设置加密密码")
+            try:
+                payload = self._aead.decrypt(payload[:12], payload[12:], aad)
+            except InvalidTag:
+                raise ValueError("解密密码错误或分块已损坏")
+        if flags & 1:
+            payload = zlib.decompress(payload)
+        return payload
+
+class ChunkStore:
+    """WebDAV 上的分块仓库: <webdav_path>/chunks/<分块ID>，仓库参数保存在 chunks/repo.json"""
+
+    def __init__(self, client: WebDavClient, remote_dir: str, password: Optional[str], create: bool = False,
+                 uploader: Optional["ResilientUploader"] = None):
+        self.client = client
+        self.uploader = uploader or ResilientUploader(client, {})
+        self.dir = f"{remote_dir}/{INCREMENTAL_STORE_DIR}".replace("//", "/")
+        repo_path = f"{self.dir}/repo.json"
+
+        if self.client.exists(repo_path):
+            buf = io.BytesIO()
+            self.client.download_fileobj(repo_path, buf)
+            repo = json.loads(buf.getvalue().decode("utf-8"))
+        elif create:
+            if not self.client.exists(self.dir):
+                self.client.mkdir(self.dir)
+            repo = {"version": 1, "salt": base64.b64encode(os.urandom(16)).decode(), "encrypted": bool(password)}
+            cipher = ChunkCipher(password, base64.b64decode(repo["salt"]))
+            repo["check"] = cipher.chunk_id(b"vw-chunk-store")
+            self.uploader.upload_bytes(json.dumps(repo).encode("utf-8"), repo_path, atomic=True)
+        else:
+            raise ValueError("远程分块仓库不存在")
+
+        self.cipher = ChunkCipher(password, base64.b64decode(repo["salt"]))
+        if repo.get("encrypted") != self.cipher.encrypted or repo.get("check") != self.cipher.chunk_id(b"vw-chunk-store"):
+            raise ValueError("加密密码与远程分块仓库不一致")
+
+    def path(self, chunk_id: str) -> str:
+        return f"{self.dir}/{chunk_id}"
+
+    def list_ids(self) -> set:
+        ids = set()
+        for f in self.client.ls(self.dir, detail=True):
+            name = os.path.basename(f['name'].rstrip('/'))
+            if f.get('type') != 'directory' and len(name) == 64:
+                ids.add(name)
+        return ids
+
+    def put(self, chunk_id: str, data: bytes):
+        blob = self.cipher.seal(data, chunk_id.encode())
+        self.uploader.upload_bytes(blob, self.path(chunk_id))
+        return len(blob)
+
+    def get(self, chunk_id: str) -> bytes:
+        buf = io.BytesIO()
+        self.client.download_fileobj(self.path(chunk_id), buf)
+        data = self.cipher.open(buf.getvalue(), chunk_id.encode())
+        if self.cipher.chunk_id(data) != chunk_id:
+            raise ValueError(f"分块校验失败: {chunk_id}")
+        return data
+
+    def put_manifest(self, remote_path: str, manifest: dict):
+        blob = self.cipher.seal(json.dumps(manifest, ensure_ascii=False).encode("utf-8"), b"manifest")
+        self.uploader.upload_bytes(blob, remote_path, atomic=True)
+        return {"size": len(blob), "checksum": hashlib.sha256(blob).hexdigest()}
+
+    def get_manifest(self, remote_path: str) -> dict:
+        buf = io.BytesIO()
+        self.client.download_fileobj(remote_path, buf)
+        return json.loads(self.cipher.open(buf.getvalue(), b"manifest").decode("utf-8"))
+
+def _load_incremental_cache() -> dict:
+    if os.path.exists(INCREMENTAL_CACHE_FILE):
+        try:
+            with open(INCREMENTAL_CACHE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            pass
+    return {}
+
+_incremental_cache_lock = threading.Lock()
+
+def _save_incremental_cache(store_id: str, files: dict):
+    """保存某个分块仓库的文件缓存 (多个目标各有自己的仓库，可能并发写入)"""
+    with _incremental_cache_lock:
+        cache = _load_incremental_cache()
+        stores = cache.get("stores", {})
+        stores[store_id] = files
+        tmp_path = INCREMENTAL_CACHE_FILE + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"stores": stores}, f)
+        os.replace(tmp_path, INCREMENTAL_CACHE_FILE)
+
+def upload_incremental_snapshot(uploader: "ResilientUploader", remote_dir: str, manifest_name: str, password: Optional[str],
+                                db_snapshot: Optional[str] = None, data_dir: str = DATA_DIR):
+    """分块去重上传 /data，最后写入快照清单 (清单写入前的中断不会留下不完整的快照)；返回清单的大小与 SHA-256"""
+    store = ChunkStore(uploader.client, remote_dir, password, create=True, uploader=uploader)
+    known = store.list_ids()
+    # 本地缓存: 大小/mtime/inode 未变化且分块仍在远端的文件无需重新读取
+    store_id = store.cipher.chunk_id(b"vw-chunk-store")
+    cached_files = _load_incremental_cache().get("stores", {}).get(store_id, {})
+    new_cache = {}
+
+    stats = {"files": 0, "chunks": 0, "uploaded": 0, "uploaded_bytes": 0, "reused_bytes": 0}
+    pending = []
+
+    def wait(limit: int):
+        while len(pending) > limit:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                pending.remove(fut)
+                stats["uploaded_bytes"] += fut.result()
+
+    manifest = {"version": 1, "created": get_current_time_str(), "files": []}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=CHUNK_TRANSFER_WORKERS) as pool:
+        for abs_path, rel_path in iter_backup_files(db_snapshot, data_dir):
+            st = os.stat(abs_path)
+            key = [st.st_size, st.st_mtime_ns, st.st_ino]
+            cached = cached_files.get(rel_path)
+            if cached and cached[:3] == key and all(c in known for c in cached[3]):
+                chunks = cached[3]
+                stats["reused_bytes"] += st.st_size
+            else:
+                chunks = []
+                for data in iter_cdc_chunks(abs_path):
+                    chunk_id = store.cipher.chunk_id(data)
+                    chunks.append(chunk_id)
+                    if chunk_id in known:
+                        stats["reused_bytes"] += len(data)
+                        continue
+                    known.add(chunk_id)
+                    stats["uploaded"] += 1
+                    pending.append(pool.submit(store.put, chunk_id, data))
+                    wait(CHUNK_TRANSFER_WORKERS * 2)
+            stats["files"] += 1
+            stats["chunks"] += len(chunks)
+            jobs.progress("pack", st.st_size)
+            BYTES_PACKED.inc(st.st_size)
+            new_cache[rel_path] = key + [chunks]
+            manifest["files"].append({
+                "path": rel_path,
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "mode": st.st_mode & 0o7777,
+                "chunks": chunks,
+            })
+        wait(0)
+
+    remote_path = f"{remote_dir}/{manifest_name}".replace("//", "/")
+    uploaded = store.put_manifest(remote_path, manifest)
+    _save_incremental_cache(store_id, new_cache)
+    logging.info(
+        f"增量上传完成: 文件 {stats['files']} 个, 分块 {stats['chunks']} 个, "
+        f"新上传 {stats['uploaded']} 个 ({round(stats['uploaded_bytes'] / 1024 / 1024, 2)} MB), "
+        f"复用 {round(stats['reused_bytes'] / 1024 / 1024, 2)} MB"
+    )
+    return uploaded
+
+def iter_fetched_chunks(store: ChunkStore, chunk_ids: List[str]):
+    """按顺序返回分块内容，后台并发预取 (同时在途的分块数量有上限)"""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=CHUNK_TRANSFER_WORKERS) as pool:
+        window = []
+        ids = iter(chunk_ids)
+        for chunk_id in ids:
+            window.append(pool.submit(store.get, chunk_id))
+            if len(window) >= CHUNK_TRANSFER_WORKERS * 2:
+                break
+        for chunk_id in ids:
+            yield window.pop(0).result()
+            window.append(pool.submit(store.get, chunk_id))
+        for fut in window:
+            yield fut.result()
+
+def extract_incremental_snapshot(store: ChunkStore, manifest: dict, dest_dir: str, only=None):
+    """根据快照清单从分块仓库重建文件 (only(相对路径) 返回 False 的文件不取回)"""
+    files = [f for f in manifest.get("files", []) if only is None or only(f["path"])]
+    all_chunks = [c for f in files for c in f["chunks"]]
+    fetched = iter_fetched_chunks(store, all_chunks)
+    for entry in files:
+        target = os.path.realpath(os.path.join(dest_dir, entry["path"]))
+        if not target.startswith(os.path.realpath(dest_dir) + os.sep):
+            raise ValueError(f"清单中的路径不合法: {entry['path']}")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as f:
+            for _ in entry["chunks"]:
+                f.write(next(fetched))
+        jobs.progress("extract", entry["size"])
+        os.chmod(target, entry.get("mode", 0o644))
+        os.utime(target, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+def collect_chunk_garbage(client: WebDavClient, remote_dir: str, manifest_paths: List[str]):
+    """删除不再被任何快照清单引用的分块 (任一清单无法读取时放弃，避免误删)"""
+    cfg = load_config()
+    try:
+        store = ChunkStore(client, remote_dir, cfg.get("encryption_password"))
+        referenced = set()
+        for path in manifest_paths:
+            with webdav_timer("retention", "get_manifest"):
+                manifest = store.get_manifest(path)
+            for entry in manifest.get("files", []):
+                referenced.update(entry["chunks"])
+
+        with webdav_timer("retention", "list_chunks"):
+            orphans = store.list_ids() - referenced
+        for chunk_id in orphans:
+            with webdav_timer("retention", "delete"):
+                client.remove(store.path(chunk_id))
+        if orphans:
+            logging.info(f"分块回收: 删除 {len(orphans)} 个未引用分块，保留 {len(referenced)} 个")
+    except Exception as e:
+        logging.error(f"分块回收出错，本次跳过: {e}")
+
+# --- 任务引擎 ---
+
+class Job:
+    """一次备份或还原任务，记录各阶段的状态、处理字节数与耗时"""
+
+    def __init__(self, kind: str, trigger: str):
+        self.id = secrets.token_hex(6)
+        self.kind = kind
+        self.trigger = trigger
+        self.status = "running"
+        self.error = None
+        self.merged = 0
+        self.started_at = time.time()
+        self.finished_at = None
+        self.phases = []
+
+    def get_phase(self, name: str) -> Optional[dict]:
+        for phase in reversed(self.phases):
+            if phase["name"] == name:
+                return phase
+        return None
+
+    def to_dict(self) -> dict:
+        now = time.time()
+        phases = []
+        for p in self.phases:
+            elapsed = (p["finished_at"] or now) - p["started_at"]
+            throughput = p["bytes"] / elapsed if elapsed > 0 and p["bytes"] else 0
+            eta = None
+            if p["status"] == "running" and p["total"] and throughput:
+                eta = max(p["total"] - p["bytes"], 0) / throughput
+            phases.append({
+                "name": p["name"],
+                "status": p["status"],
+                "bytes": p["bytes"],
+                "total": p["total"],
+                "elapsed": round(elapsed, 2),
+                "throughput": round(throughput),
+                "eta": round(eta, 1) if eta is not None else None,
+            })
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "trigger": self.trigger,
+            "status": self.status,
+            "error": self.error,
+            "merged_triggers": self.merged,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "phases": phases,
+        }
+
+class JobEngine:
+    """备份与还原共用一把锁，同一时间只运行一个任务
+
+    运行期间再次触发的备份合并到当前任务；与当前任务冲突的请求 (如备份中发起还原) 被拒绝。
+    任务内的代码通过 phase()/progress() 汇报进度，没有运行中的任务时这些调用不做任何事。
+    """
+
+    def __init__(self, history: int = 20):
+        self._lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self.current = None
+        self.history = []
+        self.history_size = history
+
+    def submit(self, kind: str, trigger: str, func, *args, wait: bool = False):
+        """启动任务，返回 (任务, 是否新建)；已有任务运行时不启动，返回当前任务"""
+        deadline = time.monotonic() + JOB_LOCK_WAIT
+        while True:
+            # 拿锁与设置 current 在同一临界区内完成，并发的提交总能看到正在运行的任务 (用于合并或报告冲突)
+            with self._state_lock:
+                if self._lock.acquire(blocking=False):
+                    job = self.current = Job(kind, trigger)
+                    break
+                job = self.current
+                if job is not None or time.monotonic() >= deadline:
+                    if job is not None and job.kind == kind and kind == "backup":
+                        job.merged += 1
+                        logging.info(f"备份任务正在运行，本次触发 ({trigger}) 已合并到任务 {job.id}")
+                    else:
+                        logging.warning(f"已有任务正在运行，忽略 {trigger} 触发的 {kind} 任务")
+                    return job, False
+            # 锁被持续复制周期占用 (见 exclusive)，等它结束
+            time.sleep(0.2)
+
+        def run():
+            try:
+                governor.begin(kind)
+                func(*args)
+            except Exception as e:
+                logging.error(f"任务 {job.id} 异常: {e}", exc_info=True)
+                self.fail(str(e))
+            finally:
+                governor.end()
+                with self._state_lock:
+                    for p in job.phases:
+                        if p["status"] == "running":
+                            p["status"] = "failed" if job.error else "success"
+                            p["finished_at"] = time.time()
+                    if job.status == "running":
+                        job.status = "success"
+                    job.finished_at = time.time()
+                    JOBS_TOTAL.labels(kind, job.status).inc()
+                    # 跳过说明数据与最近一次备份一致，同样视为成功
+                    if job.status in ("success", "skipped"):
+                        LAST_SUCCESS.labels(kind).set(job.finished_at)
+                    self.current = None
+                    self.history.insert(0, job)
+                    del self.history[self.history_size:]
+                    self._lock.release()
+
+        # 任务总在新线程中运行 (wait 时等待其结束)，降低的优先级不会残留在调度器的线程上
+        worker = threading.Thread(target=run, name=f"{kind}-{job.id}", daemon=True)
+        worker.start()
+        if wait:
+            worker.join()
+        return job, True
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """在任务之外短暂占用任务锁 (持续复制周期使用)，返回是否拿到锁；已有任务运行时不等待"""
+        acquired = self._lock.acquire(blocking=False)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self._lock.release()
+
+    def skip(self):
+        """标记当前任务为已跳过 (没有需要处理的变化)"""
+        with self._state_lock:
+            if self.current is not None and self.current.status == "running":
+                self.current.status = "skipped"
+
+    def fail(self, error: str):
+        """标记当前任务失败 (任务内部自行捕获异常时调用)"""
+        with self._state_lock:
+            if self.current is not None:
+                self.current.status = "failed"
+                self.current.error = error
+
+    @contextlib.contextmanager
+    def phase(self, name: str, total: Optional[int] = None):
+        """记录一个阶段的开始与结束"""
+        entry = {"name": name, "status": "running", "bytes": 0, "total": total,
+                 "started_at": time.time(), "finished_at": None}
+        with self._state_lock:
+            job = self.current
+            if job is not None:
+                job.phases.append(entry)
+        if job is None:
+            yield
+            return
+        status = "failed"
+        try:
+            yield
+            status = "success"
+        finally:
+            with self._state_lock:
+                entry["status"] = status
+                entry["finished_at"] = time.time()
+            PHASE_DURATION.labels(job.kind, name).observe(entry["finished_at"] - entry["started_at"])
+
+    def progress(self, name: str, n: int):
+        with self._state_lock:
+            phase = self.current.get_phase(name) if self.current is not None else None
+            if phase is not None:
+                phase["bytes"] += n
+
+    def set_total(self, name: str, total: int):
+        with self._state_lock:
+            phase = self.current.get_phase(name) if self.current is not None else None
+            if phase is not None:
+                phase["total"] = total
+
+    def snapshot(self) -> dict:
+        with self._state_lock:
+            return {
+                "current": self.current.to_dict() if self.current else None,
+                "history": [job.to_dict() for job in self.history],
+            }
+
+jobs = JobEngine()
+
+def estimate_backup_size(db_snapshot: Optional[str] = None, data_dir: str = DATA_DIR) -> int:
+    """统计待备份文件的总大小 (用于计算打包进度)"""
+    total = 0
+    for abs_path, _ in iter_backup_files(db_snapshot, data_dir):
+        try:
+            total += os.path.getsize(abs_path)
+        except OSError:
+            pass
+    return total
+
+# --- 多目标复制 ---
+
+class BackupTarget:
+    """一次备份中的一个上传目标 (连接、上传器与本次上传结果)"""
+
+    def __init__(self, cfg: dict):
+        self.cfg = cfg
+        self.name = cfg["name"]
+        self.key = catalog_target(cfg)
+        self.remote_dir = cfg.get('webdav_path', '/')
+        self.client = make_webdav_client(cfg)
+        self.uploader = ResilientUploader(self.client, cfg)
+        self.uploaded = None
+        self.error = None
+        self.elapsed = 0.0
+
+    def remote_path(self, name: str) -> str:
+        return f"{self.remote_dir}/{name}".replace("//", "/")
+
+    def prepare(self):
+        try:
+            if self.remote_dir != "/" and not self.client.exists(self.remote_dir):
+                self.client.mkdir(self.remote_dir)
+        except:
+            pass
+
+def run_on_targets(targets: List[BackupTarget], func):
+    """在所有尚未失败的目标上并发执行 func(target)，单个目标失败只记录在该目标上"""
+    alive = [t for t in targets if t.error is None]
+
+    def run(t: BackupTarget):
+        started = time.monotonic()
+        try:
+            result = func(t)
+            if result is not None:
+                t.uploaded = result
+        except Exception as e:
+            logging.error(f"目标 {t.name} 上传失败: {e}")
+            t.error = str(e)
+        finally:
+            t.elapsed += time.monotonic() - started
+
+    if len(alive) == 1:
+        run(alive[0])
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(alive) or 1) as pool:
+        list(pool.map(run, alive))
+
+def pick_restore_target(cfg: dict, name: str) -> dict:
+    """按列表耗时从快到慢选择第一个可访问且包含该备份的目标"""
+    errors = []
+    for t in rank_targets(cfg, name):
+        remote_path = f"{t.get('webdav_path', '/')}/{name}".replace("//", "/")
+        try:
+            if make_webdav_client(t).exists(remote_path):
+                return t
+            errors.append(f"{t['name']}: 不存在")
+        except Exception as e:
+            logging.warning(f"目标 {t['name']} 不可用: {e}")
+            errors.append(f"{t['name']}: {e}")
+    raise RuntimeError(f"没有可用的目标包含 {name} ({'; '.join(errors)})")
+
+# --- 核心备份逻辑 (Zip 版) ---
+
+def perform_backup(force: bool = False):
+    """执行备份 (停止服务 -> Zip打包加密 -> 启动服务 -> 上传)
+
+    /data 与上次成功备份相比没有变化时 (见 compute_data_fingerprint) 跳过停机、打包与上传，
+    只刷新备份索引并执行保留策略；force 为 True 时总是备份。
+
+    backup_mode 为 online 时改为在线快照，全程不停止服务；
+    stream_transfer 开启时打包与上传合并为流式管道，不生成临时 Zip 文件；
+    backup_format 为 incremental 时按内容分块去重上传，只生成快照清单；为 vwb 时打包为 zstd + AES-GCM 的流式归档。
+    配置了多个目标时只打包一次，再并发上传到各目标，各目标独立记录结果并执行自己的保留策略。
+    verify_after_backup 开启时，上传完成后从最快的目标读回新备份做一次完整校验；
+    wal_replication 开启时，本次备份成为持续复制的新基础代。
+    """
+    cfg = load_config()
+    fmt = cfg.get("backup_format", "zip")
+    incremental = fmt == "incremental"
+    logging.info({
+        "incremental": ">>> 开始执行备份任务 (增量分块)",
+        "vwb": ">>> 开始执行备份任务 (zstd + AES-256-GCM)",
+    }.get(fmt, ">>> 开始执行备份任务 (Zip AES-256)"))
+    
+    target_cfgs = get_targets(cfg)
+    if not target_cfgs:
+        logging.warning("未配置 WebDAV，跳过备份。")
+        return
+
+    tmp_files = []
+    backup_name = ""
+    online = cfg.get("backup_mode", "stop") == "online"
+    stream = bool(cfg.get("stream_transfer", False))
+    if stream and len(target_cfgs) > 1:
+        logging.info("配置了多个目标，流式传输改为打包到临时文件后并发上传")
+        stream = False
+
+    try:
+        # 0. 变更检测
+        fingerprint = compute_data_fingerprint(cfg)
+        if not force and is_backup_current(fingerprint, target_cfgs):
+            logging.info("数据自上次成功备份以来没有变化，跳过本次备份 (只刷新备份索引与保留策略)")
+            with jobs.phase("retention"):
+                for t in target_cfgs:
+                    apply_retention_policy(make_webdav_client(t), t.get('webdav_path', '/'), t)
+            jobs.skip()
+            return
+
+        timestamp = get_current_time_str()
+        # 使用 .zip 后缀 (增量备份为快照清单，流式归档为 .vwb)
+        suffix = {"incremental": INCREMENTAL_MANIFEST_SUFFIX, "vwb": ARCHIVE_SUFFIX}.get(fmt, ".zip")
+        backup_name = f"vw_backup_{timestamp}{suffix}"
+        zip_path = os.path.join(TEMP_DIR, backup_name)
+        password = cfg.get("encryption_password")
+        writer = write_backup_vwb if fmt == "vwb" else write_backup_zip
+
+        targets = [BackupTarget(t) for t in target_cfgs]
+        run_on_targets(targets, BackupTarget.prepare)
+        wal_base = None
+        frozen_dir = os.path.join(DATA_DIR, BACKUP_FREEZE_DIR)
+
+        def capture_wal_base(db_file: Optional[str]) -> Optional[str]:
+            # 持续复制: 保存与本次备份一致的数据库副本，上传成功后作为新一代的影子库
+            if not cfg.get("wal_replication", False) or not db_file or not os.path.exists(db_file):
+                return None
+            path = os.path.join(TEMP_DIR, f"wal_base_{timestamp}.sqlite3")
+            tmp_files.append(path)
+            snapshot_sqlite(db_file, path)
+            return path
+
+        def pack(db_snapshot: Optional[str] = None, data_dir: str = DATA_DIR):
+            # 流式/增量模式下上传与打包同时进行
+            with jobs.phase("pack", total=estimate_backup_size(db_snapshot, data_dir)), \
+                    (jobs.phase("upload") if stream or incremental else contextlib.nullcontext()):
+                return pack_and_upload(db_snapshot, data_dir)
+
+        def pack_and_upload(db_snapshot: Optional[str], data_dir: str):
+            if incremental:
+                # 每个目标有独立的分块仓库 (加密参数不同)，分别分块上传
+                logging.info(f"正在增量分块并上传到 {len(targets)} 个目标的 {INCREMENTAL_STORE_DIR} 目录...")
+                run_on_targets(targets, lambda t: upload_incremental_snapshot(
+                    t.uploader, t.remote_dir, backup_name, password, db_snapshot=db_snapshot, data_dir=data_dir))
+            elif stream:
+                t = targets[0]
+                logging.info(f"正在流式打包加密并上传到 {t.remote_path(backup_name)} ...")
+                run_on_targets(targets, lambda t: upload_zip_stream(
+                    t.uploader, t.remote_path(backup_name), password, db_snapshot=db_snapshot, writer=writer,
+                    data_dir=data_dir))
+            else:
+                logging.info(f"正在打包并加密到 {zip_path} ...")
+                tmp_files.append(zip_path)
+                writer(zip_path, password, db_snapshot=db_snapshot, data_dir=data_dir)
+                return {"size": os.path.getsize(zip_path), "checksum": file_sha256(zip_path)}
+
+        if online:
+            # 1-3. 在线快照：数据库保持运行，通过备份 API 复制后直接打包
+            try:
+                db_path = os.path.join(DATA_DIR, SQLITE_DB_NAME)
+                snapshot_path = None
+                if os.path.exists(db_path):
+                    snapshot_path = os.path.join(TEMP_DIR, f"db_snapshot_{timestamp}.sqlite3")
+                    tmp_files.append(snapshot_path)
+                    logging.info("正在通过 SQLite 在线备份 API 生成数据库快照...")
+                    with jobs.phase("snapshot"):
+                        snapshot_sqlite(db_path, snapshot_path)
+                        wal_base = capture_wal_base(snapshot_path)
+
+                archive = pack(snapshot_path)
+            except Exception as e:
+                logging.error(f"在线快照打包失败: {e}")
+                raise e
+            logging.info("服务停机时长: 0.00 秒 (在线快照模式)")
+            SERVICE_DOWNTIME.labels("backup_online").observe(0)
+        else:
+            # 1. 停止服务（确保数据一致性）
+            try:
+                with jobs.phase("stop"):
+                    stop_service()
+            except Exception as e:
+                logging.error(f"停止服务失败，中止备份: {e}")
+                jobs.fail(f"停止服务失败: {e}")
+                return
+            stopped_at = time.monotonic()
+
+            # 2. 创建加密 Zip；流式/增量模式的上传耗时不可控，停机期间只冻结 /data 的一致视图，恢复服务后再从中打包上传
+            archive = None
+            try:
+                # 停机后数据库已合并 WAL，此时的指纹与打包内容一致
+                fingerprint = compute_data_fingerprint(cfg)
+                db_path = os.path.join(DATA_DIR, SQLITE_DB_NAME)
+                if stream or incremental:
+                    with jobs.phase("snapshot"):
+                        freeze_data_dir(frozen_dir)
+                        wal_base = capture_wal_base(os.path.join(frozen_dir, SQLITE_DB_NAME))
+                else:
+                    wal_base = capture_wal_base(db_path)
+                    archive = pack()
+            except Exception as e:
+                logging.error(f"打包失败: {e}")
+                start_service() # 尝试恢复服务
+                raise e
+            
+            # 3. 立即恢复服务
+            try:
+                with jobs.phase("start"):
+                    start_service()
+            except Exception as e:
+                logging.error(f"服务启动失败! 请手动检查: {e}")
+                send_notifications("严重错误：备份后服务无法自动启动！", success=False)
+                raise e
+            downtime = time.monotonic() - stopped_at
+            logging.info(f"服务停机时长: {downtime:.2f} 秒 (停机打包模式)")
+            SERVICE_DOWNTIME.labels("backup_stop").observe(downtime)
+
+            if archive is None:
+                archive = pack(data_dir=frozen_dir)
+
+        # 4. 上传 (流式/增量模式已在打包时完成)：同一个 Zip 并发上传到所有目标
+        if not (stream or incremental):
+            alive = [t for t in targets if t.error is None]
+            logging.info(f"正在上传到 {len(alive)} 个 WebDAV 目标...")
+            with jobs.phase("upload", total=archive["size"] * len(alive)):
+                run_on_targets(alive, lambda t: t.uploader.upload_file(zip_path, t.remote_path(backup_name)) or archive)
+
+        succeeded = [t for t in targets if t.error is None and t.uploaded]
+        failed = [t for t in targets if t not in succeeded]
+        now = datetime.datetime.now(TZ_CN).strftime("%Y-%m-%d %H:%M:%S")
+        for t in failed:
+            catalog.set_upload_status(t.key, name=backup_name, status="failed", error=t.error or "未完成", at=now, elapsed=round(t.elapsed, 2))
+        if not succeeded:
+            raise RuntimeError("所有目标上传失败: " + "; ".join(f"{t.name}: {t.error}" for t in failed))
+
+        for t in succeeded:
+            logging.info(f"上传成功: {t.name}")
+            t.uploader.log_summary()
+            catalog.record(
+                t.key, backup_name,
+                path=t.remote_path(backup_name),
+                format=backup_format_of(backup_name),
+                last_modified=now,
+                **t.uploaded,
+            )
+            catalog.set_upload_status(t.key, name=backup_name, status="success", error=None, at=now, elapsed=round(t.elapsed, 2))
+        ARCHIVE_SIZE.set(succeeded[0].uploaded["size"])
+        
+        # 5. 保留策略 (各目标使用自己的保留数量)
+        logging.info("正在检查保留策略...")
+        with jobs.phase("retention"):
+            for t in succeeded:
+                apply_retention_policy(t.client, t.remote_dir, t.cfg)
+
+        # 6. 持续复制从本次备份开始新的一代 (优先主目标)
+        if wal_base:
+            try:
+                replicator.start_generation(backup_name, wal_base, succeeded[0].cfg)
+            except Exception as e:
+                logging.error(f"持续复制开始新的一代失败: {e}")
+
+        # 7. 读回新备份做一次校验 (不停止服务)
+        verified = ""
+        if cfg.get("verify_after_backup", False):
+            result = verify_remote_backup(backup_name)
+            if result["status"] != "ok":
+                raise RuntimeError(f"备份 {backup_name} 已上传，但校验未通过: {result['error']}")
+            verified = "，已校验"
+
+        # 所有目标都成功时才记录指纹，否则下次仍会备份
+        if not failed:
+            save_last_backup(backup_name, fingerprint)
+
+        if failed:
+            msg = f"备份 {backup_name} 未能上传到以下目标: " + "; ".join(f"{t.name}: {t.error}" for t in failed)
+            logging.error(msg)
+            send_notifications(msg, success=False)
+        logging.info(f"备份流程全部完成: {backup_name}")
+        send_notifications(f"备份完成: {backup_name} ({len(succeeded)}/{len(targets)} 个目标{verified})", success=True)
+
+    except Exception as e:
+        logging.error(f"备份流程异常: {e}", exc_info=True)
+        jobs.fail(str(e))
+        send_notifications(f"备份失败: {str(e)}", success=False)
+    finally:
+        # 清理临时文件
+        for f in tmp_files:
+            if os.path.exists(f):
+                try:
+                    os.remove(f)
+                except:
+                    pass
+        shutil.rmtree(os.path.join(DATA_DIR, BACKUP_FREEZE_DIR), ignore_errors=True)
+
+# --- 还原逻辑 (Zip 版) ---
+
+class ManualRecoveryRequired(RuntimeError):
+    """还原的撤销或回滚失败，/data 可能只换了一半：服务保持停止，原数据保留在 rollback_dir 等待手动恢复"""
+
+    def __init__(self, message: str, rollback_dir: str):
+        super().__init__(message)
+        self.rollback_dir = rollback_dir
+
+def swap_data_entries(src_dir: str, aside_dir: str):
+    """把 /data 的顶层条目移入 aside_dir，再把 src_dir 的条目移入 /data (均为 rename，耗时与数据量无关)
+
+    中途失败时按相反顺序撤销已完成的移动并删除 aside_dir，/data 与 src_dir 保持原样后再抛出异常；
+    撤销也失败时 aside_dir 保留，抛出 ManualRecoveryRequired。
+    """
+    os.makedirs(aside_dir)
+    moved_aside, moved_in = [], []
+    try:
+        for name in os.listdir(DATA_DIR):
+            if name not in DATA_WORK_DIRS:
+                os.rename(os.path.join(DATA_DIR, name), os.path.join(aside_dir, name))
+                moved_aside.append(name)
+        for name in os.listdir(src_dir):
+            os.rename(os.path.join(src_dir, name), os.path.join(DATA_DIR, name))
+            moved_in.append(name)
+    except Exception as e:
+        logging.error(f"交换数据目录失败，正在撤销已完成的移动: {e}")
+        failed = []
+        for src, dest, names in ((DATA_DIR, src_dir, moved_in), (aside_dir, DATA_DIR, moved_aside)):
+            for name in reversed(names):
+                try:
+                    os.rename(os.path.join(src, name), os.path.join(dest, name))
+                except OSError as undo_error:
+                    failed.append(f"{name}: {undo_error}")
+        if failed:
+            raise ManualRecoveryRequired(
+                f"交换数据目录失败 ({e})，且撤销失败 ({'; '.join(failed)})，原数据保留在 {aside_dir}，请手动恢复",
+                aside_dir,
+            ) from e
+        os.rmdir(aside_dir)
+        raise
+    os.rmdir(src_dir)
+
+def validate_restored_data(data_dir: str):
+    """在交换前检查暂存数据：必须非空，数据库需通过 quick_check"""
+    if not os.listdir(data_dir):
+        raise ValueError("备份中没有任何文件")
+    db_path = os.path.join(data_dir, SQLITE_DB_NAME)
+    if os.path.exists(db_path):
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            result = conn.execute("PRAGMA quick_check").fetchone()[0]
+        finally:
+            conn.close()
+        if result != "ok":
+            raise ValueError(f"数据库校验失败: {result}")
+
+def check_service_health() -> bool:
+    """轮询 Vaultwarden 的 /alive 接口，直到成功或超时"""
+    cfg = load_config()
+    url = f"{cfg.get('vaultwarden_url', 'http://127.0.0.1:80').rstrip('/')}/alive"
+    deadline = time.monotonic() + int(cfg.get("restore_health_timeout", 60))
+    while True:
+        try:
+            if httpx.get(url, timeout=5).status_code == 200:
+                return True
+        except Exception:
+            pass
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(1)
+
+def restore_in_place(extract, estimated: Optional[int] = None):
+    """原地还原 (停止服务 -> 清空数据 -> 解压 -> 启动服务)，磁盘空间不足以暂存时使用"""
+    # 停止服务
+    try:
+        with jobs.phase("stop"):
+            stop_service()
+    except Exception as e:
+        logging.error(f"停止服务失败: {e}")
+        raise e
+    stopped_at = time.monotonic()
+
+    # 清空 /data 目录 (确保无残留垃圾文件)
+    logging.info(f"正在清空数据目录 {DATA_DIR} ...")
+    for filename in os.listdir(DATA_DIR):
+        file_path = os.path.join(DATA_DIR, filename)
+        try:
+            if os.path.isfile(file_path) or os.path.islink(file_path):
+                os.unlink(file_path)
+            elif os.path.isdir(file_path):
+                shutil.rmtree(file_path)
+        except Exception as e:
+            logging.error(f"删除 {file_path} 失败: {e}")
+
+    # 解压还原
+    with jobs.phase("extract", total=estimated):
+        extract(DATA_DIR)
+    
+    # 启动服务
+    try:
+        with jobs.phase("start"):
+            start_service()
+        logging.info("还原完成，服务已重启")
+    except Exception as e:
+        logging.error(f"服务启动失败: {e}")
+        raise e
+    downtime = time.monotonic() - stopped_at
+    logging.info(f"服务停机时长: {downtime:.2f} 秒 (原地还原)")
+    SERVICE_DOWNTIME.labels("restore_in_place").observe(downtime)
+
+def restore_staged(extract, estimated: Optional[int] = None):
+    """分阶段还原 (解压到暂存目录并校验 -> 停止服务 -> 目录交换 -> 启动服务 -> 健康检查)
+
+    旧数据保留在回滚目录，健康检查失败时自动换回。交换的撤销或换回失败时服务保持停止，
+    抛出 ManualRecoveryRequired。
+    """
+    staging = os.path.join(DATA_DIR, RESTORE_STAGING_DIR)
+    rollback = os.path.join(DATA_DIR, RESTORE_ROLLBACK_DIR)
+    if os.path.exists(rollback):
+        raise RuntimeError(f"发现上一次还原遗留的回滚目录 {rollback}，请确认数据后手动删除再还原")
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    try:
+        # 服务保持运行，先解压并校验
+        logging.info(f"正在解压到暂存目录 {staging} (服务保持运行)...")
+        with jobs.phase("extract", total=estimated):
+            extract(staging)
+        with jobs.phase("validate"):
+            validate_restored_data(staging)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    try:
+        with jobs.phase("stop"):
+            stop_service()
+    except Exception as e:
+        logging.error(f"停止服务失败: {e}")
+        shutil.rmtree(staging, ignore_errors=True)
+        raise e
+    stopped_at = time.monotonic()
+
+    logging.info("正在交换数据目录...")
+    try:
+        with jobs.phase("swap"):
+            swap_data_entries(staging, rollback)
+    except ManualRecoveryRequired:
+        # 撤销失败时 /data 只换了一半，保留现场等待手动处理
+        raise
+    except Exception:
+        # 交换已撤销，在原数据上恢复服务
+        start_service()
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    with jobs.phase("start"):
+        start_service()
+    downtime = time.monotonic() - stopped_at
+    logging.info(f"服务停机时长: {downtime:.2f} 秒 (分阶段还原)")
+    SERVICE_DOWNTIME.labels("restore_staged").observe(downtime)
+
+    with jobs.phase("health"):
+        healthy = check_service_health()
+    if healthy:
+        shutil.rmtree(rollback, ignore_errors=True)
+        logging.info("还原完成，服务健康检查通过，已删除回滚数据")
+        return
+
+    # 健康检查失败：换回旧数据
+    logging.error("还原后服务健康检查失败，正在回滚到还原前的数据...")
+    try:
+        stop_service()
+        swap_data_entries(rollback, staging)
+    except Exception as e:
+        # 无论换回是否已撤销，/data 都不是可用的数据，不再启动服务
+        logging.error(f"回滚失败: {e}")
+        raise ManualRecoveryRequired(
+            f"还原后服务健康检查失败，回滚也失败: {e}；还原前的数据保留在 {rollback}", rollback) from e
+    start_service()
+    shutil.rmtree(staging, ignore_errors=True)
+    raise RuntimeError("还原后服务健康检查失败，已回滚到还原前的数据")
+
+def run_restore(extract, prepare=None, finalize=None):
+    """执行还原 (准备/验证 -> 分阶段或原地还原)
+
+    prepare 在停止服务前执行 (用于提前发现格式或密码错误)，返回解压后的预估大小；
+    extract(dest_dir) 负责写入数据，finalize(dest_dir) 在解压后执行 (如重放增量段)。
+    暂存空间不足时回退为原地还原。
+    """
+    if finalize:
+        base_extract = extract
+
+        def extract(dest_dir: str):
+            base_extract(dest_dir)
+            with jobs.phase("replay"):
+                finalize(dest_dir)
+
+    try:
+        # 1. 基础验证
+        required = prepare() if prepare else None
+
+        # 2. 暂存需要额外的磁盘空间，不足时回退
+        free = shutil.disk_usage(DATA_DIR).free
+        if required and required > free * 0.95:
+            logging.warning(
+                f"磁盘剩余空间不足以暂存还原数据 (需要 {round(required / 1024 / 1024, 2)} MB)，回退为原地还原"
+            )
+            restore_in_place(extract, required)
+        else:
+            restore_staged(extract, required)
+        send_notifications("还原完成，服务已重启", success=True)
+
+    except ManualRecoveryRequired as e:
+        # 不能在换了一半的 /data 上启动服务
+        logging.error(f"还原失败，服务保持停止，需要手动恢复: {e}", exc_info=True)
+        jobs.fail(str(e))
+        send_notifications(
+            f"还原失败，服务保持停止，需要手动恢复: {e}\n还原前的数据在 {e.rollback_dir}，"
+            f"请把其中的文件移回 {DATA_DIR} 后手动启动服务", success=False)
+    except Exception as e:
+        logging.error(f"还原失败: {e}", exc_info=True)
+        jobs.fail(str(e))
+        send_notifications(f"还原失败: {str(e)}", success=False)
+        # 尝试保底启动
+        try:
+            start_service()
+        except Exception as start_error:
+            logging.error(f"保底启动服务失败: {start_error}")
+
+def restore_zip_archive(source, finalize=None):
+    """从 Zip 还原，source 可以是本地路径，也可以是可 seek 的流 (如 RemoteZipReader)"""
+    password = load_config().get("encryption_password")
+
+    def prepare() -> int:
+        if not pyzipper.is_zipfile(source):
+            raise ValueError("不是有效的 Zip 文件")
+        with pyzipper.AESZipFile(source, 'r') as zf:
+            return sum(info.file_size for info in zf.infolist())
+
+    def extract(dest_dir: str):
+        logging.info("正在解压 Zip 包...")
+        try:
+            with pyzipper.AESZipFile(source, 'r') as zf:
+                if password:
+                    zf.setpassword(password.encode('utf-8'))
+                
+                # 提取到数据目录 (逐个解压以便汇报进度)
+                for info in zf.infolist():
+                    zf.extract(info, path=dest_dir)
+                    jobs.progress("extract", info.file_size)
+                logging.info("解压完成")
+        except RuntimeError as e:
+            # 通常是密码错误
+            if 'Bad password' in str(e):
+                raise ValueError("解密密码错误")
+            raise e
+
+    run_restore(extract, prepare, finalize)
+
+def restore_vwb_archive(source, finalize=None):
+    """从 .vwb 归档还原，source 为可顺序读取的流 (本地文件或 HTTP 响应流，不需要 seek)
+
+    头部与密码在停止服务前校验；数据块在解压过程中逐块认证。
+    """
+    password = load_config().get("encryption_password")
+    state = {}
+
+    def prepare() -> Optional[int]:
+        state["reader"] = ArchiveReader(source, password)
+        return state["reader"].raw_size or None
+
+    def extract(dest_dir: str):
+        logging.info("正在解密解压 .vwb 归档...")
+        result = extract_vwb_archive(state["reader"], dest_dir)
+        logging.info(f"解压完成: {result['entries']} 个文件")
+
+    run_restore(extract, prepare, finalize)
+
+def detect_archive_format(path: str) -> str:
+    """根据文件头的魔数判断本地备份文件的格式"""
+    with open(path, "rb") as f:
+        return "vwb" if f.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC else "zip"
+
+def restore_incremental(client: WebDavClient, remote_dir: str, manifest_name: str, finalize=None):
+    """从分块仓库还原快照清单 (清单在停止服务前下载并解密)"""
+    password = load_config().get("encryption_password")
+    state = {}
+
+    def prepare() -> int:
+        store = ChunkStore(client, remote_dir, password)
+        state["store"] = store
+        state["manifest"] = store.get_manifest(f"{remote_dir}/{manifest_name}".replace("//", "/"))
+        return sum(f["size"] for f in state["manifest"].get("files", []))
+
+    def extract(dest_dir: str):
+        logging.info(f"正在从分块仓库重建 {len(state['manifest'].get('files', []))} 个文件...")
+        extract_incremental_snapshot(state["store"], state["manifest"], dest_dir)
+        logging.info("重建完成")
+
+    run_restore(extract, prepare, finalize)
+
+def process_restore_file(local_file_path: str, finalize=None):
+    """从本地备份文件还原 (按魔数识别 Zip 或 .vwb)，完成后删除该文件"""
+    try:
+        if detect_archive_format(local_file_path) == "vwb":
+            logging.info(">>> 开始执行还原任务 (.vwb)")
+            with open(local_file_path, "rb") as f:
+                restore_vwb_archive(f, finalize)
+        else:
+            logging.info(">>> 开始执行还原任务 (Zip)")
+            restore_zip_archive(local_file_path, finalize)
+    finally:
+        if os.path.exists(local_file_path):
             try:
                 os.remove(local_file_path)
             except:
                 pass
 
-def download_and_restore(filename: str):
-    """从 WebDAV 下载并还原"""
-    cfg = load_config()
+def download_and_restore(filename: str, until: Optional[str] = None):
+    """从 WebDAV 下载并还原 (stream_transfer 开启时边下载边解压，增量快照按清单重建)
+
+    配置了多个目标时，从最快的可用目标读取。指定 until ("latest" 或 "YYYY-MM-DD HH:MM:SS") 时，
+    解压后继续重放该备份之后的持续复制增量段，把数据库恢复到指定时间点。
+    """
     local_filename = os.path.basename(filename)
     local_path = os.path.join(TEMP_DIR, local_filename)
+    finalize = None
+    if until:
+        def finalize(dest_dir: str):
+            replay_wal_segments(os.path.join(dest_dir, SQLITE_DB_NAME), local_filename,
+                                None if until == "latest" else until)
     
     try:
-        logging.info(f"开始下载备份文件: {filename}")
-        client = WebDavClient(
-            cfg["webdav_url"], 
-            auth=(cfg.get("webdav_user", ""), cfg.get("webdav_password", ""))
-        )
+        cfg = pick_restore_target(load_config(), local_filename)
+        logging.info(f"从目标 {cfg['name']} 读取备份")
+        client = make_webdav_client(cfg)
         
         remote_path = f"{cfg.get('webdav_path', '/')}/{local_filename}".replace("//", "/")
+
+        if local_filename.endswith(INCREMENTAL_MANIFEST_SUFFIX):
+            logging.info(f">>> 开始执行还原任务 (增量快照: {filename})")
+            restore_incremental(client, cfg.get('webdav_path', '/'), local_filename, finalize)
+            return
         
-        client.download_file(remote_path, local_path)
-        process_restore_file(local_path)
+        if cfg.get("stream_transfer", False) and local_filename.endswith(ARCHIVE_SUFFIX):
+            # .vwb 只需顺序读取，不依赖 Range
+            logging.info(f">>> 开始执行还原任务 (流式读取: {filename})")
+            with client.open(remote_path, mode="rb") as raw:
+                restore_vwb_archive(raw, finalize)
+            return
+
+        if cfg.get("stream_transfer", False):
+            with client.open(remote_path, mode="rb") as raw:
+                if raw.supports_ranges and raw.size:
+                    logging.info(f">>> 开始执行还原任务 (流式读取: {filename})")
+                    restore_zip_archive(RemoteZipReader(raw), finalize)
+                    return
+            logging.warning("服务器不支持 Range 请求，回退为先下载后还原")
+
+        logging.info(f"开始下载备份文件: {filename}")
+        expected = next((e for e in catalog.entries(catalog_target(cfg)) if e["name"] == local_filename), None)
+        RangedDownloader(client, cfg).download(remote_path, local_path, expected)
+        process_restore_file(local_path, finalize)
     except Exception as e:
         logging.error(f"下载/还原过程出错: {e}")
+        jobs.fail(str(e))
         send_notifications(f"下载/还原出错: {e}", success=False)
 
+# --- 按文件还原 ---
+
+class HttpRangeFile:
+    """按需发起有界 Range 请求的远程只读文件，用于随机读取 Zip 的中央目录与单个条目
+
+    与 RemoteZipReader 不同，每次只请求需要的字节范围 (连续读取时请求长度逐次翻倍，最多 RANGE_READ_MAX)，
+    跳转不会让服务器继续发送到文件末尾，传输量与实际读取的条目大小成正比。
+    """
+
+    def __init__(self, client: WebDavClient, remote_path: str):
+        self.client = client
+        self.url = client.join_url(remote_path)
+        resp = client.http.head(self.url)
+        resp.raise_for_status()
+        self.size = int(resp.headers.get("content-length") or 0)
+        if not self.size:
+            raise ValueError("无法获取远程文件大小")
+        self.pos = 0
+        self.fetched = 0
+        self.requests = 0
+        self._buf = b""
+        self._buf_start = 0
+        self._read_size = RANGE_READ_MIN
+
+    def _fetch(self, n: int):
+        if self.pos == self._buf_start + len(self._buf):
+            self._read_size = min(self._read_size * 2, RANGE_READ_MAX)
+        else:
+            self._read_size = RANGE_READ_MIN
+        end = min(self.pos + max(n, self._read_size), self.size) - 1
+        with self.client.http.stream("GET", self.url, headers={"Range": f"bytes={self.pos}-{end}"}) as resp:
+            if resp.status_code == 200:
+                raise RangeNotSupported()
+            resp.raise_for_status()
+            data = resp.read()
+        self._buf, self._buf_start = data, self.pos
+        self.requests += 1
+        self.fetched += len(data)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0:
+            n = self.size - self.pos
+        n = max(min(n, self.size - self.pos), 0)
+        if n == 0:
+            return b""
+        offset = self.pos - self._buf_start
+        if not (0 <= offset and offset + n <= len(self._buf)):
+            self._fetch(n)
+            offset = 0
+        data = self._buf[offset:offset + n]
+        self.pos += len(data)
+        return data
+
+    def seekable(self) -> bool:
+        return True
+
+    def close(self):
+        pass
+
+def open_remote_zip(client: WebDavClient, remote_path: str) -> tuple:
+    """只读取中央目录打开远程 Zip，返回 (AESZipFile, HttpRangeFile)"""
+    remote = HttpRangeFile(client, remote_path)
+    try:
+        zf = pyzipper.AESZipFile(remote, 'r')
+    except RangeNotSupported:
+        raise ValueError("服务器不支持 Range 请求，无法按文件浏览")
+    except pyzipper.BadZipFile:
+        raise ValueError("不是有效的 Zip 文件")
+    return zf, remote
+
+def list_backup_entries(name: str) -> dict:
+    """列出云端备份中的文件 (Zip 只读取中央目录，增量快照只读取清单)"""
+    cfg = pick_restore_target(load_config(), name)
+    client = make_webdav_client(cfg)
+    remote_dir = cfg.get('webdav_path', '/')
+    remote_path = f"{remote_dir}/{name}".replace("//", "/")
+    fmt = backup_format_of(name)
+    if fmt == "incremental":
+        store = ChunkStore(client, remote_dir, cfg.get("encryption_password"))
+        entries = [
+            {"path": f["path"], "size": f["size"],
+             "modified": datetime.datetime.fromtimestamp(f["mtime_ns"] / 1e9, TZ_CN).strftime("%Y-%m-%d %H:%M:%S")}
+            for f in store.get_manifest(remote_path).get("files", [])
+        ]
+    elif fmt == "zip":
+        zf, remote = open_remote_zip(client, remote_path)
+        with zf:
+            entries = [
+                {"path": info.filename, "size": info.file_size,
+                 "modified": "%04d-%02d-%02d %02d:%02d:%02d" % info.date_time}
+                for info in zf.infolist() if not info.is_dir()
+            ]
+        logging.info(f"读取 {name} 的中央目录: {remote.requests} 次请求, {round(remote.fetched / 1024, 1)} KB")
+    else:
+        raise ValueError(".vwb 归档只能顺序读取，不支持按文件浏览")
+    return {"name": name, "format": fmt, "entries": sorted(entries, key=lambda e: e["path"])}
+
+def restore_selected_files(name: str, paths: List[str]):
+    """只还原云端备份中选中的文件或目录 (Zip 通过 Range 随机读取，增量快照只取回相关分块)
+
+    选中的文件先解压到暂存目录并校验，再逐个替换 /data 中的同名文件，其余文件不受影响。
+    只有包含 db.sqlite3 时才停止服务 (同时移走旧的 -wal/-shm)，并在启动后做健康检查；
+    被替换的文件暂存在回滚目录，替换或健康检查失败时换回；换回也失败时服务保持停止，等待手动恢复。
+    """
+    staging = os.path.join(DATA_DIR, RESTORE_STAGING_DIR)
+    rollback = os.path.join(DATA_DIR, RESTORE_ROLLBACK_DIR)
+    prefixes = [p.strip("/") for p in paths if p.strip("/")]
+    if SQLITE_DB_NAME in prefixes:
+        # 数据库与备份中的 -wal 等附属文件一起还原
+        prefixes += [SQLITE_DB_NAME + s for s in SQLITE_SIDECAR_SUFFIXES]
+    selected = lambda rel: any(rel == p or rel.startswith(p + "/") for p in prefixes)
+    stopped_at = None
+    moved = []  # (相对路径, 是否有旧文件)
+
+    def undo():
+        # 只执行一次：中途失败时部分文件已换回，再次执行会把它们当作还原后的文件删除
+        pending = list(reversed(moved))
+        moved.clear()
+        for rel, existed in pending:
+            dst = os.path.join(DATA_DIR, rel)
+            if os.path.exists(dst):
+                os.remove(dst)
+            if existed:
+                os.replace(os.path.join(rollback, rel), dst)
+
+    try:
+        if not prefixes:
+            raise ValueError("没有选择要还原的文件")
+        if os.path.exists(rollback):
+            raise RuntimeError(f"发现上一次还原遗留的回滚目录 {rollback}，请确认数据后手动删除再还原")
+        cfg = pick_restore_target(load_config(), name)
+        logging.info(f">>> 开始按文件还原 ({name}，从目标 {cfg['name']} 读取): {', '.join(paths)}")
+        client = make_webdav_client(cfg)
+        remote_dir = cfg.get('webdav_path', '/')
+        remote_path = f"{remote_dir}/{name}".replace("//", "/")
+        password = cfg.get("encryption_password")
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+        # 1. 服务保持运行，只取回选中的条目
+        fmt = backup_format_of(name)
+        if fmt == "incremental":
+            store = ChunkStore(client, remote_dir, password)
+            manifest = store.get_manifest(remote_path)
+            chosen = [f for f in manifest.get("files", []) if selected(f["path"])]
+            if not chosen:
+                raise ValueError("备份中没有选中的文件")
+            with jobs.phase("extract", total=sum(f["size"] for f in chosen)):
+                extract_incremental_snapshot(store, manifest, staging, only=selected)
+        elif fmt == "zip":
+            zf, remote = open_remote_zip(client, remote_path)
+            with zf:
+                chosen = [info for info in zf.infolist() if not info.is_dir() and selected(info.filename)]
+                if not chosen:
+                    raise ValueError("备份中没有选中的文件")
+                if password:
+                    zf.setpassword(password.encode('utf-8'))
+                with jobs.phase("extract", total=sum(info.file_size for info in chosen)):
+                    for info in chosen:
+                        try:
+                            zf.extract(info, path=staging)
+                        except RuntimeError as e:
+                            if 'Bad password' in str(e):
+                                raise ValueError("解密密码错误")
+                            raise
+                        jobs.progress("extract", info.file_size)
+            logging.info(
+                f"读取远程数据 {round(remote.fetched / 1024 / 1024, 2)} MB ({remote.requests} 次请求)，"
+                f"归档共 {round(remote.size / 1024 / 1024, 2)} MB"
+            )
+        else:
+            raise ValueError(".vwb 归档只能顺序读取，不支持按文件还原")
+        with jobs.phase("validate"):
+            validate_restored_data(staging)
+
+        restored = []
+        for root, _, files in os.walk(staging):
+            for f in files:
+                restored.append(os.path.relpath(os.path.join(root, f), staging).replace(os.sep, "/"))
+        replace_db = SQLITE_DB_NAME in restored
+
+        # 2. 只有数据库在其中时才停止服务
+        if replace_db:
+            with jobs.phase("stop"):
+                stop_service()
+            stopped_at = time.monotonic()
+            # 旧数据库的附属文件不能与新数据库混用，一并移走
+            restored += [SQLITE_DB_NAME + s for s in SQLITE_SIDECAR_SUFFIXES if SQLITE_DB_NAME + s not in restored]
+
+        with jobs.phase("swap"):
+            for rel in restored:
+                src = os.path.join(staging, rel)
+                dst = os.path.join(DATA_DIR, rel)
+                existed = os.path.lexists(dst)
+                if not existed and not os.path.exists(src):
+                    continue
+                if existed:
+                    os.makedirs(os.path.dirname(os.path.join(rollback, rel)), exist_ok=True)
+                    os.replace(dst, os.path.join(rollback, rel))
+                moved.append((rel, existed))
+                if os.path.exists(src):
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    os.replace(src, dst)
+
+        if replace_db:
+            with jobs.phase("start"):
+                start_service()
+            downtime = time.monotonic() - stopped_at
+            stopped_at = None
+            logging.info(f"服务停机时长: {downtime:.2f} 秒 (按文件还原)")
+            SERVICE_DOWNTIME.labels("restore_files").observe(downtime)
+            with jobs.phase("health"):
+                healthy = check_service_health()
+            if not healthy:
+                logging.error("还原后服务健康检查失败，正在换回被替换的文件...")
+                stop_service()
+                try:
+                    undo()
+                except Exception as undo_error:
+                    raise ManualRecoveryRequired(
+                        f"还原后服务健康检查失败，换回被替换的文件也失败: {undo_error}；被替换的文件保留在 {rollback}",
+                        rollback) from undo_error
+                start_service()
+                shutil.rmtree(rollback, ignore_errors=True)
+                raise RuntimeError("还原后服务健康检查失败，已换回还原前的文件")
+        elif any(rel in ("config.json", "rsa_key.pem", "rsa_key.pub.pem") for rel in restored):
+            logging.warning("已还原 Vaultwarden 的配置或密钥文件，需要重启服务后生效")
+
+        shutil.rmtree(rollback, ignore_errors=True)
+        logging.info(f"按文件还原完成: {len([r for r, _ in moved if os.path.exists(os.path.join(DATA_DIR, r))])} 个文件")
+        send_notifications(f"按文件还原完成: {', '.join(paths)}", success=True)
+    except Exception as e:
+        logging.error(f"按文件还原失败: {e}", exc_info=True)
+        manual = isinstance(e, ManualRecoveryRequired)
+        if moved:
+            try:
+                undo()
+                shutil.rmtree(rollback, ignore_errors=True)
+            except Exception as undo_error:
+                logging.error(f"换回被替换的文件失败，旧文件保留在 {rollback}: {undo_error}")
+                manual = True
+        jobs.fail(str(e))
+        if manual:
+            # /data 中只换回了一部分文件，不能在其上启动服务
+            send_notifications(
+                f"按文件还原失败，需要手动恢复: {e}\n被替换的文件在 {rollback}，"
+                f"请把其中的文件移回 {DATA_DIR} 后手动启动服务",
+                success=False)
+        else:
+            send_notifications(f"按文件还原失败: {e}", success=False)
+            if stopped_at is not None:
+                try:
+                    start_service()
+                except Exception as start_error:
+                    logging.error(f"恢复服务失败: {start_error}")
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+# --- 备份校验 ---
+
+def check_sqlite_database(db_path: str) -> dict:
+    """对数据库执行完整的 integrity_check，并统计每个表的行数"""
+    conn = sqlite3.connect(db_path)
+    try:
+        problems = [row[0] for row in conn.execute(f"PRAGMA integrity_check({VERIFY_MAX_ERRORS})")]
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+        counts = {}
+        for table in tables:
+            quoted = table.replace('"', '""')
+            counts[table] = conn.execute(f'SELECT COUNT(*) FROM "{quoted}"').fetchone()[0]
+    finally:
+        conn.close()
+    return {"integrity": "ok" if problems == ["ok"] else "; ".join(problems), "tables": counts}
+
+def is_sqlite_file(rel_path: str) -> bool:
+    """数据库主文件及其 WAL 等附属文件 (校验时需要一起取出，才能得到与还原后一致的数据)"""
+    return rel_path in [SQLITE_DB_NAME] + [SQLITE_DB_NAME + suffix for suffix in SQLITE_SIDECAR_SUFFIXES]
+
+def verify_zip_archive(source, password: Optional[str], scratch_dir: str) -> dict:
+    """顺序读取 Zip 的每个条目 (解密并校验 CRC/HMAC)，只把数据库文件写入 scratch_dir
+
+    每次只读取 VERIFY_READ_SIZE，内存占用与条目大小无关；source 可以是本地路径或 RemoteZipReader。
+    """
+    if not pyzipper.is_zipfile(source):
+        raise ValueError("不是有效的 Zip 文件")
+    entries = 0
+    total = 0
+    try:
+        with pyzipper.AESZipFile(source, 'r') as zf:
+            if password:
+                zf.setpassword(password.encode('utf-8'))
+            infos = [info for info in zf.infolist() if not info.is_dir()]
+            jobs.set_total("verify", sum(info.file_size for info in infos))
+            for info in infos:
+                out = open(os.path.join(scratch_dir, info.filename), "wb") if is_sqlite_file(info.filename) else None
+                try:
+                    with zf.open(info) as f:
+                        while True:
+                            data = f.read(VERIFY_READ_SIZE)
+                            if not data:
+                                break
+                            if out:
+                                out.write(data)
+                            jobs.progress("verify", len(data))
+                finally:
+                    if out:
+                        out.close()
+                entries += 1
+                total += info.file_size
+    except RuntimeError as e:
+        if 'password' in str(e).lower():
+            raise ValueError("解密密码错误")
+        raise
+    except pyzipper.BadZipFile as e:
+        raise ValueError(f"Zip 条目损坏: {e}")
+    return {"entries": entries, "bytes": total}
+
+def verify_incremental_snapshot(store: ChunkStore, manifest: dict, scratch_dir: str) -> dict:
+    """取回快照引用的所有分块 (解密时校验 GCM 标签与分块 ID)，核对文件大小，只把数据库文件写入 scratch_dir"""
+    files = manifest.get("files", [])
+    jobs.set_total("verify", sum(f["size"] for f in files))
+    fetched = iter_fetched_chunks(store, [c for f in files for c in f["chunks"]])
+    for entry in files:
+        out = open(os.path.join(scratch_dir, entry["path"]), "wb") if is_sqlite_file(entry["path"]) else None
+        size = 0
+        try:
+            for _ in entry["chunks"]:
+                data = next(fetched)
+                size += len(data)
+                if out:
+                    out.write(data)
+                jobs.progress("verify", len(data))
+        finally:
+            if out:
+                out.close()
+        if size != entry["size"]:
+            raise ValueError(f"文件大小与清单不符: {entry['path']} ({size} != {entry['size']})")
+    return {"entries": len(files), "bytes": sum(f["size"] for f in files)}
+
+def verify_vwb_archive(source, password: Optional[str], scratch_dir: str) -> dict:
+    """顺序读取 .vwb 归档 (逐块认证解密并校验 zstd 校验和)，只把数据库文件写入 scratch_dir"""
+    return extract_vwb_archive(ArchiveReader(source, password), scratch_dir, phase="verify", only=is_sqlite_file)
+
+def verify_local_file(path: str, password: Optional[str], scratch_dir: str) -> dict:
+    """按魔数识别本地备份文件的格式并校验"""
+    if detect_archive_format(path) == "vwb":
+        with open(path, "rb") as f:
+            return verify_vwb_archive(f, password, scratch_dir)
+    return verify_zip_archive(path, password, scratch_dir)
+
+def verify_archive(read) -> dict:
+    """执行校验并汇总结果 (不抛出异常，失败原因写入 error)
+
+    read(scratch_dir) 负责读取归档，返回条目数与字节数；随后对取出的数据库做完整性检查。
+    """
+    started = time.monotonic()
+    result = {"status": "failed", "entries": 0, "bytes": 0, "integrity": None, "tables": {}, "error": None}
+    scratch_dir = tempfile.mkdtemp(prefix="verify_", dir=TEMP_DIR)
+    try:
+        with jobs.phase("verify"):
+            result.update(read(scratch_dir))
+            db_path = os.path.join(scratch_dir, SQLITE_DB_NAME)
+            if not os.path.exists(db_path):
+                raise ValueError(f"备份中没有 {SQLITE_DB_NAME}")
+            result.update(check_sqlite_database(db_path))
+            if result["integrity"] != "ok":
+                raise ValueError(f"数据库完整性检查未通过: {result['integrity']}")
+        result["status"] = "ok"
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    result["elapsed"] = round(time.monotonic() - started, 2)
+    result["verified_at"] = datetime.datetime.now(TZ_CN).strftime("%Y-%m-%d %H:%M:%S")
+    VERIFY_TOTAL.labels(result["status"]).inc()
+    if result["status"] == "ok":
+        logging.info(
+            f"校验通过: {result['entries']} 个文件, {round(result['bytes'] / 1024 / 1024, 2)} MB, "
+            f"数据表行数 {result['tables']}, 耗时 {result['elapsed']} 秒"
+        )
+    else:
+        logging.error(f"校验未通过: {result['error']}")
+    return result
+
+def verify_remote_backup(name: str, target_name: Optional[str] = None) -> dict:
+    """校验 WebDAV 上的备份 (不停止服务、不改动 /data)，结果记录到该目标的备份索引
+
+    未指定目标时从最快的可用目标读取；支持 Range 时流式读取，否则先下载到临时目录。
+    """
+    cfg = load_config()
+    if target_name:
+        t = next((t for t in get_targets(cfg) if t["name"] == target_name), None)
+        if t is None:
+            raise ValueError(f"目标不存在: {target_name}")
+    else:
+        t = pick_restore_target(cfg, name)
+    client = make_webdav_client(t)
+    remote_dir = t.get('webdav_path', '/')
+    remote_path = f"{remote_dir}/{name}".replace("//", "/")
+    password = cfg.get("encryption_password")
+    logging.info(f">>> 开始校验备份: {name} (目标 {t['name']})")
+
+    def read(scratch_dir: str) -> dict:
+        if name.endswith(INCREMENTAL_MANIFEST_SUFFIX):
+            store = ChunkStore(client, remote_dir, password)
+            return verify_incremental_snapshot(store, store.get_manifest(remote_path), scratch_dir)
+        with client.open(remote_path, mode="rb") as raw:
+            if name.endswith(ARCHIVE_SUFFIX):
+                return verify_vwb_archive(raw, password, scratch_dir)
+            if raw.supports_ranges and raw.size:
+                return verify_zip_archive(RemoteZipReader(raw), password, scratch_dir)
+        logging.warning("服务器不支持 Range 请求，先下载到临时目录再校验")
+        local_path = os.path.join(scratch_dir, os.path.basename(name))
+        with jobs.phase("download", total=client.content_length(remote_path)):
+            client.download_file(remote_path, local_path, callback=lambda n: jobs.progress("download", n))
+        try:
+            return verify_local_file(local_path, password, scratch_dir)
+        finally:
+            os.remove(local_path)
+
+    result = verify_archive(read)
+    result["target"] = t["name"]
+    catalog.record(catalog_target(t), name, verification=result)
+    return result
+
+def run_verify(name: Optional[str] = None, target_name: Optional[str] = None, local_path: Optional[str] = None):
+    """校验任务入口：校验远程备份或上传的本地备份文件 (完成后删除)，失败时标记任务失败并发送通知"""
+    try:
+        if local_path:
+            logging.info(f">>> 开始校验上传的备份文件: {os.path.basename(local_path)}")
+            password = load_config().get("encryption_password")
+            result = verify_archive(lambda scratch_dir: verify_local_file(local_path, password, scratch_dir))
+        else:
+            result = verify_remote_backup(name, target_name)
+    except Exception as e:
+        logging.error(f"校验任务出错: {e}")
+        result = {"status": "failed", "error": str(e)}
+    finally:
+        if local_path and os.path.exists(local_path):
+            os.remove(local_path)
+
+    label = name or os.path.basename(local_path)
+    if result["status"] != "ok":
+        jobs.fail(result["error"])
+        send_notifications(f"备份校验未通过: {label}: {result['error']}", success=False)
+    else:
+        send_notifications(f"备份校验通过: {label}", success=True)
+
+# --- 持续复制 (数据库增量段) ---
+
+def wal_generation_dir(remote_dir: str, base_name: str) -> str:
+    return f"{remote_dir}/{WAL_REMOTE_DIR}/{base_name}".replace("//", "/")
+
+def read_page_size(db_path: str) -> int:
+    with open(db_path, "rb") as f:
+        size = int.from_bytes(f.read(100)[16:18], "big")
+    return 65536 if size == 1 else size
+
+def diff_pages(old_path: str, new_path: str, page_size: int) -> Dict[int, bytes]:
+    """逐页比较两个数据库文件，返回 {页号: 新文件中的页面内容}"""
+    changed = {}
+    with open(old_path, "rb") as old, open(new_path, "rb") as new:
+        pgno = 1
+        while True:
+            page = new.read(page_size)
+            if not page:
+                break
+            if old.read(page_size) != page:
+                changed[pgno] = page
+            pgno += 1
+    return changed
+
+def wal_checksum(data: bytes, s0: int, s1: int, big_endian: bool) -> tuple:
+    """SQLite WAL 的累积校验和 (按 32 位字成对累加)"""
+    words = struct.unpack(f"{'>' if big_endian else '<'}{len(data) // 4}I", data)
+    for i in range(0, len(words), 2):
+        s0 = (s0 + words[i] + s1) & 0xFFFFFFFF
+        s1 = (s1 + words[i + 1] + s0) & 0xFFFFFFFF
+    return s0, s1
+
+def read_wal_header(wal_path: str) -> Optional[dict]:
+    """读取 -wal 文件头，返回从第一帧开始读取的位置；文件不存在、为空或无效时返回 None"""
+    try:
+        with open(wal_path, "rb") as f:
+            raw = f.read(WAL_FILE_HEADER.size)
+    except FileNotFoundError:
+        return None
+    if len(raw) < WAL_FILE_HEADER.size:
+        return None
+    magic, _, page_size, _, salt1, salt2, c1, c2 = WAL_FILE_HEADER.unpack(raw)
+    big_endian = magic == WAL_MAGIC[1]
+    if magic not in WAL_MAGIC or wal_checksum(raw[:24], 0, 0, big_endian) != (c1, c2):
+        return None
+    return {"salt": [salt1, salt2], "page_size": page_size, "big_endian": big_endian,
+            "offset": WAL_FILE_HEADER.size, "checksum": [c1, c2]}
+
+def read_wal_frames(wal_path: str, pos: dict) -> tuple:
+    """从 pos 开始读取 -wal 中新提交的帧，返回 ({页号: 最新页面}, 提交后的数据库页数, 新位置)
+
+    只接受 salt 与累积校验和都连续的帧，并截止到最后一个提交帧 (写入中的事务留到下个周期)；
+    没有新的提交时页数为 None、位置不变。
+    """
+    page_size = pos["page_size"]
+    frame_size = WAL_FRAME_HEADER.size + page_size
+    s0, s1 = pos["checksum"]
+    offset = pos["offset"]
+    pages, pending, page_count, new_pos = {}, {}, None, pos
+    with open(wal_path, "rb") as f:
+        f.seek(offset)
+        while True:
+            frame = f.read(frame_size)
+            if len(frame) < frame_size:
+                break
+            pgno, commit, salt1, salt2, c1, c2 = WAL_FRAME_HEADER.unpack_from(frame)
+            if [salt1, salt2] != pos["salt"]:
+                break
+            s0, s1 = wal_checksum(frame[:8], s0, s1, pos["big_endian"])
+            s0, s1 = wal_checksum(frame[WAL_FRAME_HEADER.size:], s0, s1, pos["big_endian"])
+            if (s0, s1) != (c1, c2):
+                break
+            pending[pgno] = frame[WAL_FRAME_HEADER.size:]
+            offset += frame_size
+            if commit:
+                pages.update(pending)
+                pending = {}
+                page_count = commit
+                new_pos = dict(pos, offset=offset, checksum=[s0, s1])
+    return pages, page_count, new_pos
+
+def parse_wal_segment_name(name: str) -> Optional[tuple]:
+    """<序号>-<YYYYmmdd_HHMMSS>.seg -> (序号, 时间)"""
+    m = re.match(r"^(\d{8})-(\d{8}_\d{6})" + re.escape(WAL_SEGMENT_SUFFIX) + "$", name)
+    return (int(m.group(1)), m.group(2)) if m else None
+
+class WalReplicator:
+    """持续复制 (思路同 Litestream)：以每次完整备份为基础代，定期把数据库变化的页面加密上传为增量段
+
+    每个周期先检查数据库文件与 -wal 是否变化，变化时从上次读到的位置继续读取 -wal 中新提交的帧，
+    把其中的页面作为一个增量段上传到 <存储路径>/wal/<基础备份名>/<序号>-<时间>.seg，开销只与变化量有关。
+    -wal 在两个周期之间被检查点重置 (salt 变化)、数据库不是 WAL 模式或刚开始新的一代时，
+    改为用 SQLite 备份 API 复制一份一致的数据库，与影子库 (最近一次上传后的状态) 逐页比较。
+    只有读取变化的页面时占用任务锁，上传期间备份/还原任务可以正常开始；上传完成时若已开始新的一代则丢弃本次结果。
+    上传成功后才推进读取位置并更新影子库；失败时下个周期重新读取，序号保持连续。状态保存在 /conf，重启后继续当前代。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = None
+        self._cipher = None
+        self._stamp = None
+
+    def _load(self) -> Optional[dict]:
+        if self._state is None and os.path.exists(WAL_STATE_FILE):
+            try:
+                with open(WAL_STATE_FILE, 'r', encoding='utf-8') as f:
+                    self._state = json.load(f)
+            except Exception as e:
+                logging.error(f"加载持续复制状态失败: {e}")
+        return self._state
+
+    def _save(self):
+        tmp_path = WAL_STATE_FILE + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._state, f, ensure_ascii=False)
+        os.replace(tmp_path, WAL_STATE_FILE)
+
+    def start_generation(self, base_name: str, base_db: str, target_cfg: dict):
+        """以刚上传完成的完整备份为基础开始新的一代 (base_db 为该备份中数据库的一致副本，将成为影子库)"""
+        salt = os.urandom(16)
+        cipher = ChunkCipher(load_config().get("encryption_password"), salt)
+        client = make_webdav_client(target_cfg)
+        remote_dir = target_cfg.get('webdav_path', '/')
+        gen_dir = wal_generation_dir(remote_dir, base_name)
+        for path in (f"{remote_dir}/{WAL_REMOTE_DIR}".replace("//", "/"), gen_dir):
+            if not client.exists(path):
+                client.mkdir(path)
+        meta = {
+            "version": 1,
+            "base": base_name,
+            "salt": base64.b64encode(salt).decode(),
+            "encrypted": cipher.encrypted,
+            "check": cipher.chunk_id(b"vw-wal"),
+            "created_at": datetime.datetime.now(TZ_CN).strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        ResilientUploader(client, target_cfg).upload_bytes(
+            json.dumps(meta).encode("utf-8"), f"{gen_dir}/generation.json", atomic=True)
+        with self._lock:
+            os.replace(base_db, WAL_SHADOW_FILE)
+            self._state = {"base": base_name, "target": target_cfg["name"], "seq": 0, "salt": meta["salt"],
+                           "check": meta["check"], "last_shipped": None, "last_error": None}
+            self._cipher = cipher
+            self._stamp = None
+            self._save()
+        logging.info(f"持续复制: 以 {base_name} 为基础开始新的一代 (目标 {target_cfg['name']})")
+
+    def tick(self):
+        """一个复制周期 (由调度器按 wal_interval 调用；备份/还原任务运行期间跳过)"""
+        cfg = load_config()
+        if not cfg.get("wal_replication", False):
+            return
+        # 读取变化时占用任务锁，避免读到还原到一半的 /data；上传较慢 (含重试退避)，放在锁外进行
+        with jobs.exclusive() as acquired:
+            if not acquired:
+                return
+            captured = self._capture(cfg)
+        if captured is not None:
+            self._ship(*captured)
+
+    def _capture(self, cfg: dict) -> Optional[tuple]:
+        """读取影子库之后变化的页面，返回 (状态, 文件戳, 变化信息, 错误)；没有变化时返回 None"""
+        db_path = os.path.join(DATA_DIR, SQLITE_DB_NAME)
+        wal_path = db_path + "-wal"
+        with self._lock:
+            state = self._load()
+            if not state or not os.path.exists(db_path) or not os.path.exists(WAL_SHADOW_FILE):
+                return None
+            stamp = tuple(
+                (st.st_mtime_ns, st.st_size) for st in
+                (os.stat(p) for p in (db_path, wal_path) if os.path.exists(p))
+            )
+            if stamp == self._stamp:
+                return None
+            pos = state.get("wal_pos")
+
+        snapshot = os.path.join(TEMP_DIR, "wal_snapshot.sqlite3")
+        try:
+            target_cfg = next((t for t in get_targets(cfg) if t["name"] == state["target"]), None)
+            if target_cfg is None:
+                raise ValueError(f"目标 {state['target']} 已不存在，等待下一次完整备份开始新的一代")
+            if self._cipher is None:
+                self._cipher = ChunkCipher(cfg.get("encryption_password"), base64.b64decode(state["salt"]))
+            if self._cipher.chunk_id(b"vw-wal") != state["check"]:
+                self._cipher = None
+                raise ValueError("加密密码已修改，等待下一次完整备份开始新的一代")
+
+            change = {"target": target_cfg, "taken_at": datetime.datetime.now(TZ_CN), "resync": False}
+            header = read_wal_header(wal_path)
+            if pos is not None and header is not None and header["salt"] == pos["salt"]:
+                # 只读取上次位置之后新提交的帧
+                change["pages"], change["page_count"], change["pos"] = read_wal_frames(wal_path, pos)
+                change["page_size"] = pos["page_size"]
+            else:
+                # 先记下复制前已提交的位置 (这些帧都包含在随后的副本中)，之后的帧下个周期再读，重复读取的页面不影响结果
+                change["pos"] = read_wal_frames(wal_path, header)[2] if header is not None else None
+                snapshot_sqlite(db_path, snapshot)
+                page_size = read_page_size(snapshot)
+                change.update(page_size=page_size, page_count=os.path.getsize(snapshot) // page_size,
+                              pages=diff_pages(WAL_SHADOW_FILE, snapshot, page_size), resync=True)
+                # 副本改名保留到上传完成后替换影子库，不占用下个周期的副本路径
+                change["snapshot"] = snapshot + ".pending"
+                os.replace(snapshot, change["snapshot"])
+            return state, stamp, change, None
+        except Exception as e:
+            return state, stamp, None, str(e)
+        finally:
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
+
+    def _ship(self, state: dict, stamp: tuple, change: Optional[dict], error: Optional[str]):
+        """上传变化的页面，成功后更新影子库并推进序号与读取位置"""
+        base, seq = state["base"], state["seq"]
+        shipped = None
+        try:
+            if error is None:
+                pages, page_count, page_size = change["pages"], change["page_count"], change["page_size"]
+                if pages or (page_count is not None and page_count * page_size != os.path.getsize(WAL_SHADOW_FILE)):
+                    target_cfg = change["target"]
+                    name = f"{seq:08d}-{change['taken_at'].strftime('%Y%m%d_%H%M%S')}{WAL_SEGMENT_SUFFIX}"
+                    payload = WAL_SEGMENT_HEADER.pack(page_size, page_count) + b"".join(
+                        struct.pack(">I", pgno) + page for pgno, page in sorted(pages.items()))
+                    blob = self._cipher.seal(payload, f"{base}/{seq}".encode())
+                    remote_dir = target_cfg.get('webdav_path', '/')
+                    client = make_webdav_client(target_cfg)
+                    with webdav_timer("wal", "upload"):
+                        ResilientUploader(client, target_cfg).upload_bytes(
+                            blob, f"{wal_generation_dir(remote_dir, base)}/{name}", atomic=True)
+                    shipped = change["taken_at"].strftime("%Y-%m-%d %H:%M:%S")
+                    WAL_SEGMENTS.inc()
+                    WAL_LAST_SHIPPED.set(time.time())
+                    logging.info(f"持续复制: 已上传增量段 {name} ({len(pages)} 个页面, {round(len(blob) / 1024, 1)} KB)")
+        except Exception as e:
+            error = str(e)
+
+        with self._lock:
+            try:
+                if state is not self._state:
+                    # 上传期间完整备份开始了新的一代，本次结果属于旧的一代，影子库与状态都不再更新
+                    logging.info(f"持续复制: {base} 已被新的一代取代，丢弃本周期的结果")
+                    return
+                if error is None:
+                    # 影子库跟随已上传的状态
+                    if change["resync"]:
+                        os.replace(change["snapshot"], WAL_SHADOW_FILE)
+                    elif change["page_count"] is not None:
+                        with open(WAL_SHADOW_FILE, "r+b") as f:
+                            for pgno, page in change["pages"].items():
+                                f.seek((pgno - 1) * change["page_size"])
+                                f.write(page)
+                            f.truncate(change["page_count"] * change["page_size"])
+                    if shipped:
+                        state["seq"] = seq + 1
+                        state["last_shipped"] = shipped
+                    state["wal_pos"] = change["pos"]
+                    self._stamp = stamp
+                elif state.get("last_error") != error:
+                    logging.error(f"持续复制失败: {error}")
+                state["last_error"] = error
+                self._save()
+            finally:
+                if change and change.get("snapshot") and os.path.exists(change["snapshot"]):
+                    os.remove(change["snapshot"])
+
+    def status(self) -> dict:
+        with self._lock:
+            state = dict(self._load() or {})
+        state.pop("salt", None)
+        state.pop("check", None)
+        return state
+
+replicator = WalReplicator()
+
+def find_wal_generation(cfg: dict, base_name: str) -> tuple:
+    """在各目标中查找该备份的增量段目录，返回 (客户端, 目录, 元数据)"""
+    for t in rank_targets(cfg):
+        client = make_webdav_client(t)
+        gen_dir = wal_generation_dir(t.get('webdav_path', '/'), base_name)
+        try:
+            if client.exists(f"{gen_dir}/generation.json"):
+                buf = io.BytesIO()
+                client.download_fileobj(f"{gen_dir}/generation.json", buf)
+                return client, gen_dir, json.loads(buf.getvalue().decode("utf-8"))
+        except Exception as e:
+            logging.warning(f"目标 {t['name']} 不可用: {e}")
+    raise ValueError(f"没有找到 {base_name} 之后的增量段")
+
+def list_wal_segments(client: WebDavClient, gen_dir: str) -> List[tuple]:
+    """返回连续的增量段 [(序号, 时间, 路径)]，遇到缺失的序号时截止"""
+    segments = []
+    for f in client.ls(gen_dir, detail=True):
+        parsed = parse_wal_segment_name(os.path.basename(f['name'].rstrip('/')))
+        if parsed:
+            segments.append((parsed[0], parsed[1], f['name']))
+    segments.sort()
+    for i, seg in enumerate(segments):
+        if seg[0] != i:
+            logging.warning(f"增量段序号不连续 (缺少 {i})，只能恢复到此之前")
+            return segments[:i]
+    return segments
+
+def replay_wal_segments(db_path: str, base_name: str, until: Optional[str] = None) -> dict:
+    """把基础备份之后的增量段按顺序写入 db_path，until 为 "YYYY-MM-DD HH:MM:SS" (None 表示全部)"""
+    cfg = load_config()
+    client, gen_dir, meta = find_wal_generation(cfg, base_name)
+    cipher = ChunkCipher(cfg.get("encryption_password"), base64.b64decode(meta["salt"]))
+    if meta.get("encrypted") != cipher.encrypted or meta.get("check") != cipher.chunk_id(b"vw-wal"):
+        raise ValueError("加密密码与增量段不一致")
+    limit = datetime.datetime.strptime(until, "%Y-%m-%d %H:%M:%S").strftime("%Y%m%d_%H%M%S") if until else None
+    segments = [seg for seg in list_wal_segments(client, gen_dir) if limit is None or seg[1] <= limit]
+    if not os.path.exists(db_path):
+        raise ValueError(f"基础备份中没有 {SQLITE_DB_NAME}")
+
+    # 先把基础备份的 WAL 合并进主文件，之后直接按页写入
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        conn.close()
+    logging.info(f"正在重放 {len(segments)} 个增量段{f' (截止 {until})' if until else ''}...")
+    with open(db_path, "r+b") as f:
+        for seq, _, path in segments:
+            buf = io.BytesIO()
+            client.download_fileobj(path, buf)
+            jobs.progress("replay", len(buf.getvalue()))
+            payload = cipher.open(buf.getvalue(), f"{base_name}/{seq}".encode())
+            page_size, page_count = WAL_SEGMENT_HEADER.unpack_from(payload)
+            pos = WAL_SEGMENT_HEADER.size
+            while pos < len(payload):
+                pgno = struct.unpack_from(">I", payload, pos)[0]
+                f.seek((pgno - 1) * page_size)
+                f.write(payload[pos + 4:pos + 4 + page_size])
+                pos += 4 + page_size
+            f.truncate(page_count * page_size)
+    last = datetime.datetime.strptime(segments[-1][1], "%Y%m%d_%H%M%S").strftime("%Y-%m-%d %H:%M:%S") if segments else None
+    logging.info(f"增量段重放完成，数据库已恢复到 {last or base_name}")
+    return {"segments": len(segments), "until": last}
+
 # --- 调度器设置 ---
 
 scheduler = BackgroundScheduler(timezone=TZ_CN)
 
+def run_scheduled_backup():
+    """定时备份 (正在运行的备份会合并本次触发；其他任务占用时跳过并发送失败通知)"""
+    job, created = jobs.submit("backup", "schedule", perform_backup, wait=True)
+    if not created and (job is None or job.kind != "backup"):
+        reason = f"{job.kind} 任务正在运行" if job is not None else f"等待任务锁超过 {JOB_LOCK_WAIT} 秒"
+        logging.error(f"定时备份未执行: {reason}")
+        send_notifications(f"定时备份未执行: {reason}", success=False)
+
 def schedule_backup_job(config: dict):
     """根据配置更新调度任务"""
     if scheduler.get_job('backup_job'):
@@ -479,7 +4230,7 @@ def schedule_backup_job(config: dict):
     try:
         trigger = CronTrigger.from_crontab(cron_exp, timezone=TZ_CN)
         scheduler.add_job(
-            perform_backup, 
+            run_scheduled_backup, 
             trigger, 
             id='backup_job',
             replace_existing=True
@@ -488,21 +4239,314 @@ def schedule_backup_job(config: dict):
     except ValueError as e:
         logging.error(f"Cron 表达式错误: {cron_exp}, 使用默认值")
         scheduler.add_job(
-            perform_backup, 
+            run_scheduled_backup, 
             CronTrigger(hour=3, minute=0, timezone=TZ_CN), 
             id='backup_job',
             replace_existing=True
         )
 
+def schedule_wal_job(config: dict):
+    """开启持续复制时按 wal_interval 秒运行复制周期"""
+    if scheduler.get_job('wal_job'):
+        scheduler.remove_job('wal_job')
+    if not config.get("wal_replication", False):
+        return
+    interval = max(int(config.get("wal_interval", 10)), 1)
+    scheduler.add_job(replicator.tick, IntervalTrigger(seconds=interval, timezone=TZ_CN), id='wal_job',
+                      max_instances=1, coalesce=True, replace_existing=True)
+    logging.info(f"持续复制已开启，间隔 {interval} 秒")
+
 scheduler.start()
 initial_cfg = load_config()
 schedule_backup_job(initial_cfg)
+schedule_wal_job(initial_cfg)
+
+
+# --- 日志读取 ---
+
+def read_log_tail(lines: int = 100, since: Optional[str] = None) -> List[str]:
+    """从日志末尾向前按块读取，只读取返回所需的部分
+
+    since 为 "YYYY-MM-DD HH:MM:SS" 格式的时间，只返回晚于该时间的日志记录
+    (没有时间戳的续行，如异常堆栈，归属于前一条记录)。
+    """
+    if not os.path.exists(LOG_FILE):
+        return []
+
+    with open(LOG_FILE, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        while pos > 0:
+            step = min(LOG_TAIL_BLOCK, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+            complete = data.split(b"\n")[1:] if pos > 0 else data.split(b"\n")
+            if len(complete) > lines:
+                if since is None:
+                    break
+                # 已读到的最早一条完整记录不晚于 since 时停止
+                stamps = [l[:19].decode('utf-8', 'replace') for l in complete if l[:4].isdigit()]
+                if stamps and stamps[0] <= since:
+                    break
+
+    text = data.decode('utf-8', 'replace')
+    result = text.splitlines()
+    if pos > 0:
+        result = result[1:]  # 第一行可能不完整
+
+    if since is not None:
+        kept = []
+        keep = False
+        for line in result:
+            if line[:4].isdigit():
+                keep = line[:19] > since
+            if keep:
+                kept.append(line)
+        result = kept
+    return result[-lines:]
+
+async def follow_log(request: Request):
+    """以 Server-Sent Events 推送新日志 (处理日志轮转)"""
+    for line in read_log_tail(LOG_STREAM_BACKLOG):
+        yield f"data: {line}\n\n"
+
+    position = None
+    inode = None
+    idle = 0.0
+    while not await request.is_disconnected():
+        try:
+            st = os.stat(LOG_FILE)
+        except FileNotFoundError:
+            st = None
+
+        if st is not None:
+            if position is None:
+                position, inode = st.st_size, st.st_ino
+            elif st.st_ino != inode or st.st_size < position:
+                # 日志已轮转：从新文件开头读取
+                position, inode = 0, st.st_ino
+            if st.st_size > position:
+                with open(LOG_FILE, 'rb') as f:
+                    f.seek(position)
+                    chunk = f.read()
+                # 只推送完整的行
+                end = chunk.rfind(b"\n") + 1
+                position += end
+                for line in chunk[:end].decode('utf-8', 'replace').splitlines():
+                    yield f"data: {line}\n\n"
+                idle = 0.0
+
+        await asyncio.sleep(LOG_STREAM_INTERVAL)
+        idle += LOG_STREAM_INTERVAL
+        if idle >= 15:
+            # 心跳，防止代理断开空闲连接
+            yield ": keep-alive\n\n"
+            idle = 0.0
+
+# --- 上传接收 ---
+
+class UploadTooLarge(ValueError):
+    """上传的文件超过大小上限"""
 
+class UploadIngest:
+    """流式接收上传的备份文件：分块写入临时文件，同时计算 SHA-256 并尽早校验文件头
+
+    文件名由服务端生成，不使用客户端提供的文件名；超过大小上限或文件头不是 Zip/.vwb 时立即中止。
+    内存中只保留一个 STREAM_CHUNK_SIZE 的写缓冲，写盘与哈希在线程池中执行，不阻塞事件循环。
+    check_password 时在收到 .vwb 头部后立即校验加密密码。
+    """
+
+    def __init__(self, prefix: str, limit: int, check_password: bool = False):
+        self.path = os.path.join(TEMP_DIR, f"{prefix}_{secrets.token_hex(8)}.upload")
+        self.limit = limit
+        self.check_password = check_password
+        self.size = 0
+        self.format = None
+        self.sha256 = hashlib.sha256()
+        self._head = b""
+        self._head_checked = False
+        self._buffer = bytearray()
+        self._file = None
+
+    async def open(self):
+        """在线程池中创建临时文件 (构造后、写入前调用)"""
+        self._file = await asyncio.to_thread(open, self.path, "wb")
+
+    async def _check_head(self):
+        head = self._head
+        if self.format is None and len(head) >= 4:
+            if head[:4] == ZIP_LOCAL_MAGIC:
+                self.format = "zip"
+            elif head[:4] == ARCHIVE_MAGIC:
+                self.format = "vwb"
+            else:
+                raise ValueError("不是 Zip 或 .vwb 备份文件")
+        if self.format == "zip" and len(head) >= ZIP_LOCAL_HEADER.size:
+            method = ZIP_LOCAL_HEADER.unpack(head[:ZIP_LOCAL_HEADER.size])[3]
+            if method not in (pyzipper.ZIP_STORED, pyzipper.ZIP_DEFLATED, pyzipper.ZIP_BZIP2, pyzipper.ZIP_LZMA, 99):
+                raise ValueError(f"Zip 使用了不支持的压缩方式 ({method})")
+            self._head_checked = True
+        elif self.format == "vwb" and len(head) >= ARCHIVE_HEADER.size:
+            if self.check_password:
+                # 解析头部并校验密码 (scrypt 较耗时，放到线程池)
+                password = load_config().get("encryption_password")
+                await asyncio.to_thread(ArchiveReader, io.BytesIO(head), password)
+            elif ARCHIVE_HEADER.unpack(head)[1] > ARCHIVE_VERSION:
+                raise ValueError("归档版本过新，请升级后再处理")
+            self._head_checked = True
+
+    def _write(self, data: bytes):
+        self.sha256.update(data)
+        self._file.write(data)
+
+    async def _flush(self):
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            await asyncio.to_thread(self._write, data)
+
+    async def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise UploadTooLarge(f"文件超过大小上限 ({round(self.limit / 1024 / 1024)} MB)")
+        if not self._head_checked:
+            need = max(ZIP_LOCAL_HEADER.size, ARCHIVE_HEADER.size) - len(self._head)
+            self._head += data[:need]
+            await self._check_head()
+        self._buffer += data
+        if len(self._buffer) >= STREAM_CHUNK_SIZE:
+            await self._flush()
+
+    async def finish(self):
+        """写完剩余数据；Zip 只读取末尾的中央目录确认文件完整"""
+        await self._flush()
+        await asyncio.to_thread(self._file.close)
+        if not self._head_checked:
+            raise ValueError("文件过小，不是有效的备份文件")
+        if self.format == "zip" and not await asyncio.to_thread(pyzipper.is_zipfile, self.path):
+            raise ValueError("Zip 文件不完整 (找不到中央目录)")
+
+    def _discard(self):
+        if self._file is not None:
+            self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def discard(self):
+        """删除不完整的临时文件"""
+        await asyncio.to_thread(self._discard)
+
+async def receive_upload(request: Request, prefix: str, check_password: bool = False) -> UploadIngest:
+    """从 multipart/form-data 请求中流式接收名为 file 的文件字段
+
+    大小上限为 upload_max_mb (0 表示不限)，且不超过 TEMP_DIR 的剩余空间；
+    请求声明的 Content-Length 超限时不读取请求体直接拒绝。
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or not params.get(b"boundary"):
+        raise ValueError("需要 multipart/form-data 上传")
+    limit = shutil.disk_usage(TEMP_DIR).free
+    max_mb = int(load_config().get("upload_max_mb", 0))
+    if max_mb > 0:
+        limit = min(limit, max_mb * 1024 * 1024)
+    length = int(request.headers.get("content-length") or 0)
+    if length > limit + UPLOAD_FORM_OVERHEAD:
+        raise UploadTooLarge(f"文件超过大小上限 ({round(limit / 1024 / 1024)} MB)")
+
+    ingest = UploadIngest(prefix, limit, check_password)
+    state = {"headers": {}, "field": b"", "value": b"", "in_file": False, "received": False, "filename": None}
+    pending = []
+
+    def on_part_begin():
+        state["headers"] = {}
+
+    def on_header_field(data: bytes, start: int, end: int):
+        state["field"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        state["value"] += data[start:end]
+
+    def on_header_end():
+        state["headers"][state["field"].lower()] = state["value"]
+        state["field"] = state["value"] = b""
+
+    def on_headers_finished():
+        _, options = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        state["in_file"] = options.get(b"name") == b"file" and b"filename" in options
+        if state["in_file"]:
+            if state["received"]:
+                raise ValueError("一次只能上传一个文件")
+            state["filename"] = os.path.basename(options[b"filename"].decode("utf-8", "replace"))
+
+    def on_part_data(data: bytes, start: int, end: int):
+        if state["in_file"]:
+            pending.append(bytes(data[start:end]))
+
+    def on_part_end():
+        if state["in_file"]:
+            state["received"] = True
+            state["in_file"] = False
+
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin, "on_header_field": on_header_field, "on_header_value": on_header_value,
+        "on_header_end": on_header_end, "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data, "on_part_end": on_part_end,
+    })
+    try:
+        await ingest.open()
+        async for chunk in request.stream():
+            try:
+                parser.write(chunk)
+            except MultipartParseError as e:
+                raise ValueError(f"multipart 请求体格式错误: {e}") from e
+            for piece in pending:
+                await ingest.write(piece)
+            pending.clear()
+        try:
+            parser.finalize()
+        except MultipartParseError as e:
+            raise ValueError(f"multipart 请求体格式错误: {e}") from e
+        if not state["received"]:
+            raise ValueError("请求中没有名为 file 的文件")
+        await ingest.finish()
+    except BaseException:
+        # 任何错误 (包括格式错误、超限与客户端断开) 都删除不完整的临时文件
+        await asyncio.shield(ingest.discard())
+        raise
+    logging.info(
+        f"已接收上传的备份文件 {state['filename']}: {round(ingest.size / 1024 / 1024, 2)} MB, "
+        f"格式 {ingest.format}, SHA-256 {ingest.sha256.hexdigest()}"
+    )
+    return ingest
+
+async def receive_upload_response(request: Request, prefix: str, check_password: bool = False):
+    """接收上传并把错误转换为 HTTP 响应，返回 (UploadIngest, None) 或 (None, 错误响应)"""
+    try:
+        return await receive_upload(request, prefix, check_password), None
+    except UploadTooLarge as e:
+        return None, JSONResponse(status_code=413, content={"error": str(e)})
+    except ClientDisconnect:
+        logging.warning("上传过程中客户端断开连接，已丢弃不完整的文件")
+        return None, JSONResponse(status_code=400, content={"error": "Upload interrupted."})
+    except ValueError as e:
+        logging.warning(f"拒绝上传的文件: {e}")
+        return None, JSONResponse(status_code=400, content={"error": str(e)})
+    except Exception as e:
+        return None, JSONResponse(status_code=500, content={"error": str(e)})
 
 # --- API 路由定义 ---
+# 会读写文件、访问 WebDAV 或等待锁的路由定义为普通函数，由 FastAPI 放到线程池执行，
+# 不阻塞事件循环；只做内存操作的路由保持 async。提交任务可能要等待持续复制周期释放任务锁，同样不在事件循环上执行。
+
+def job_conflict(job: Optional[Job]) -> JSONResponse:
+    """已有任务运行时的 409 响应，说明正在运行的任务类型"""
+    message = f"A {job.kind} job is running." if job is not None else "WAL replication is running, try again later."
+    return JSONResponse(status_code=409, content={"error": message})
 
 @app.get("/", response_class=HTMLResponse)
-async def read_root():
+def read_root():
     index_path = "/app/static/index.html"
     if not os.path.exists(index_path):
         index_path = "app/static/index.html"
@@ -517,82 +4561,204 @@ async def auth_check():
     return {"status": "authenticated"}
 
 @app.get("/api/config", dependencies=[Depends(check_auth)])
-async def get_config():
+def get_config():
     return load_config()
 
 @app.post("/api/config", dependencies=[Depends(check_auth)])
-async def update_config(config: dict):
-    save_config(config)
+def update_config(config: dict):
+    try:
+        save_config(config)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
     return {"status": "success", "message": "Configuration saved."}
 
 @app.post("/api/backup/now", dependencies=[Depends(check_auth)])
-async def trigger_backup_manual(background_tasks: BackgroundTasks):
-    background_tasks.add_task(perform_backup)
-    return {"status": "started", "message": "Backup started in background."}
+def trigger_backup_manual(force: bool = False):
+    job, created = jobs.submit("backup", "manual", perform_backup, force)
+    if not created and (job is None or job.kind != "backup"):
+        return job_conflict(job)
+    if not created:
+        return {"status": "merged", "job_id": job.id, "message": "Merged into the running backup."}
+    return {"status": "started", "job_id": job.id, "message": "Backup started in background."}
+
+@app.get("/api/jobs", dependencies=[Depends(check_auth)])
+async def list_jobs():
+    return jobs.snapshot()
 
 @app.get("/api/backups", dependencies=[Depends(check_auth)])
-async def list_backups():
+def list_backups(background_tasks: BackgroundTasks, page: int = 1, page_size: int = 50, refresh: bool = False):
     cfg = load_config()
-    if not cfg.get("webdav_url"):
+    targets = get_targets(cfg)
+    if not targets:
         return JSONResponse(status_code=400, content={"error": "WebDAV not configured"})
     
     try:
-        client = WebDavClient(
-            cfg["webdav_url"], 
-            auth=(cfg.get("webdav_user", ""), cfg.get("webdav_password", ""))
-        )
-        files = client.ls(cfg.get('webdav_path', '/'), detail=True)
-        
-        backup_files = []
-        for f in files:
-            # 过滤目录，只显示包含 vw_backup_ 的文件
-            if f.get('type') != 'directory' and "vw_backup_" in f.get('name', ''):
-                clean_name = os.path.basename(f['name'])
-                
-                # 健壮的大小获取
-                raw_size = f.get('size')
-                if raw_size is None:
-                    raw_size = f.get('content_length')
-                try:
-                    size_bytes = int(raw_size) if raw_size is not None else 0
-                except:
-                    size_bytes = 0
-                size_mb = round(size_bytes / 1024 / 1024, 2)
-                
-                backup_files.append({
-                    "name": clean_name,
-                    "size": f"{size_mb} MB",
-                    "last_modified": f.get('last_modified', '')
-                })
-        
-        return sorted(backup_files, key=lambda x: x['name'], reverse=True)
+        metas = [catalog.meta(catalog_target(t)) for t in targets]
+        if refresh or all(m["synced_at"] == 0 for m in metas):
+            # 强制同步或首次加载：同步对账后返回
+            backups = refresh_all_catalogs(force=True)
+        else:
+            # 直接读取索引，过期时在后台刷新
+            ttl = int(cfg.get("catalog_ttl", 300))
+            if any(catalog.is_stale(catalog_target(t), ttl) for t in targets):
+                background_tasks.add_task(refresh_catalog_quietly)
+            backups = merge_catalog_entries(targets)
+
+        page = max(page, 1)
+        page_size = min(max(page_size, 1), 500)
+        items = []
+        for b in backups[(page - 1) * page_size: page * page_size]:
+            items.append({
+                "name": b["name"],
+                "size": f"{round(b.get('size', 0) / 1024 / 1024, 2)} MB",
+                "size_bytes": b.get("size", 0),
+                "last_modified": b.get("last_modified", ""),
+                "timestamp": b.get("timestamp", ""),
+                "format": b.get("format", "zip"),
+                "checksum": b.get("checksum"),
+                "targets": b.get("targets", []),
+                "verification": b.get("verification"),
+            })
+        return {
+            "items": items,
+            "total": len(backups),
+            "page": page,
+            "page_size": page_size,
+            "synced_at": min(catalog.meta(catalog_target(t))["synced_at"] for t in targets),
+        }
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+@app.get("/api/targets", dependencies=[Depends(check_auth)])
+def list_targets():
+    """各 WebDAV 目标的状态 (不返回密码)"""
+    result = []
+    for t in get_targets(load_config()):
+        meta = catalog.meta(catalog_target(t))
+        result.append({
+            "name": t["name"],
+            "webdav_url": t["webdav_url"],
+            "webdav_path": t.get("webdav_path", "/"),
+            "max_backups": t.get("max_backups", 10),
+            "backups": len(catalog.entries(catalog_target(t))),
+            "latency": meta["latency"],
+            "synced_at": meta["synced_at"],
+            "last_upload": meta["last_upload"],
+        })
+    return result
+
 @app.post("/api/restore", dependencies=[Depends(check_auth)])
-async def restore_from_cloud(file_name: str, background_tasks: BackgroundTasks):
-    background_tasks.add_task(download_and_restore, file_name)
-    return {"status": "started", "message": f"Restoring {file_name} in background..."}
+def restore_from_cloud(file_name: str, until: Optional[str] = None):
+    if until and until != "latest":
+        try:
+            datetime.datetime.strptime(until, "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return JSONResponse(status_code=400, content={"error": "until must be 'latest' or 'YYYY-MM-DD HH:MM:SS'"})
+    job, created = jobs.submit("restore", "manual", download_and_restore, file_name, until)
+    if not created:
+        return job_conflict(job)
+    return {"status": "started", "job_id": job.id, "message": f"Restoring {file_name} in background..."}
+
+@app.get("/api/backups/entries", dependencies=[Depends(check_auth)])
+def backup_entries(file_name: str):
+    """列出备份中的文件 (用于按文件还原)"""
+    try:
+        return list_backup_entries(os.path.basename(file_name))
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+@app.post("/api/restore/files", dependencies=[Depends(check_auth)])
+def restore_files_from_cloud(request: dict):
+    file_name = os.path.basename(str(request.get("file_name") or ""))
+    paths = request.get("paths")
+    if not file_name or not isinstance(paths, list) or not paths or not all(isinstance(p, str) for p in paths):
+        return JSONResponse(status_code=400, content={"error": "file_name and a non-empty list of paths are required"})
+    job, created = jobs.submit("restore", "manual", restore_selected_files, file_name, paths)
+    if not created:
+        return job_conflict(job)
+    return {"status": "started", "job_id": job.id, "message": f"Restoring {len(paths)} path(s) from {file_name} in background..."}
+
+@app.post("/api/verify", dependencies=[Depends(check_auth)])
+def verify_from_cloud(file_name: str, target: Optional[str] = None):
+    job, created = jobs.submit("verify", "manual", run_verify, file_name, target)
+    if not created:
+        return job_conflict(job)
+    return {"status": "started", "job_id": job.id, "message": f"Verifying {file_name} in background..."}
+
+@app.post("/api/upload_verify", dependencies=[Depends(check_auth)])
+async def upload_and_verify(request: Request):
+    running = jobs.current
+    if running is not None:
+        return job_conflict(running)
+    upload, error = await receive_upload_response(request, "verify")
+    if error:
+        return error
+    job, created = await run_in_threadpool(jobs.submit, "verify", "upload", run_verify, None, None, upload.path)
+    if not created:
+        os.remove(upload.path)
+        return job_conflict(job)
+    return {"status": "started", "job_id": job.id, "sha256": upload.sha256.hexdigest(), "size": upload.size,
+            "message": "File uploaded. Verification starting in background..."}
 
 @app.post("/api/upload_restore", dependencies=[Depends(check_auth)])
-async def upload_and_restore(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
-    local_path = os.path.join(TEMP_DIR, file.filename)
+async def upload_and_restore(request: Request):
+    running = jobs.current
+    if running is not None:
+        return job_conflict(running)
+    upload, error = await receive_upload_response(request, "restore", check_password=True)
+    if error:
+        return error
+    job, created = await run_in_threadpool(jobs.submit, "restore", "upload", process_restore_file, upload.path)
+    if not created:
+        os.remove(upload.path)
+        return job_conflict(job)
+    return {"status": "started", "job_id": job.id, "sha256": upload.sha256.hexdigest(), "size": upload.size,
+            "message": "File uploaded. Restore starting in background..."}
+
+@app.get("/api/wal", dependencies=[Depends(check_auth)])
+def wal_status():
+    return {"enabled": bool(load_config().get("wal_replication", False)), **replicator.status()}
+
+@app.get("/api/wal/segments", dependencies=[Depends(check_auth)])
+def wal_segments(file_name: str):
+    """该备份之后可用于时间点还原的增量段范围"""
     try:
-        with open(local_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        background_tasks.add_task(process_restore_file, local_path)
-        return {"status": "started", "message": "File uploaded. Restore starting in background..."}
+        client, gen_dir, meta = find_wal_generation(load_config(), file_name)
+        segments = list_wal_segments(client, gen_dir)
+    except ValueError:
+        return {"base": file_name, "segments": 0, "first": None, "last": None}
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
+    fmt = lambda ts: datetime.datetime.strptime(ts, "%Y%m%d_%H%M%S").strftime("%Y-%m-%d %H:%M:%S")
+    return {
+        "base": file_name,
+        "created_at": meta.get("created_at"),
+        "segments": len(segments),
+        "first": fmt(segments[0][1]) if segments else None,
+        "last": fmt(segments[-1][1]) if segments else None,
+    }
+
+@app.get("/metrics", dependencies=[Depends(check_auth)])
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 @app.get("/api/logs", dependencies=[Depends(check_auth)])
-async def get_logs():
-    if os.path.exists(LOG_FILE):
-        try:
-            with open(LOG_FILE, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                return {"logs": "".join(lines[-100:])}
-        except:
-            pass
-    return {"logs": "No logs yet."}
+def get_logs(lines: int = 100, since: Optional[str] = None):
+    lines = min(max(lines, 1), 5000)
+    try:
+        tail = read_log_tail(lines, since)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    if not tail and since is None:
+        return {"logs": "No logs yet."}
+    return {"logs": "\n".join(tail) + ("\n" if tail else "")}
+
+@app.get("/api/logs/stream", dependencies=[Depends(check_auth)])
+async def stream_logs(request: Request):
+    return StreamingResponse(
+        follow_log(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
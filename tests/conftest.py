@@ -0,0 +1,127 @@
+"""测试环境: 临时的 /data、/conf 与工作目录，supervisorctl 桩脚本，以及 bench 中的进程内 WebDAV 服务器
+
+app.main 在导入时读取目录环境变量，因此必须在导入之前设置好。
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="vw-test-")
+PATHS = {name: os.path.join(WORKDIR, name) for name in ("data", "conf", "work", "dav", "bin")}
+for _path in PATHS.values():
+    os.makedirs(_path, exist_ok=True)
+
+# supervisorctl 桩脚本: 停止/启动立即成功
+_stub = os.path.join(PATHS["bin"], "supervisorctl")
+with open(_stub, "w") as f:
+    f.write("#!/bin/sh\nexit 0\n")
+os.chmod(_stub, 0o755)
+
+os.environ.update({
+    "DATA_FOLDER": PATHS["data"],
+    "BACKUP_CONF_DIR": PATHS["conf"],
+    "BACKUP_TEMP_DIR": PATHS["work"],
+    "PATH": PATHS["bin"] + os.pathsep + os.environ.get("PATH", ""),
+})
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "bench"))
+
+from app import main as app_main  # noqa: E402
+import benchmark  # noqa: E402
+
+app_main.logging.getLogger().removeHandler(app_main.console_handler)
+app_main.scheduler.remove_all_jobs()
+
+def pytest_sessionfinish(session, exitstatus):
+    app_main.scheduler.shutdown(wait=False)
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+@pytest.fixture(scope="session")
+def main():
+    return app_main
+
+@pytest.fixture(scope="session")
+def dav_url():
+    server, url = benchmark.start_webdav_server(PATHS["dav"])
+    yield url
+    server.shutdown()
+
+@pytest.fixture
+def api(main):
+    """带管理员认证的 API 客户端 (不触发应用的启动事件)"""
+    from fastapi.testclient import TestClient
+    client = TestClient(main.app)
+    client.auth = (main.ADMIN_USER, main.ADMIN_PASS)
+    return client
+
+@pytest.fixture
+def vault(main, dav_url, request):
+    """生成一份小规模的 Vaultwarden /data，配置指向 WebDAV 中该测试独立的目录，返回配置字典"""
+    shutil.rmtree(main.TEMP_DIR, ignore_errors=True)
+    os.makedirs(main.TEMP_DIR)
+    benchmark.generate_vault(main.DATA_DIR, 200, attachments=5, attachment_kb=64, icons=10, seed=1)
+    remote_dir = f"/{request.node.name}"
+    os.makedirs(os.path.join(PATHS["dav"], remote_dir.lstrip("/")), exist_ok=True)
+    main.save_config({
+        "webdav_url": dav_url,
+        "webdav_path": remote_dir,
+        "encryption_password": "test-password",
+        "max_backups": 5,
+        "vaultwarden_url": dav_url.rstrip("/"),
+        "restore_health_timeout": 10,
+    })
+    return main.load_config()
+
+def configure(main, **overrides) -> dict:
+    """在当前配置上覆盖若干项"""
+    main.save_config({**main.load_config(), **overrides})
+    return main.load_config()
+
+def run_job(main, kind: str, func, *args):
+    """同步执行一个任务并返回其记录"""
+    job, created = main.jobs.submit(kind, "test", func, *args, wait=True)
+    assert created
+    return job
+
+def change_after_restart(main, monkeypatch):
+    """服务恢复后立即改写、删除和新增文件 (模拟上传期间 Vaultwarden 的写入)"""
+    original = main.start_service
+
+    def start_and_write():
+        original()
+        attachments = sorted(p for p in data_digest(main.DATA_DIR) if p.startswith("attachments/"))
+        with open(os.path.join(main.DATA_DIR, "config.json"), "w") as f:
+            f.write('{"rewritten": true}')
+        os.remove(os.path.join(main.DATA_DIR, attachments[0]))
+        with open(os.path.join(main.DATA_DIR, "attachments", "new-upload"), "wb") as f:
+            f.write(b"x" * 1000)
+
+    monkeypatch.setattr(main, "start_service", start_and_write)
+
+def data_digest(data_dir: str) -> dict:
+    """{相对路径: SHA-256}；db.sqlite3 记录各表行数 (快照复制后文件字节可能不同)，不含附属文件与备份/还原工作目录"""
+    result = {}
+    for root, dirs, files in os.walk(data_dir):
+        dirs[:] = [d for d in dirs if d not in app_main.DATA_WORK_DIRS]
+        for name in files:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, data_dir)
+            if rel.startswith(app_main.SQLITE_DB_NAME + "-"):
+                continue
+            if rel == app_main.SQLITE_DB_NAME:
+                conn = sqlite3.connect(path)
+                try:
+                    tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+                    result[rel] = {t: conn.execute(f'SELECT count(*) FROM "{t}"').fetchone()[0] for t in sorted(tables)}
+                finally:
+                    conn.close()
+                continue
+            with open(path, "rb") as f:
+                result[rel] = hashlib.sha256(f.read()).hexdigest()
+    return result
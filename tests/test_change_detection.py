@@ -0,0 +1,71 @@
+"""变更检测: /data 与上次成功备份一致时跳过，force 与数据、目标的变化都会重新备份"""
+import os
+import sqlite3
+import time
+
+import pytest
+
+from conftest import PATHS, configure, run_job
+
+def remote_backups(vault) -> list:
+    path = os.path.join(PATHS["dav"], vault["webdav_path"].strip("/"))
+    return sorted(n for n in os.listdir(path) if n.startswith("vw_backup_"))
+
+@pytest.fixture
+def backed_up(main, vault):
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "success", job.error
+    time.sleep(1.1)  # 备份名精确到秒
+    return remote_backups(vault)
+
+def test_unchanged_data_is_skipped(main, vault, backed_up):
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "skipped"
+    assert [p["name"] for p in job.phases] == ["retention"]
+    assert remote_backups(vault) == backed_up
+
+def test_force_backs_up_unchanged_data(main, vault, backed_up, api):
+    job = run_job(main, "backup", main.perform_backup, True)
+    assert job.status == "success", job.error
+    assert len(remote_backups(vault)) == 2
+
+    time.sleep(1.1)
+    resp = api.post("/api/backup/now", params={"force": "true"})
+    assert resp.status_code == 200 and resp.json()["status"] == "started"
+    while main.jobs.current is not None:
+        time.sleep(0.05)
+    assert main.jobs.history[0].status == "success"
+    assert len(remote_backups(vault)) == 3
+
+@pytest.mark.parametrize("change", ["attachment", "database", "online-database"])
+def test_changes_trigger_backup(main, vault, backed_up, change):
+    if change == "attachment":
+        with open(os.path.join(main.DATA_DIR, "attachments", "new-file"), "wb") as f:
+            f.write(b"x")
+    else:
+        if change == "online-database":
+            configure(main, backup_mode="online")
+            # 在线模式下提交可能只写入 -wal，主文件的大小与 mtime 不变
+            conn = sqlite3.connect(os.path.join(main.DATA_DIR, main.SQLITE_DB_NAME))
+            conn.execute("PRAGMA wal_autocheckpoint=0")
+        else:
+            conn = sqlite3.connect(os.path.join(main.DATA_DIR, main.SQLITE_DB_NAME))
+        conn.execute("INSERT INTO ciphers (uuid, data) VALUES ('changed', 'x')")
+        conn.commit()
+        conn.close()
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "success", job.error
+    assert len(remote_backups(vault)) == 2
+
+def test_missing_remote_backup_triggers_backup(main, vault, backed_up):
+    os.remove(os.path.join(PATHS["dav"], vault["webdav_path"].strip("/"), backed_up[0]))
+    main.refresh_catalog(force=True)
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "success", job.error
+    assert len(remote_backups(vault)) == 1
+
+def test_format_change_triggers_backup(main, vault, backed_up):
+    configure(main, backup_format="vwb")
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "success", job.error
+    assert remote_backups(vault)[-1].endswith(main.ARCHIVE_SUFFIX)
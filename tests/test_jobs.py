@@ -0,0 +1,96 @@
+"""任务引擎: 同一时间只运行一个任务、备份触发合并、冲突返回 409，以及持续复制占用任务锁时的等待与超时"""
+import threading
+import time
+
+import pytest
+
+@pytest.fixture
+def blocker(main):
+    """启动一个阻塞的备份任务，测试结束时放行"""
+    release = threading.Event()
+    job, created = main.jobs.submit("backup", "test", release.wait)
+    assert created
+    yield job
+    release.set()
+    deadline = time.monotonic() + 5
+    while main.jobs.current is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+def test_backup_trigger_merges_into_running_backup(main, blocker, api):
+    job, created = main.jobs.submit("backup", "schedule", pytest.fail)
+    assert not created and job is blocker and blocker.merged == 1
+
+    resp = api.post("/api/backup/now")
+    assert resp.status_code == 200 and resp.json()["status"] == "merged"
+    assert blocker.merged == 2
+
+def test_conflicting_job_is_rejected_with_kind(main, blocker, api):
+    job, created = main.jobs.submit("restore", "manual", pytest.fail)
+    assert not created and job is blocker and blocker.merged == 0
+
+    resp = api.post("/api/restore", params={"file_name": "vw_backup_20240101_000000.zip"})
+    assert resp.status_code == 409
+    assert resp.json()["error"] == "A backup job is running."
+
+def test_concurrent_submits_start_one_job(main, blocker):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(main.jobs.submit("restore", "test", pytest.fail)))
+               for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [created for _, created in results] == [False] * 20
+
+def test_concurrent_submits_on_idle_engine(main):
+    release = threading.Event()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(main.jobs.submit("backup", "test", release.wait)))
+               for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    created = [job for job, new in results if new]
+    assert len(created) == 1
+    assert created[0].merged == 19
+    release.set()
+    while main.jobs.current is not None:
+        time.sleep(0.01)
+    assert main.jobs.history[0] is created[0] and created[0].status == "success"
+
+def test_failed_job_releases_lock(main):
+    def boom():
+        raise RuntimeError("boom")
+
+    job, created = main.jobs.submit("verify", "test", boom, wait=True)
+    assert created and job.status == "failed" and "boom" in job.error
+    job, created = main.jobs.submit("verify", "test", lambda: None, wait=True)
+    assert created and job.status == "success"
+
+def test_submit_waits_for_replication_cycle(main):
+    held = threading.Event()
+
+    def cycle():
+        with main.jobs.exclusive() as acquired:
+            assert acquired
+            held.set()
+            time.sleep(0.3)
+
+    t = threading.Thread(target=cycle)
+    t.start()
+    held.wait()
+    started = time.monotonic()
+    job, created = main.jobs.submit("verify", "test", lambda: None, wait=True)
+    t.join()
+    assert created and job.status == "success"
+    assert time.monotonic() - started >= 0.2
+
+def test_submit_times_out_while_replication_holds_lock(main, monkeypatch, api):
+    monkeypatch.setattr(main, "JOB_LOCK_WAIT", 0.3)
+    with main.jobs.exclusive() as acquired:
+        assert acquired
+        assert main.jobs.submit("verify", "test", pytest.fail) == (None, False)
+        resp = api.post("/api/restore", params={"file_name": "vw_backup_20240101_000000.zip"})
+    assert resp.status_code == 409
+    assert "WAL replication" in resp.json()["error"]
@@ -0,0 +1,156 @@
+"""分段下载: 按 Range 并发下载、单段中断后从已写入的位置续传、任务失败后跳过已完成的段，以及回退为单连接下载"""
+import hashlib
+import os
+import shutil
+import threading
+
+import pytest
+
+import benchmark
+from conftest import PATHS
+
+MB = 1024 * 1024
+
+class FaultyRangeHandler(benchmark.WebDavHandler):
+    """记录 GET/HEAD 请求的 Range，并可注入失败: 指定序号的 GET 只发送一半数据后断开，
+    HEAD 返回错误或不带 Content-Length，或忽略 Range 返回整个文件"""
+    requests = []
+    fail_gets = set()
+    head_status = None
+    head_without_length = False
+    ignore_range = False
+
+    def do_GET(self):
+        self.requests.append((self.command, self.headers.get("Range")))
+        if self.command == "HEAD" and self.head_status:
+            return self._send(self.head_status)
+        if self.ignore_range and "Range" in self.headers:
+            del self.headers["Range"]
+        gets = sum(method == "GET" for method, _ in self.requests)
+        if self.command == "GET" and gets in self.fail_gets:
+            return self._send_truncated()
+        if self.command == "HEAD" and self.head_without_length:
+            self.send_response(200)
+            self.end_headers()
+            return
+        super().do_GET()
+
+    do_HEAD = do_GET
+
+    def _send_truncated(self):
+        path = self._fs_path(self.path)
+        first, _, last = self.headers["Range"][6:].partition("-")
+        start, end = int(first), int(last)
+        self.send_response(206)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Content-Range", f"bytes {start}-{end}/{os.path.getsize(path)}")
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            self.wfile.write(f.read((end - start + 1) // 2))
+        self.close_connection = True
+
+@pytest.fixture(scope="module")
+def range_url():
+    root = os.path.join(PATHS["dav"], "ranged")
+    os.makedirs(root, exist_ok=True)
+    handler = type("Handler", (FaultyRangeHandler,), {"root": os.path.realpath(root)})
+    server = benchmark.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/", root
+    server.shutdown()
+
+@pytest.fixture
+def server(range_url, main, monkeypatch):
+    FaultyRangeHandler.requests.clear()
+    FaultyRangeHandler.fail_gets = set()
+    for attr in ("head_status", "head_without_length", "ignore_range"):
+        monkeypatch.setattr(FaultyRangeHandler, attr, FaultyRangeHandler.__dict__[attr])
+    monkeypatch.setattr(main.time, "sleep", lambda seconds: None)
+    shutil.rmtree(main.TEMP_DIR, ignore_errors=True)
+    os.makedirs(main.TEMP_DIR)
+    return range_url
+
+def make_downloader(main, url: str, **overrides):
+    cfg = {"webdav_url": url, "download_segment_mb": 1, "download_workers": 1, "download_retries": 2, **overrides}
+    return main.RangedDownloader(main.make_webdav_client(cfg), cfg)
+
+def write_remote(root: str, size: int) -> tuple:
+    data = os.urandom(size)
+    with open(os.path.join(root, "backup.zip"), "wb") as f:
+        f.write(data)
+    return data, {"size": size, "checksum": hashlib.sha256(data).hexdigest()}
+
+def read_local(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def ranges() -> list:
+    return [r for method, r in FaultyRangeHandler.requests if method == "GET"]
+
+def leftovers(main, local: str) -> list:
+    return [p for p in (local + main.UPLOAD_TEMP_SUFFIX, local + main.DOWNLOAD_STATE_SUFFIX) if os.path.exists(p)]
+
+def test_download_in_segments(main, server):
+    url, root = server
+    data, expected = write_remote(root, int(3.5 * MB))
+    local = os.path.join(main.TEMP_DIR, "download.zip")
+    make_downloader(main, url, download_workers=3).download("backup.zip", local, expected)
+    assert read_local(local) == data
+    assert sorted(ranges()) == [f"bytes={i * MB}-{min((i + 1) * MB, len(data)) - 1}" for i in range(4)]
+    assert leftovers(main, local) == []
+
+def test_interrupted_segment_resumes_from_written_offset(main, server):
+    url, root = server
+    data, expected = write_remote(root, 8 * MB)
+    FaultyRangeHandler.fail_gets = {2}
+    local = os.path.join(main.TEMP_DIR, "download.zip")
+    downloader = make_downloader(main, url, download_segment_mb=4)
+    downloader.download("backup.zip", local, expected)
+    assert read_local(local) == data
+    # 第二段只收到一半，重试时从已写入的位置开始
+    assert ranges() == [f"bytes=0-{4 * MB - 1}", f"bytes={4 * MB}-{8 * MB - 1}", f"bytes={6 * MB}-{8 * MB - 1}"]
+    assert downloader.retry_count == 1
+
+def test_failed_download_skips_completed_segments(main, server):
+    url, root = server
+    data, expected = write_remote(root, 4 * MB)
+    FaultyRangeHandler.fail_gets = {4}
+    local = os.path.join(main.TEMP_DIR, "download.zip")
+    with pytest.raises((IOError, main.httpx.HTTPError)):
+        make_downloader(main, url, download_retries=0).download("backup.zip", local, expected)
+    assert not os.path.exists(local)
+    assert len(leftovers(main, local)) == 2
+
+    FaultyRangeHandler.requests.clear()
+    make_downloader(main, url).download("backup.zip", local, expected)
+    assert read_local(local) == data
+    # 前三段已完成，只重新下载最后一段
+    assert ranges() == [f"bytes={3 * MB}-{4 * MB - 1}"]
+    assert leftovers(main, local) == []
+
+def test_checksum_mismatch_discards_download(main, server):
+    url, root = server
+    write_remote(root, MB)
+    local = os.path.join(main.TEMP_DIR, "download.zip")
+    with pytest.raises(IOError, match="SHA-256"):
+        make_downloader(main, url).download("backup.zip", local, {"size": MB, "checksum": "0" * 64})
+    assert not os.path.exists(local)
+    assert leftovers(main, local) == []
+
+@pytest.mark.parametrize("fault, value", [
+    ("head_status", 405),
+    ("head_without_length", True),
+    ("ignore_range", True),
+], ids=["head-fails", "no-content-length", "range-ignored"])
+def test_falls_back_to_single_connection(main, server, monkeypatch, fault, value):
+    url, root = server
+    data, expected = write_remote(root, int(2.5 * MB))
+    monkeypatch.setattr(FaultyRangeHandler, fault, value)
+    local = os.path.join(main.TEMP_DIR, "download.zip")
+    make_downloader(main, url, download_workers=3).download("backup.zip", local, expected)
+    assert read_local(local) == data
+    # 单连接下载不带 Range 请求整个文件
+    assert ranges()[-1] is None
+    assert leftovers(main, local) == []
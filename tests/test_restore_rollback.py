@@ -0,0 +1,104 @@
+"""分阶段还原: 目录交换失败时撤销、健康检查失败时换回，以及换回失败时保持服务停止"""
+import os
+
+import pytest
+
+from conftest import configure, data_digest, run_job
+
+@pytest.fixture
+def services(main, monkeypatch):
+    """记录停止/启动服务的调用顺序"""
+    calls = []
+    monkeypatch.setattr(main, "stop_service", lambda: calls.append("stop"))
+    monkeypatch.setattr(main, "start_service", lambda: calls.append("start"))
+    return calls
+
+@pytest.fixture
+def notifications(main, monkeypatch):
+    sent = []
+    monkeypatch.setattr(main, "send_notifications", lambda msg, success=True: sent.append((msg, success)))
+    return sent
+
+@pytest.fixture
+def backup(main, vault):
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "success", job.error
+    return main.refresh_catalog(force=True)[0]["name"]
+
+def fail_rename_after(monkeypatch, main, count: int, undo_fails: bool = False):
+    """让第 count 次之后的 os.rename 失败 (undo_fails 为 False 时撤销用的 rename 仍然成功)"""
+    original = os.rename
+    calls = {"n": 0}
+
+    def rename(src, dst):
+        calls["n"] += 1
+        if calls["n"] == count + 1 or (undo_fails and calls["n"] > count):
+            raise OSError("simulated rename failure")
+        return original(src, dst)
+
+    monkeypatch.setattr(main.os, "rename", rename)
+
+def make_staging(main) -> str:
+    staging = os.path.join(main.DATA_DIR, main.RESTORE_STAGING_DIR)
+    os.makedirs(os.path.join(staging, "attachments"))
+    for name in ("db.sqlite3", "rsa_key.pem"):
+        with open(os.path.join(staging, name), "w") as f:
+            f.write("new")
+    return staging
+
+def test_swap_undoes_partial_moves(main, vault, monkeypatch):
+    before = data_digest(main.DATA_DIR)
+    staging = make_staging(main)
+    staged = sorted(os.listdir(staging))
+    rollback = os.path.join(main.DATA_DIR, main.RESTORE_ROLLBACK_DIR)
+    # 旧条目全部移走、第一个新条目移入后，移入第二个新条目时失败
+    old_entries = [n for n in os.listdir(main.DATA_DIR) if n not in main.DATA_WORK_DIRS]
+    fail_rename_after(monkeypatch, main, len(old_entries) + 1)
+
+    with pytest.raises(OSError, match="simulated"):
+        main.swap_data_entries(staging, rollback)
+    assert not os.path.exists(rollback)
+    assert sorted(os.listdir(staging)) == staged
+    assert data_digest(main.DATA_DIR) == before
+
+def test_swap_reports_failed_undo(main, vault, monkeypatch):
+    staging = make_staging(main)
+    rollback = os.path.join(main.DATA_DIR, main.RESTORE_ROLLBACK_DIR)
+    fail_rename_after(monkeypatch, main, 2, undo_fails=True)
+
+    with pytest.raises(main.ManualRecoveryRequired) as excinfo:
+        main.swap_data_entries(staging, rollback)
+    assert excinfo.value.rollback_dir == rollback
+    assert len(os.listdir(rollback)) == 2
+
+def test_health_check_failure_rolls_back(main, backup, services, notifications):
+    with open(os.path.join(main.DATA_DIR, "rsa_key.pem"), "w") as f:
+        f.write("rotated key")
+    before = data_digest(main.DATA_DIR)
+    configure(main, vaultwarden_url="http://127.0.0.1:9", restore_health_timeout=0)
+
+    job = run_job(main, "restore", main.download_and_restore, backup)
+    assert job.status == "failed" and "已回滚" in job.error
+    assert services[:4] == ["stop", "start", "stop", "start"] and services[-1] == "start"
+    assert data_digest(main.DATA_DIR) == before
+    assert not os.path.exists(os.path.join(main.DATA_DIR, main.RESTORE_ROLLBACK_DIR))
+    assert not notifications[-1][1]
+
+def test_failed_rollback_keeps_service_stopped(main, backup, services, notifications, monkeypatch):
+    configure(main, vaultwarden_url="http://127.0.0.1:9", restore_health_timeout=0)
+    original = main.swap_data_entries
+
+    def swap(src_dir, aside_dir):
+        if src_dir.endswith(main.RESTORE_ROLLBACK_DIR):
+            raise OSError("simulated rollback failure")
+        return original(src_dir, aside_dir)
+
+    monkeypatch.setattr(main, "swap_data_entries", swap)
+    job = run_job(main, "restore", main.download_and_restore, backup)
+    rollback = os.path.join(main.DATA_DIR, main.RESTORE_ROLLBACK_DIR)
+    assert job.status == "failed"
+    # 换回失败后不再启动服务，回滚目录保留
+    assert services == ["stop", "start", "stop"]
+    assert os.path.isdir(rollback)
+    msg, success = notifications[-1]
+    assert not success and rollback in msg
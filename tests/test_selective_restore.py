@@ -0,0 +1,115 @@
+"""按文件还原: 通过 Range 只读取远程 Zip 的中央目录与选中条目，其余文件不受影响"""
+import os
+import sqlite3
+
+import pytest
+
+from conftest import data_digest, run_job
+
+ATTACHMENT_PREFIX = "attachments/"
+
+@pytest.fixture
+def backup(main, vault):
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "success", job.error
+    return main.refresh_catalog(force=True)[0]["name"]
+
+@pytest.fixture
+def remotes(main, monkeypatch):
+    """记录每次打开的 HttpRangeFile，用于检查实际读取的字节数"""
+    opened = []
+    original = main.open_remote_zip
+
+    def recording(client, remote_path):
+        zf, remote = original(client, remote_path)
+        opened.append(remote)
+        return zf, remote
+
+    monkeypatch.setattr(main, "open_remote_zip", recording)
+    return opened
+
+def test_list_entries_reads_only_central_directory(main, backup, remotes):
+    listing = main.list_backup_entries(backup)
+    assert listing["format"] == "zip"
+    paths = [e["path"] for e in listing["entries"]]
+    assert main.SQLITE_DB_NAME in paths and "rsa_key.pem" in paths
+    assert sum(p.startswith(ATTACHMENT_PREFIX) for p in paths) == 5
+    assert remotes[0].fetched < remotes[0].size
+
+def test_restore_single_attachment(main, backup, remotes):
+    before = data_digest(main.DATA_DIR)
+    attachment = sorted(p for p in before if p.startswith(ATTACHMENT_PREFIX))[0]
+    with open(os.path.join(main.DATA_DIR, attachment), "wb") as f:
+        f.write(b"corrupted")
+    os.remove(os.path.join(main.DATA_DIR, "rsa_key.pem"))
+
+    job = run_job(main, "restore", main.restore_selected_files, backup, [attachment])
+    assert job.status == "success", job.error
+    after = data_digest(main.DATA_DIR)
+    assert after[attachment] == before[attachment]
+    # 未选中的文件保持还原前的状态
+    assert "rsa_key.pem" not in after
+    del before["rsa_key.pem"]
+    assert after == before
+    assert not os.path.exists(os.path.join(main.DATA_DIR, main.RESTORE_ROLLBACK_DIR))
+    assert remotes[0].fetched < remotes[0].size
+
+def test_restore_database_restarts_service(main, backup):
+    db_path = os.path.join(main.DATA_DIR, main.SQLITE_DB_NAME)
+    before = data_digest(main.DATA_DIR)
+    conn = sqlite3.connect(db_path)
+    conn.execute("DELETE FROM ciphers")
+    conn.commit()
+    conn.close()
+
+    job = run_job(main, "restore", main.restore_selected_files, backup, [main.SQLITE_DB_NAME])
+    assert job.status == "success", job.error
+    phases = [p["name"] for p in job.phases]
+    assert phases.index("stop") < phases.index("swap") < phases.index("start") < phases.index("health")
+    assert data_digest(main.DATA_DIR) == before
+
+def test_restore_missing_path_leaves_data_untouched(main, backup):
+    before = data_digest(main.DATA_DIR)
+    job = run_job(main, "restore", main.restore_selected_files, backup, ["no/such/file"])
+    assert job.status == "failed"
+    assert "没有选中的文件" in job.error
+    assert data_digest(main.DATA_DIR) == before
+
+@pytest.fixture
+def unhealthy(main, monkeypatch):
+    """健康检查总是失败，并记录停止/启动服务的调用顺序"""
+    calls = []
+    monkeypatch.setattr(main, "check_service_health", lambda: False)
+    monkeypatch.setattr(main, "stop_service", lambda: calls.append("stop"))
+    monkeypatch.setattr(main, "start_service", lambda: calls.append("start"))
+    return calls
+
+def test_database_restore_rolls_back_when_unhealthy(main, backup, unhealthy):
+    before = data_digest(main.DATA_DIR)
+    job = run_job(main, "restore", main.restore_selected_files, backup, [main.SQLITE_DB_NAME])
+    assert job.status == "failed" and "已换回" in job.error
+    assert unhealthy == ["stop", "start", "stop", "start"]
+    assert data_digest(main.DATA_DIR) == before
+
+def test_failed_rollback_runs_once_and_keeps_service_stopped(main, backup, unhealthy, monkeypatch):
+    sent = []
+    monkeypatch.setattr(main, "send_notifications", lambda msg, success=True: sent.append((msg, success)))
+    original = main.os.replace
+    rollback = os.path.join(main.DATA_DIR, main.RESTORE_ROLLBACK_DIR)
+    undo_calls = []
+
+    def replace(src, dst):
+        if str(src).startswith(rollback):
+            undo_calls.append(src)
+            raise OSError("simulated undo failure")
+        return original(src, dst)
+
+    monkeypatch.setattr(main.os, "replace", replace)
+    job = run_job(main, "restore", main.restore_selected_files, backup, [main.SQLITE_DB_NAME])
+    assert job.status == "failed"
+    # 换回只尝试一次，失败后不再启动服务
+    assert len(undo_calls) == 1
+    assert unhealthy == ["stop", "start", "stop"]
+    assert os.path.isdir(rollback)
+    msg, success = sent[-1]
+    assert not success and rollback in msg
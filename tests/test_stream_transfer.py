@@ -0,0 +1,26 @@
+"""流式传输: 打包加密直接作为 chunked PUT 上传、停机打包模式的时间点一致性，以及通过 Range 边下载边还原"""
+import os
+
+import pytest
+
+from conftest import PATHS, change_after_restart, configure, data_digest, run_job
+
+@pytest.mark.parametrize("backup_format", ["zip", "vwb"])
+def test_stop_mode_stream_is_point_in_time(main, vault, monkeypatch, backup_format):
+    configure(main, stream_transfer=True, backup_format=backup_format)
+    before = data_digest(main.DATA_DIR)
+    change_after_restart(main, monkeypatch)
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "success", job.error
+    phases = [p["name"] for p in job.phases]
+    assert phases.index("snapshot") < phases.index("start") < phases.index("upload")
+    # 流式上传不落地临时文件
+    assert not [n for n in os.listdir(main.TEMP_DIR) if n.startswith("vw_backup_")]
+
+    monkeypatch.undo()
+    name = main.refresh_catalog(force=True)[0]["name"]
+    remote = os.path.join(PATHS["dav"], vault["webdav_path"].strip("/"), name)
+    assert os.path.getsize(remote) == main.refresh_catalog()[0]["size"]
+    job = run_job(main, "restore", main.download_and_restore, name)
+    assert job.status == "success", job.error
+    assert data_digest(main.DATA_DIR) == before
@@ -0,0 +1,97 @@
+"""多目标复制: 一次打包并发上传、单个目标失败隔离、按目标保留与还原时的目标选择"""
+import os
+import time
+
+from conftest import PATHS, configure, data_digest, run_job
+
+def remote_names(remote_dir: str) -> list:
+    path = os.path.join(PATHS["dav"], remote_dir.strip("/"))
+    return sorted(n for n in os.listdir(path) if n.startswith("vw_backup_")) if os.path.isdir(path) else []
+
+def test_backup_fans_out_to_all_targets(main, vault, dav_url):
+    mirror = vault["webdav_path"] + "-mirror"
+    configure(main, webdav_targets=[{"name": "mirror", "webdav_url": dav_url, "webdav_path": mirror, "max_backups": 1}])
+
+    for _ in range(2):
+        job = run_job(main, "backup", main.perform_backup, True)
+        assert job.status == "success", job.error
+        time.sleep(1.1)  # 备份名精确到秒
+
+    primary = remote_names(vault["webdav_path"])
+    assert len(primary) == 2
+    # 镜像目标按自己的 max_backups 只保留最新的一个
+    assert remote_names(mirror) == primary[-1:]
+
+    merged = main.merge_catalog_entries(main.get_targets(main.load_config()))
+    assert merged[0]["name"] == primary[-1]
+    assert sorted(merged[0]["targets"]) == ["default", "mirror"]
+    assert merged[1]["targets"] == ["default"]
+
+def test_unreachable_target_does_not_fail_backup(main, vault):
+    cfg = configure(main, upload_retries=0, webdav_targets=[
+        {"name": "broken", "webdav_url": "http://127.0.0.1:9/", "webdav_path": "/", "timeout": 2}])
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "success", job.error
+    assert len(remote_names(vault["webdav_path"])) == 1
+
+    broken = next(t for t in main.get_targets(cfg) if t["name"] == "broken")
+    status = main.catalog.meta(main.catalog_target(broken))["last_upload"]
+    assert status["status"] == "failed" and status["error"]
+
+def test_restore_uses_target_that_still_has_the_backup(main, vault, dav_url):
+    mirror = vault["webdav_path"] + "-mirror"
+    cfg = configure(main, webdav_targets=[{"name": "mirror", "webdav_url": dav_url, "webdav_path": mirror}])
+    before = data_digest(main.DATA_DIR)
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "success", job.error
+
+    name = remote_names(mirror)[0]
+    os.remove(os.path.join(PATHS["dav"], vault["webdav_path"].strip("/"), name))
+    assert main.pick_restore_target(cfg, name)["name"] == "mirror"
+
+    os.remove(os.path.join(main.DATA_DIR, "rsa_key.pem"))
+    job = run_job(main, "restore", main.download_and_restore, name)
+    assert job.status == "success", job.error
+    assert data_digest(main.DATA_DIR) == before
+
+def test_targets_sharing_a_location_keep_separate_catalogs(main, vault, dav_url):
+    cfg = configure(main, webdav_targets=[
+        {"name": "other-account", "webdav_url": dav_url, "webdav_path": vault["webdav_path"], "webdav_user": "other"}])
+    primary, other = main.get_targets(cfg)
+    assert main.catalog_target(primary) != main.catalog_target(other)
+    assert main.catalog_target(vault) == main.catalog_target(primary)
+
+    main.catalog.set_upload_status(main.catalog_target(primary), name="a.zip", status="success", error=None)
+    main.catalog.set_upload_status(main.catalog_target(other), name="a.zip", status="failed", error="401")
+    assert main.catalog.meta(main.catalog_target(primary))["last_upload"]["status"] == "success"
+    assert main.catalog.meta(main.catalog_target(other))["last_upload"]["status"] == "failed"
+
+def test_duplicate_target_names_are_rejected(main):
+    for targets in ([{"name": "a"}, {"name": "a"}], [{"name": "default"}], [{"name": "target2"}, {}]):
+        _, errors = main.validate_config({"webdav_targets": targets})
+        assert errors and "目标名称重复" in errors[0]
+    assert main.validate_config({"webdav_targets": [{"name": "a"}, {}]})[1] == []
+
+def test_retention_counts_fallback_deletes(main, vault, monkeypatch):
+    configure(main, max_backups=1)
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "success", job.error
+    first = main.refresh_catalog(force=True)[0]
+
+    # 第一次删除失败，路径兼容重试成功
+    original = main.WebDavClient.remove
+    failures = []
+
+    def remove(self, path, *args, **kwargs):
+        if path.endswith(first["name"]) and not failures:
+            failures.append(path)
+            raise OSError("simulated delete failure")
+        return original(self, path, *args, **kwargs)
+
+    monkeypatch.setattr(main.WebDavClient, "remove", remove)
+    time.sleep(1.1)  # 备份名精确到秒
+    job = run_job(main, "backup", main.perform_backup, True)
+    assert job.status == "success", job.error
+    assert failures
+    assert first["name"] not in remote_names(vault["webdav_path"])
+    assert job.get_phase("retention")["bytes"] == first["size"]
@@ -0,0 +1,77 @@
+"""上传接收: 流式写入临时文件，格式错误、超过大小上限或不是备份文件时拒绝并删除临时文件"""
+import hashlib
+import os
+import time
+
+import pytest
+
+from conftest import PATHS, configure, run_job
+
+BOUNDARY = "test-boundary"
+
+def multipart(data: bytes, name: str = "file") -> bytes:
+    return (
+        f"--{BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="{name}"; filename="../backup.zip"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode() + data + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+def post(api, body, content_type: str = f"multipart/form-data; boundary={BOUNDARY}"):
+    return api.post("/api/upload_verify", content=body, headers={"content-type": content_type})
+
+def leftover_uploads(main) -> list:
+    return [n for n in os.listdir(main.TEMP_DIR) if n.endswith(".upload")]
+
+@pytest.fixture
+def archive(main, vault):
+    """一份真实的 Zip 备份内容"""
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "success", job.error
+    name = main.refresh_catalog(force=True)[0]["name"]
+    with open(os.path.join(PATHS["dav"], vault["webdav_path"].strip("/"), name), "rb") as f:
+        return f.read()
+
+def test_valid_upload_is_verified_and_removed(main, api, archive):
+    resp = post(api, multipart(archive))
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["sha256"] == hashlib.sha256(archive).hexdigest()
+    assert resp.json()["size"] == len(archive)
+    while main.jobs.current is not None:
+        time.sleep(0.05)
+    assert main.jobs.history[0].status == "success", main.jobs.history[0].error
+    assert leftover_uploads(main) == []
+
+@pytest.mark.parametrize("body, content_type, message", [
+    (b"plain body", "application/octet-stream", "multipart/form-data"),
+    (b"--other-boundary\r\nbroken", None, "multipart"),
+    (multipart(b"hello world, not a backup"), None, "不是 Zip 或 .vwb"),
+    (multipart(b"PK"), None, "文件过小"),
+    (multipart(b"data", name="other"), None, "没有名为 file"),
+], ids=["not-multipart", "malformed", "not-archive", "too-small", "no-file-field"])
+def test_rejected_uploads_leave_no_temp_files(main, api, vault, body, content_type, message):
+    resp = post(api, body, content_type) if content_type else post(api, body)
+    assert resp.status_code == 400
+    assert message in resp.json()["error"]
+    assert leftover_uploads(main) == []
+
+def test_truncated_zip_rejected(main, api, archive):
+    resp = post(api, multipart(archive[:len(archive) // 2]))
+    assert resp.status_code == 400 and "中央目录" in resp.json()["error"]
+    assert leftover_uploads(main) == []
+
+def test_oversize_upload_rejected(main, api, archive):
+    configure(main, upload_max_mb=1)
+    payload = multipart(archive[:4] + os.urandom(2 * 1024 * 1024))
+    # 声明的 Content-Length 超限时直接拒绝
+    resp = post(api, payload)
+    assert resp.status_code == 413
+    assert leftover_uploads(main) == []
+
+    # 分块传输没有 Content-Length，写入超过上限时中止
+    def chunks():
+        for i in range(0, len(payload), 64 * 1024):
+            yield payload[i:i + 64 * 1024]
+
+    resp = post(api, chunks())
+    assert resp.status_code == 413
+    assert leftover_uploads(main) == []
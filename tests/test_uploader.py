@@ -0,0 +1,157 @@
+"""可靠上传: 临时文件名 + MOVE、SabreDAV 分段续传、失败重试与退避、按 KB/s 限速"""
+import os
+import threading
+
+import pytest
+
+import benchmark
+from conftest import PATHS, configure
+
+class PartialUpdateHandler(benchmark.WebDavHandler):
+    """在 bench 的 WebDAV 服务器上增加 SabreDAV 部分更新 (PATCH + X-Update-Range)，并可注入失败"""
+    requests = []
+    # 方法 -> 剩余的失败次数；PATCH 失败时只写入一半数据，模拟连接中断前服务器已确认的部分
+    failures = {}
+
+    def _fail(self) -> bool:
+        self.requests.append((self.command, self.path))
+        remaining = self.failures.get(self.command, 0)
+        if remaining:
+            self.failures[self.command] = remaining - 1
+        return bool(remaining)
+
+    def do_OPTIONS(self):
+        self._fail()
+        self._send(200, headers={"DAV": "1, 2, sabredav-partialupdate"})
+
+    def do_PUT(self):
+        if self._fail():
+            for _ in self._read_body():
+                pass
+            return self._send(503)
+        super().do_PUT()
+
+    def do_MOVE(self):
+        self._fail()
+        super().do_MOVE()
+
+    def do_PATCH(self):
+        failing = self._fail()
+        path = self._fs_path(self.path)
+        start = int(self.headers["X-Update-Range"][6:].partition("-")[0])
+        data = b"".join(self._read_body())
+        with open(path, "r+b") as f:
+            f.seek(start)
+            f.write(data[:len(data) // 2] if failing else data)
+        self._send(500 if failing else 204)
+
+@pytest.fixture(scope="module")
+def patch_url():
+    root = os.path.join(PATHS["dav"], "partial")
+    os.makedirs(root, exist_ok=True)
+    handler = type("Handler", (PartialUpdateHandler,), {"root": os.path.realpath(root)})
+    server = benchmark.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/", root
+    server.shutdown()
+
+@pytest.fixture
+def partial_server(patch_url):
+    PartialUpdateHandler.requests.clear()
+    PartialUpdateHandler.failures.clear()
+    return patch_url
+
+@pytest.fixture
+def sleeps(main, monkeypatch):
+    """记录限速与重试退避的等待时间，不实际等待"""
+    waited = []
+    monkeypatch.setattr(main.time, "sleep", waited.append)
+    return waited
+
+def make_uploader(main, url: str, **overrides):
+    cfg = {"webdav_url": url, "upload_segment_mb": 1, "upload_retries": 2, **overrides}
+    return main.ResilientUploader(main.make_webdav_client(cfg), cfg)
+
+def write_source(main, size: int) -> tuple:
+    data = os.urandom(size)
+    path = os.path.join(main.TEMP_DIR, "source.bin")
+    os.makedirs(main.TEMP_DIR, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path, data
+
+def read_remote(root: str, name: str) -> bytes:
+    with open(os.path.join(root, name), "rb") as f:
+        return f.read()
+
+def test_upload_writes_part_then_moves(main, partial_server, sleeps):
+    url, root = partial_server
+    path, data = write_source(main, 200 * 1024)  # 小于一段，整体 PUT
+    make_uploader(main, url).upload_file(path, "/small.bin")
+    assert read_remote(root, "small.bin") == data
+    assert not os.path.exists(os.path.join(root, "small.bin" + main.UPLOAD_TEMP_SUFFIX))
+    methods = [(m, p) for m, p in PartialUpdateHandler.requests if m in ("PUT", "MOVE")]
+    assert methods == [("PUT", "/small.bin.part"), ("MOVE", "/small.bin.part")]
+
+def test_put_retries_with_backoff(main, partial_server, sleeps):
+    url, root = partial_server
+    path, data = write_source(main, 100 * 1024)
+    PartialUpdateHandler.failures["PUT"] = 2
+    uploader = make_uploader(main, url)
+    uploader.upload_file(path, "/retried.bin")
+    assert read_remote(root, "retried.bin") == data
+    assert uploader.retry_count == 2
+    assert sleeps == [1, 2]
+
+def test_put_gives_up_after_retries(main, partial_server, sleeps):
+    url, root = partial_server
+    path, _ = write_source(main, 100 * 1024)
+    PartialUpdateHandler.failures["PUT"] = 5
+    with pytest.raises(Exception):
+        make_uploader(main, url, upload_retries=1).upload_file(path, "/failed.bin")
+    assert not os.path.exists(os.path.join(root, "failed.bin"))
+
+def test_segmented_upload_resumes_from_acknowledged_offset(main, partial_server, sleeps):
+    url, root = partial_server
+    path, data = write_source(main, 3 * 1024 * 1024 + 12345)
+    PartialUpdateHandler.failures["PATCH"] = 1
+    uploader = make_uploader(main, url)
+    uploader.upload_file(path, "/resumed.bin")
+    assert read_remote(root, "resumed.bin") == data
+    assert uploader.retry_count == 1
+    patches = [p for m, p in PartialUpdateHandler.requests if m == "PATCH"]
+    # 第二段只确认了一半：之后从 1.5 MB 处续传，共 1 + 1 (失败) + 2 次
+    assert len(patches) == 4
+
+def test_stream_upload_uses_segments(main, partial_server, sleeps):
+    url, root = partial_server
+    path, data = write_source(main, 2 * 1024 * 1024 + 100)
+    with open(path, "rb") as f:
+        make_uploader(main, url).upload_stream(f, "/streamed.bin")
+    assert read_remote(root, "streamed.bin") == data
+
+@pytest.mark.parametrize("limit, rate", [(0.5, 512), (1.5, 1536), ("0.25", 256), (0, 0)])
+def test_fractional_bandwidth_limit(main, limit, rate):
+    cfg, errors = main.validate_config({"upload_bandwidth_limit": limit, "download_bandwidth_limit": limit})
+    assert errors == []
+    assert main.ResilientUploader(None, cfg).limiter.rate == rate
+    assert main.RangedDownloader(None, cfg).limiter.rate == rate
+
+def test_negative_bandwidth_limit_rejected(main):
+    _, errors = main.validate_config({"upload_bandwidth_limit": -1, "backup_read_limit": -0.5})
+    assert len(errors) == 2
+
+def test_rate_limiter_waits_for_sub_kb_rate(main, sleeps):
+    limiter = main.RateLimiter(0.5 * 1024)
+    limiter.consume(1024)
+    assert sleeps and sleeps[0] == pytest.approx(2, rel=0.05)
+
+def test_governor_read_limit_keeps_fraction(main, vault):
+    configure(main, backup_read_limit=0.5)
+    main.governor.begin("backup")
+    try:
+        assert main.governor._read_limiter.rate == 512
+    finally:
+        main.governor.end()
+    assert not main.governor._read_limiter.rate
@@ -0,0 +1,92 @@
+""".vwb 归档 (zstd + AES-256-GCM): 往返、篡改、截断、密码错误与完整备份还原"""
+import io
+import os
+
+import pytest
+
+from conftest import configure, data_digest, run_job
+
+PASSWORD = "test-password"
+
+@pytest.fixture
+def archive(main, vault):
+    path = os.path.join(main.TEMP_DIR, "test.vwb")
+    main.write_backup_vwb(path, PASSWORD)
+    with open(path, "rb") as f:
+        return f.read()
+
+def extract(main, blob: bytes, password) -> str:
+    dest = os.path.join(main.TEMP_DIR, "out")
+    os.makedirs(dest, exist_ok=True)
+    main.extract_vwb_archive(main.ArchiveReader(io.BytesIO(blob), password), dest)
+    return dest
+
+def test_vwb_round_trip(main, archive):
+    assert archive.startswith(main.ARCHIVE_MAGIC)
+    dest = extract(main, archive, PASSWORD)
+    assert data_digest(dest) == data_digest(main.DATA_DIR)
+
+def test_vwb_rejects_wrong_password(main, archive):
+    with pytest.raises(ValueError, match="密码错误"):
+        extract(main, archive, "wrong-password")
+    with pytest.raises(ValueError):
+        extract(main, archive, None)
+
+def test_vwb_rejects_tampered_chunk(main, archive):
+    tampered = bytearray(archive)
+    tampered[main.ARCHIVE_HEADER.size + 100] ^= 1
+    with pytest.raises(ValueError):
+        extract(main, bytes(tampered), PASSWORD)
+
+def test_vwb_rejects_truncated_archive(main, archive):
+    with pytest.raises(ValueError):
+        extract(main, archive[:-20], PASSWORD)
+
+def test_vwb_backup_and_restore(main, vault):
+    configure(main, backup_format="vwb")
+    before = data_digest(main.DATA_DIR)
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "success", job.error
+    name = main.refresh_catalog(force=True)[0]["name"]
+    assert name.endswith(main.ARCHIVE_SUFFIX)
+
+    os.remove(os.path.join(main.DATA_DIR, "rsa_key.pem"))
+    job = run_job(main, "restore", main.download_and_restore, name)
+    assert job.status == "success", job.error
+    assert data_digest(main.DATA_DIR) == before
+
+@pytest.mark.parametrize("change", [b"", b"appended while reading" * 1000], ids=["shrink", "grow"])
+def test_vwb_packs_files_changing_while_read(main, vault, monkeypatch, change):
+    """在线模式下文件可能在读取期间缩小或增长，归档记录实际读到的内容"""
+    victim = sorted(p for p in data_digest(main.DATA_DIR) if p.startswith("attachments/"))[0]
+    victim_path = os.path.join(main.DATA_DIR, victim)
+    original = main.governor.reader
+
+    def reader(f):
+        if f.name == victim_path:
+            if change:
+                with open(victim_path, "ab") as out:
+                    out.write(change)
+            else:
+                os.truncate(victim_path, 10)
+        return original(f)
+
+    monkeypatch.setattr(main.governor, "reader", reader)
+    path = os.path.join(main.TEMP_DIR, "test.vwb")
+    main.write_backup_vwb(path, PASSWORD)
+    with open(path, "rb") as f:
+        dest = extract(main, f.read(), PASSWORD)
+    assert data_digest(dest) == data_digest(main.DATA_DIR)
+
+def test_vwb_online_backup_and_restore(main, vault):
+    configure(main, backup_format="vwb", backup_mode="online")
+    before = data_digest(main.DATA_DIR)
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "success", job.error
+    assert "stop" not in [p["name"] for p in job.phases]
+
+    name = main.refresh_catalog(force=True)[0]["name"]
+    os.remove(os.path.join(main.DATA_DIR, "rsa_key.pem"))
+    job = run_job(main, "restore", main.download_and_restore, name)
+    assert job.status == "success", job.error
+    assert data_digest(main.DATA_DIR) == before
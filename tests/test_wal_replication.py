@@ -0,0 +1,133 @@
+"""持续复制: 读取 -wal 新提交的帧、检查点重置后的重新比较，以及按时间点重放增量段"""
+import os
+import sqlite3
+import time
+
+import pytest
+
+from conftest import configure, run_job
+
+def row_count(db_path: str) -> int:
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT count(*) FROM ciphers").fetchone()[0]
+    finally:
+        conn.close()
+
+@pytest.fixture
+def writer(main, vault):
+    """开启持续复制并完成一次基础备份，返回不自动检查点的数据库连接"""
+    configure(main, wal_replication=True, backup_mode="online")
+    main.scheduler.remove_all_jobs()
+    job = run_job(main, "backup", main.perform_backup)
+    assert job.status == "success", job.error
+    assert main.replicator.status()["seq"] == 0
+    conn = sqlite3.connect(os.path.join(main.DATA_DIR, main.SQLITE_DB_NAME))
+    conn.execute("PRAGMA wal_autocheckpoint=0")
+    yield conn
+    conn.close()
+
+def add_ciphers(conn, prefix: str, count: int = 50):
+    conn.executemany("INSERT INTO ciphers (uuid, data) VALUES (?, ?)",
+                     [(f"{prefix}-{i}", "x" * 300) for i in range(count)])
+    conn.commit()
+
+def test_read_wal_frames_follows_commits(main, writer):
+    wal_path = os.path.join(main.DATA_DIR, main.SQLITE_DB_NAME + "-wal")
+    add_ciphers(writer, "a")
+    pos = main.read_wal_header(wal_path)
+    pages, page_count, pos = main.read_wal_frames(wal_path, pos)
+    assert pages and page_count == writer.execute("PRAGMA page_count").fetchone()[0]
+
+    # 没有新的提交时位置不变
+    assert main.read_wal_frames(wal_path, pos) == ({}, None, pos)
+    add_ciphers(writer, "b")
+    pages, page_count, new_pos = main.read_wal_frames(wal_path, pos)
+    assert pages and new_pos["offset"] > pos["offset"]
+
+def test_tick_ships_only_new_frames(main, writer, monkeypatch):
+    add_ciphers(writer, "a")
+    main.replicator.tick()  # 新一代的第一个周期与影子库比较
+    assert main.replicator.status()["seq"] == 1
+
+    add_ciphers(writer, "b")
+    monkeypatch.setattr(main, "snapshot_sqlite", lambda *args: pytest.fail("不应复制整个数据库"))
+    main.replicator.tick()
+    status = main.replicator.status()
+    assert status["seq"] == 2 and status["last_error"] is None
+
+def test_tick_skipped_while_job_lock_held(main, writer):
+    add_ciphers(writer, "a")
+    with main.jobs.exclusive() as acquired:
+        assert acquired
+        main.replicator.tick()
+    assert main.replicator.status()["seq"] == 0
+
+def test_replay_to_point_in_time(main, writer):
+    db_path = os.path.join(main.DATA_DIR, main.SQLITE_DB_NAME)
+    base_name = main.replicator.status()["base"]
+
+    add_ciphers(writer, "a")
+    main.replicator.tick()
+    time.sleep(1.1)  # 增量段时间精确到秒
+    add_ciphers(writer, "b")
+    main.replicator.tick()
+    middle = main.replicator.status()["last_shipped"]
+    middle_rows = row_count(db_path)
+
+    time.sleep(1.1)
+    writer.execute("DELETE FROM ciphers WHERE uuid LIKE 'a-%'")
+    writer.commit()
+    # 截断检查点会重置 -wal，下一个周期改为与影子库逐页比较
+    writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    add_ciphers(writer, "c", 20)
+    main.replicator.tick()
+    assert main.replicator.status()["seq"] == 3
+    latest_rows = row_count(db_path)
+    assert latest_rows != middle_rows
+
+    for until, expected in ((middle, middle_rows), ("latest", latest_rows)):
+        job = run_job(main, "restore", main.download_and_restore, base_name, until)
+        assert job.status == "success", job.error
+        assert row_count(db_path) == expected
+
+def test_upload_runs_without_job_lock(main, writer, monkeypatch):
+    held = []
+    original = main.ResilientUploader.upload_bytes
+
+    def recording(self, *args, **kwargs):
+        held.append(main.jobs._lock.locked())
+        return original(self, *args, **kwargs)
+
+    monkeypatch.setattr(main.ResilientUploader, "upload_bytes", recording)
+    add_ciphers(writer, "a")
+    main.replicator.tick()
+    assert held == [False]
+    assert main.replicator.status()["seq"] == 1
+
+def test_result_dropped_when_new_generation_starts(main, writer, monkeypatch):
+    add_ciphers(writer, "a")
+    original = main.WalReplicator._ship
+
+    def backup_during_upload(self, *args):
+        time.sleep(1.1)  # 备份名精确到秒
+        job = run_job(main, "backup", main.perform_backup, True)
+        assert job.status == "success", job.error
+        original(self, *args)
+
+    monkeypatch.setattr(main.WalReplicator, "_ship", backup_during_upload)
+    base = main.replicator.status()["base"]
+    main.replicator.tick()
+    status = main.replicator.status()
+    assert status["base"] != base
+    assert status["seq"] == 0 and status.get("wal_pos") is None
+
+def test_scheduled_backup_reports_lock_timeout(main, vault, monkeypatch):
+    sent = []
+    monkeypatch.setattr(main, "JOB_LOCK_WAIT", 0.3)
+    monkeypatch.setattr(main, "send_notifications", lambda msg, success=True: sent.append((msg, success)))
+    with main.jobs.exclusive() as acquired:
+        assert acquired
+        main.run_scheduled_backup()
+    assert len(sent) == 1 and not sent[0][1]
+    assert "定时备份未执行" in sent[0][0]
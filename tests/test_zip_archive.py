@@ -0,0 +1,61 @@
+"""并行 AES Zip: 线程池中压缩加密的条目可由标准的 pyzipper 解密解压，内容与 /data 一致"""
+import io
+import os
+
+import pyzipper
+import pytest
+
+from conftest import configure, data_digest
+
+class Unseekable(io.RawIOBase):
+    """只能顺序写入的流 (流式上传时的管道)"""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+def extract(source, password, dest: str) -> dict:
+    with pyzipper.AESZipFile(source) as zf:
+        if password:
+            zf.setpassword(password.encode())
+        assert zf.testzip() is None
+        encrypted = {info.filename: bool(info.flag_bits & 0x1) for info in zf.infolist()}
+        zf.extractall(dest)
+    return encrypted
+
+@pytest.mark.parametrize("workers, password, level", [
+    (1, "test-password", 6),
+    (4, "test-password", 6),
+    (4, None, 6),
+    (4, "test-password", 0),
+], ids=["serial", "parallel", "unencrypted", "stored"])
+def test_round_trip(main, vault, tmp_path, workers, password, level):
+    configure(main, compression_workers=workers, compression_level=level)
+    archive = str(tmp_path / "backup.zip")
+    main.write_backup_zip(archive, password)
+
+    encrypted = extract(archive, password, str(tmp_path / "out"))
+    assert all(encrypted.values()) if password else not any(encrypted.values())
+    assert data_digest(str(tmp_path / "out")) == data_digest(main.DATA_DIR)
+
+def test_round_trip_to_unseekable_stream(main, vault, tmp_path):
+    configure(main, compression_workers=4)
+    stream = Unseekable()
+    main.write_backup_zip(stream, "test-password")
+    stream.buffer.seek(0)
+    extract(stream.buffer, "test-password", str(tmp_path / "out"))
+    assert data_digest(str(tmp_path / "out")) == data_digest(main.DATA_DIR)
+
+def test_wrong_password_rejected(main, vault, tmp_path):
+    configure(main, compression_workers=4)
+    archive = str(tmp_path / "backup.zip")
+    main.write_backup_zip(archive, "test-password")
+    with pyzipper.AESZipFile(archive) as zf:
+        zf.setpassword(b"wrong-password")
+        with pytest.raises(RuntimeError, match="password"):
+            zf.read(main.SQLITE_DB_NAME)